@@ -1,6 +1,18 @@
+"""
+Cleans the scraped Daft listings (../all-properties.json) for import into Firestore.
+
+Output: ./cleaned_properties.ndjson, one JSON property per line, newest first. This
+replaced the indented JSON array written to ./cleaned_properties.json, so the output
+can be written and read as a stream; import-to-firestore-put.js reads the new file.
+Other consumers of the old array can rebuild it with
+`jq -s . cleaned_properties.ndjson > cleaned_properties.json`.
+"""
+import heapq
 import json
+import os
 import re
-from typing import Any, Dict, List, Optional
+import tempfile
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 from datetime import datetime
 
 
@@ -218,136 +230,305 @@ def clean_property(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         return None
 
 
-def clean_properties_data(input_file: str, output_file: str):
-    print(f"Loading data from {input_file}...")
+READ_CHUNK_CHARS = 1 << 20  # input read per refill of the incremental parser
+SORT_RUN_SIZE = 5_000  # cleaned records sorted in memory per run of the external sort
+MERGE_FAN_IN = 64  # run files merged at once (each holds an open file)
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    print(f"Total properties loaded: {len(data)}")
-
-    cleaned_properties = []
-    errors = 0
-
-    for item in data:
-        cleaned = clean_property(item)
-        if cleaned:
-            cleaned_properties.append(cleaned)
-        else:
-            errors += 1
-
-    print(f"\nSuccessfully cleaned: {len(cleaned_properties)} properties")
-    print(f"Errors: {errors}")
 
+def iter_json_array(input_file: str, chunk_chars: int = READ_CHUNK_CHARS) -> Iterator[Any]:
+    """
+    Yields the elements of a top-level JSON array one at a time, so memory is bounded
+    by the largest element rather than the whole file.
+    """
+    decoder = json.JSONDecoder()
+    with open(input_file, "r", encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+
+        def fill(min_chars: int) -> bool:
+            """Appends input until min_chars are buffered past pos; False at end of file."""
+            nonlocal buffer, pos, eof
+            buffer = buffer[pos:]
+            pos = 0
+            while len(buffer) < min_chars and not eof:
+                chunk = f.read(max(chunk_chars, min_chars - len(buffer)))
+                eof = not chunk
+                buffer += chunk
+            return len(buffer) >= min_chars
+
+        def next_token() -> Optional[str]:
+            """Skips whitespace; returns the next character without consuming it."""
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if not fill(1):
+                    return None
+
+        if next_token() != "[":
+            raise ValueError(f"{input_file} does not contain a JSON array")
+        pos += 1
+        if next_token() == "]":
+            return
+        while True:
+            want = chunk_chars
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    # Only complete once a delimiter follows (a number may go on in the next chunk).
+                    if eof or (end < len(buffer) and buffer[end] in ",] \t\r\n"):
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # Most likely cut off by the end of the buffer: read more and retry,
+                # doubling so an element larger than a chunk is not re-parsed too often.
+                fill(len(buffer) - pos + want)
+                want *= 2
+            pos = end
+            yield item
+            token = next_token()
+            if token == "]":
+                return
+            if token != ",":
+                raise ValueError(f"Expected ',' or ']' in {input_file}, found {token!r}")
+            pos += 1
+            next_token()
+
+
+def _publish_date(prop: Dict[str, Any]) -> str:
+    return prop.get("dates", {}).get("publishDate") or ""
+
+
+def _write_ndjson(f, prop: Dict[str, Any]):
+    f.write(json.dumps(prop, ensure_ascii=False, separators=(",", ":")))
+    f.write("\n")
+
+
+def _iter_ndjson(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _sorted_by_publish_date(properties: Iterable[Dict[str, Any]], workdir: str, run_size: int):
+    """
+    Newest first, by external merge sort: sorted runs of run_size records are spilled
+    to NDJSON files in workdir, then merged. Ties keep their input order.
+    """
+    runs, run = [], []
+
+    def spill():
+        run.sort(key=_publish_date, reverse=True)
+        path = os.path.join(workdir, f"run-{len(runs):05d}.ndjson")
+        with open(path, "w", encoding="utf-8") as f:
+            for prop in run:
+                _write_ndjson(f, prop)
+        runs.append(path)
+        run.clear()
+
+    for prop in properties:
+        run.append(prop)
+        if len(run) >= run_size:
+            spill()
+    if not runs:  # everything fitted in one run
+        run.sort(key=_publish_date, reverse=True)
+        yield from run
+        return
+    if run:
+        spill()
+    # Merge passes until few enough runs remain to merge in one go; runs stay in
+    # input order, so ties still do.
+    passes = 0
+    while len(runs) > MERGE_FAN_IN:
+        passes += 1
+        merged = []
+        for i in range(0, len(runs), MERGE_FAN_IN):
+            group = runs[i : i + MERGE_FAN_IN]
+            path = os.path.join(workdir, f"merge-{passes}-{len(merged):05d}.ndjson")
+            with open(path, "w", encoding="utf-8") as f:
+                for prop in _merge(group):
+                    _write_ndjson(f, prop)
+            for done in group:
+                os.remove(done)
+            merged.append(path)
+        runs = merged
+    yield from _merge(runs)
+
+
+def _merge(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    return heapq.merge(*(_iter_ndjson(path) for path in paths), key=_publish_date, reverse=True)
+
+
+def clean_properties_data(
+    input_file: str,
+    output_file: str,
+    sort_by_date: bool = True,
+    run_size: int = SORT_RUN_SIZE,
+):
+    """
+    Cleans the scraped listings into NDJSON (one property per line), newest first.
+    Listings are parsed, cleaned and de-duplicated (by id) one at a time, so memory
+    stays bounded however large the scrape; sorting spills to temporary files next
+    to output_file. With sort_by_date=False the output keeps the scrape order.
+    """
+    print(f"Streaming data from {input_file}...")
+
+    counts = {"loaded": 0, "cleaned": 0, "errors": 0, "duplicates": 0}
     unique_ids = set()
-    deduplicated = []
-    for prop in cleaned_properties:
-        if prop["id"] not in unique_ids:
-            unique_ids.add(prop["id"])
-            deduplicated.append(prop)
-
-    duplicates_removed = len(cleaned_properties) - len(deduplicated)
-    if duplicates_removed > 0:
-        print(f"Removed {duplicates_removed} duplicates")
-
-    deduplicated.sort(
-        key=lambda x: x.get("dates", {}).get("publishDate", ""), reverse=True
-    )
-
-    print(f"\nWriting cleaned data to {output_file}...")
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(deduplicated, f, indent=2, ensure_ascii=False)
-
-    print(f"✓ Saved {len(deduplicated)} properties to {output_file}")
-
-    generate_summary(deduplicated)
-
 
-def generate_summary(properties: List[Dict[str, Any]]):
-    print("\n" + "=" * 60)
-    print("DATASET SUMMARY")
-    print("=" * 60)
-
-    print(f"\nTotal Properties: {len(properties)}")
-
-    prices = [p["price"]["amount"] for p in properties if p.get("price")]
-    if prices:
-        print(f"\nPrice Statistics:")
-        print(f"  Mean: €{sum(prices) / len(prices):,.2f}")
-        print(f"  Median: €{sorted(prices)[len(prices) // 2]:,.2f}")
-        print(f"  Min: €{min(prices):,.2f}")
-        print(f"  Max: €{max(prices):,.2f}")
-
-    bedrooms = {}
-    for p in properties:
+    def cleaned_properties():
+        for item in iter_json_array(input_file):
+            counts["loaded"] += 1
+            cleaned = clean_property(item)
+            if not cleaned:
+                counts["errors"] += 1
+                continue
+            counts["cleaned"] += 1
+            if cleaned["id"] in unique_ids:
+                counts["duplicates"] += 1
+                continue
+            unique_ids.add(cleaned["id"])
+            yield cleaned
+
+    summary = SummaryStats()
+    workdir = os.path.dirname(os.path.abspath(output_file))
+    with tempfile.TemporaryDirectory(prefix="clean-sort-", dir=workdir) as sort_dir:
+        properties = cleaned_properties()
+        if sort_by_date:
+            properties = _sorted_by_publish_date(properties, sort_dir, run_size)
+        with open(output_file, "w", encoding="utf-8") as f:
+            for prop in properties:
+                _write_ndjson(f, prop)
+                summary.add(prop)
+
+    print(f"Total properties loaded: {counts['loaded']}")
+    print(f"\nSuccessfully cleaned: {counts['cleaned']} properties")
+    print(f"Errors: {counts['errors']}")
+    if counts["duplicates"] > 0:
+        print(f"Removed {counts['duplicates']} duplicates")
+    print(f"✓ Saved {summary.total} properties to {output_file}")
+
+    summary.print()
+
+
+class SummaryStats:
+    """
+    Dataset summary accumulated one property at a time. Prices are counted per
+    distinct value for the median, so memory grows with the number of distinct
+    asking prices (a few thousand, as they are mostly round figures), not listings.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.price_counts: Dict[float, int] = {}
+        self.priced = 0
+        self.price_sum = 0.0
+        self.bedrooms: Dict[Any, int] = {}
+        self.property_types: Dict[str, int] = {}
+        self.ber_ratings: Dict[str, int] = {}
+        self.with_images = 0
+        self.with_video = 0
+        self.with_virtual_tour = 0
+        self.with_utilities = 0
+        self.with_eircode = 0
+        self.with_folio = 0
+        self.with_nearby = 0
+
+    def add(self, p: Dict[str, Any]):
+        self.total += 1
+        if p.get("price"):
+            amount = p["price"]["amount"]
+            self.price_counts[amount] = self.price_counts.get(amount, 0) + 1
+            self.priced += 1
+            self.price_sum += amount
         beds = p.get("bedrooms")
         if beds:
-            bedrooms[beds] = bedrooms.get(beds, 0) + 1
-
-    if bedrooms:
-        print(f"\nBedrooms Distribution:")
-        for beds in sorted(bedrooms.keys()):
-            print(f"  {beds} bed: {bedrooms[beds]}")
-
-    property_types = {}
-    for p in properties:
+            self.bedrooms[beds] = self.bedrooms.get(beds, 0) + 1
         ptype = p.get("propertyType")
         if ptype:
-            property_types[ptype] = property_types.get(ptype, 0) + 1
-
-    if property_types:
-        print(f"\nTop Property Types:")
-        for ptype, count in sorted(
-            property_types.items(), key=lambda x: x[1], reverse=True
-        )[:10]:
-            print(f"  {ptype}: {count}")
-
-    ber_ratings = {}
-    for p in properties:
+            self.property_types[ptype] = self.property_types.get(ptype, 0) + 1
         rating = p.get("ber", {}).get("rating")
         if rating:
-            ber_ratings[rating] = ber_ratings.get(rating, 0) + 1
-
-    if ber_ratings:
-        print(f"\nBER Rating Distribution:")
-        for rating in sorted(ber_ratings.keys()):
-            print(f"  {rating}: {ber_ratings[rating]}")
-
-    with_images = sum(
-        1 for p in properties if p.get("media", {}).get("totalImages", 0) > 0
-    )
-    print(f"\nMedia Statistics:")
-    print(
-        f"  Properties with images: {with_images} ({with_images / len(properties) * 100:.1f}%)"
-    )
-    print(
-        f"  Properties with video: {sum(1 for p in properties if p.get('media', {}).get('hasVideo'))}"
-    )
-    print(
-        f"  Properties with virtual tour: {sum(1 for p in properties if p.get('media', {}).get('hasVirtualTour'))}"
-    )
-
-    with_utilities = sum(
-        1 for p in properties if p.get("extracted", {}).get("utilities")
-    )
-    print(f"\nExtracted Information:")
-    print(f"  Properties with utility info: {with_utilities}")
-    print(
-        f"  Properties with Eircode: {sum(1 for p in properties if p.get('location', {}).get('eircodes'))}"
-    )
-    print(
-        f"  Properties with Folio: {sum(1 for p in properties if p.get('extracted', {}).get('folios'))}"
-    )
-    print(
-        f"  Properties with nearby locations: {sum(1 for p in properties if p.get('extracted', {}).get('nearbyLocations'))}"
-    )
-
-    print("\n" + "=" * 60)
+            self.ber_ratings[rating] = self.ber_ratings.get(rating, 0) + 1
+        media = p.get("media", {})
+        self.with_images += media.get("totalImages", 0) > 0
+        self.with_video += bool(media.get("hasVideo"))
+        self.with_virtual_tour += bool(media.get("hasVirtualTour"))
+        extracted = p.get("extracted", {})
+        self.with_utilities += bool(extracted.get("utilities"))
+        self.with_eircode += bool(p.get("location", {}).get("eircodes"))
+        self.with_folio += bool(extracted.get("folios"))
+        self.with_nearby += bool(extracted.get("nearbyLocations"))
+
+    def _median_price(self, prices: List[float]) -> float:
+        """The upper median, sorted(all prices)[n // 2], from the per-price counts."""
+        seen = 0
+        for price in prices:
+            seen += self.price_counts[price]
+            if seen > self.priced // 2:
+                return price
+        return prices[-1]
+
+    def print(self):
+        print("\n" + "=" * 60)
+        print("DATASET SUMMARY")
+        print("=" * 60)
+
+        print(f"\nTotal Properties: {self.total}")
+
+        if self.priced:
+            prices = sorted(self.price_counts)
+            print(f"\nPrice Statistics:")
+            print(f"  Mean: €{self.price_sum / self.priced:,.2f}")
+            print(f"  Median: €{self._median_price(prices):,.2f}")
+            print(f"  Min: €{prices[0]:,.2f}")
+            print(f"  Max: €{prices[-1]:,.2f}")
+
+        if self.bedrooms:
+            print(f"\nBedrooms Distribution:")
+            for beds in sorted(self.bedrooms.keys()):
+                print(f"  {beds} bed: {self.bedrooms[beds]}")
+
+        if self.property_types:
+            print(f"\nTop Property Types:")
+            for ptype, count in sorted(
+                self.property_types.items(), key=lambda x: x[1], reverse=True
+            )[:10]:
+                print(f"  {ptype}: {count}")
+
+        if self.ber_ratings:
+            print(f"\nBER Rating Distribution:")
+            for rating in sorted(self.ber_ratings.keys()):
+                print(f"  {rating}: {self.ber_ratings[rating]}")
+
+        print(f"\nMedia Statistics:")
+        print(
+            f"  Properties with images: {self.with_images} ({self.with_images / max(self.total, 1) * 100:.1f}%)"
+        )
+        print(f"  Properties with video: {self.with_video}")
+        print(f"  Properties with virtual tour: {self.with_virtual_tour}")
+
+        print(f"\nExtracted Information:")
+        print(f"  Properties with utility info: {self.with_utilities}")
+        print(f"  Properties with Eircode: {self.with_eircode}")
+        print(f"  Properties with Folio: {self.with_folio}")
+        print(f"  Properties with nearby locations: {self.with_nearby}")
+
+        print("\n" + "=" * 60)
+
+
+def generate_summary(properties: Iterable[Dict[str, Any]]):
+    summary = SummaryStats()
+    for p in properties:
+        summary.add(p)
+    summary.print()
 
 
 if __name__ == "__main__":
     input_file = "../all-properties.json"
-    output_file = "./cleaned_properties.json"
+    output_file = "./cleaned_properties.ndjson"
 
     clean_properties_data(input_file, output_file)
 
@@ -1,30 +1,39 @@
 import fs from "fs";
+import readline from "readline";
 import admin from "firebase-admin";
 
 admin.initializeApp();
 const db = admin.firestore();
 
 async function importDataWithPut() {
-  const data = JSON.parse(
-    fs.readFileSync("cleaning/cleaned_properties.json", "utf8"),
-  );
+  // One cleaned property per line (see cleaning/clean_properties_json.py), read as a stream.
+  const lines = readline.createInterface({
+    input: fs.createReadStream("cleaning/cleaned_properties.ndjson", "utf8"),
+    crlfDelay: Infinity,
+  });
 
-  console.log(`Starting import of ${data.length} properties...`);
+  console.log("Starting import of cleaned properties...");
 
-  for (let i = 0; i < data.length; i++) {
-    const property = data[i];
+  let imported = 0;
+  for await (const line of lines) {
+    if (!line.trim()) continue;
+    const property = JSON.parse(line);
 
     if (property && property.id) {
       const docRef = db.collection("properties").doc(property.id.toString());
-      await docRef.set(property);
-
-      if ((i + 1) % 100 === 0) {
-        console.log(`Imported ${i + 1}/${data.length} properties...`);
+      // Freshly imported listings are queued for the rule engine's marker-based discovery.
+      // Merged, not replaced, so a re-import keeps validityScore and listingFingerprint
+      // and fingerprint-based discovery can skip listings whose inputs did not change.
+      await docRef.set({ ...property, needsScoring: true }, { merge: true });
+      imported++;
+
+      if (imported % 100 === 0) {
+        console.log(`Imported ${imported} properties...`);
       }
     }
   }
 
-  console.log(`✓ Import complete! Imported ${data.length} properties`);
+  console.log(`✓ Import complete! Imported ${imported} properties`);
 }
 
 importDataWithPut().catch(console.error);
@@ -0,0 +1,514 @@
+# benchmarks.py
+"""
+Offline microbenchmarks for the CPU-bound hot paths: scoring kernels, the investment
+calculator and the Daft listing cleaner (daft-scraper/cleaning).
+
+Every benchmark runs on synthetic listings scattered over Ireland (clustered around
+the cities, like the real corpus) at each requested size, and records the best wall
+time of a few runs plus the peak traced memory of one extra run. Results are compared
+with a stored baseline; anything slower or hungrier than the tolerance fails the run,
+and so does a missing baseline: record one per machine before checking against it.
+
+    python benchmarks.py                           # 10, 1k, 100k and 1M rows
+    python benchmarks.py --sizes 10,1k --only rank_properties
+    python benchmarks.py --save-baseline           # record this machine's baseline
+    python benchmarks.py --hedging 5000            # lookup p50/p99 with and without hedging
+
+No API keys or network access are needed: dummy keys are set before the engine is
+imported and its caches point at a temporary directory.
+"""
+import argparse
+import asyncio
+import atexit
+import contextlib
+import gc
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+
+_SCRATCH_DIR = tempfile.mkdtemp(prefix="rule_engine_bench_")
+atexit.register(shutil.rmtree, _SCRATCH_DIR, ignore_errors=True)
+for _key in ("MAPS_API_KEY", "GEMINI_API_KEY", "DAFT_COOKIE"):
+    os.environ.setdefault(_key, "offline-benchmark")
+for _key, _name in (("HTTP_CACHE_PATH", "http_cache.sqlite3"), ("AMENITY_CACHE_PATH", "amenity_cache.sqlite3"),
+                    ("RENOVATION_CACHE_PATH", "renovation_cache.sqlite3"), ("IMAGE_STORE_PATH", "image_store"),
+                    ("AIR_QUALITY_GRID_PATH", "air_quality_grid.sqlite3"), ("SPATIAL_INDEX_PATH", "spatial_index.sqlite3")):
+    os.environ[_key] = os.path.join(_SCRATCH_DIR, _name)
+
+from config import SCORING_WEIGHTS, HEDGE_MAX_FRACTION
+from engine.investment_calculator import InvestmentCalculator
+from engine.scoring import (
+    CLUSTER_RADIUS_M, ScoringEngine, _amenity_access_score, _amenity_access_scores,
+    _cluster_score, _cluster_scores, _sustainability_score, _sustainability_scores,
+)
+
+CLEANING_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "..", "daft-scraper", "cleaning", "clean_properties_json.py")
+BASELINE_PATH = os.getenv("BENCHMARK_BASELINE_PATH", "benchmark_baseline.json")
+DEFAULT_SIZES = "10,1k,100k,1m"
+
+# A run regresses when it is slower than baseline * (1 + TIME_TOLERANCE) and by more than
+# TIME_FLOOR_S (tiny runs are all noise); likewise for peak memory.
+TIME_TOLERANCE = 0.25
+TIME_FLOOR_S = 0.002
+MEMORY_TOLERANCE = 0.10
+MEMORY_FLOOR_BYTES = 256 * 1024
+
+# Nested per-listing payloads (amenity lists, renovation items, raw Daft pages) are drawn
+# from a pool of this many distinct values, so a 1M-row input fits in memory while every
+# row still costs the same to process.
+POOL_SIZE = 2000
+# _cluster_score scans every property for one index; it is timed for this many indices.
+CLUSTER_PROBES = 10
+
+# (lat, lon, share) of listings around each city; the rest are spread over the country.
+CITIES = [(53.35, -6.26, 0.30), (51.90, -8.47, 0.12), (53.27, -9.05, 0.08),
+          (52.66, -8.63, 0.07), (52.26, -7.11, 0.05)]
+IRELAND_BOUNDS = ((51.45, 55.35), (-10.4, -6.05))
+BER_RATINGS = ["A2", "A3", "B1", "B2", "B3", "C1", "C2", "C3", "D1", "D2", "E1", "E2", "F", "G", None, "SI_666"]
+AMENITY_TYPES = ["supermarket", "school", "bus station", "train station", "park", "hospital", "pharmacy"]
+TOWNS = ["Ennis", "Tralee", "Athlone", "Sligo", "Mullingar", "Kilkenny", "Wexford", "Clonmel", "Letterkenny", "Navan"]
+
+
+# --- Synthetic data ---
+
+def _coordinates(rng: np.random.Generator, rows: int):
+    city = rng.choice(len(CITIES) + 1, size=rows, p=[c[2] for c in CITIES] + [1 - sum(c[2] for c in CITIES)])
+    centres = np.array([(lat, lon) for lat, lon, _ in CITIES] + [(0.0, 0.0)])
+    lats = centres[city, 0] + rng.normal(0, 0.08, rows)
+    lons = centres[city, 1] + rng.normal(0, 0.12, rows)
+    rural = city == len(CITIES)
+    lats[rural] = rng.uniform(*IRELAND_BOUNDS[0], rural.sum())
+    lons[rural] = rng.uniform(*IRELAND_BOUNDS[1], rural.sum())
+    return lats, lons
+
+
+def _amenity_details(rng: np.random.Generator) -> dict:
+    found = [
+        {"name": f"{t.title()} {i}", "type": t, "distance_km": round(float(rng.exponential(1.5)), 3)}
+        for i, t in enumerate(AMENITY_TYPES) if rng.random() < 0.8
+    ]
+    return {"score": round(float(rng.uniform(0, 100)), 2), "found_amenities": found, "degraded": False}
+
+
+def _renovation_details(rng: np.random.Generator) -> dict:
+    words = ["roof", "windows", "insulation", "boiler", "heating", "damp proofing", "rewiring", "kitchen"]
+    items = [
+        {"item": f"Replace {w}", "reason": f"The {w} is in poor condition", "material": "standard",
+         "amount": "1 lot", "price": round(float(rng.uniform(500, 20000)), 2)}
+        for w in rng.choice(words, size=int(rng.integers(1, 6)), replace=False)
+    ]
+    return {"items": items, "total_cost": round(sum(i["price"] for i in items), 2), "degraded": False}
+
+
+def enriched_properties(rows: int, seed: int = 7) -> List[dict]:
+    """Listings as they reach ScoringEngine.rank_properties."""
+    rng = np.random.default_rng(seed)
+    lats, lons = _coordinates(rng, rows)
+    amenities = [_amenity_details(rng) for _ in range(min(rows, POOL_SIZE))]
+    renovations = [_renovation_details(rng) for _ in range(min(rows, POOL_SIZE))]
+    prices = rng.uniform(40_000, 600_000, rows).round(0)
+    scores = rng.uniform(0, 100, (rows, 3)).round(2)
+    bers = rng.integers(0, len(BER_RATINGS), rows)
+    areas = rng.uniform(40, 250, rows).round(1)
+    return [
+        {
+            "property_id": str(1_000_000 + i), "address": f"{i} Main Street, {TOWNS[i % len(TOWNS)]}",
+            "latitude": float(lats[i]), "longitude": float(lons[i]), "listed_price": float(prices[i]),
+            "amenity_details": amenities[i % len(amenities)], "renovation_details": renovations[i % len(renovations)],
+            "amenity_score": float(scores[i, 0]), "price_attractiveness_score": float(scores[i, 1]),
+            "air_quality_score": float(scores[i, 2]), "ber": BER_RATINGS[bers[i]],
+            "area_m2": float(areas[i]) if i % 5 else None,
+        }
+        for i in range(rows)
+    ]
+
+
+def raw_daft_listings(rows: int, seed: int = 11, unique_ids: bool = True) -> List[dict]:
+    """
+    Scraped Daft listing pages as clean_property receives them. With unique_ids every row
+    gets its own listing id (about 3% repeated, for de-duplication); otherwise rows simply
+    cycle through the pool.
+    """
+    return list(iter_raw_daft_listings(rows, seed, unique_ids))
+
+
+def iter_raw_daft_listings(rows: int, seed: int = 11, unique_ids: bool = True) -> Iterator[dict]:
+    """raw_daft_listings() one row at a time, for inputs too large to hold in memory."""
+    rng = np.random.default_rng(seed)
+    lats, lons = _coordinates(rng, min(rows, POOL_SIZE))
+    pool = []
+    for i in range(min(rows, POOL_SIZE)):
+        town = TOWNS[i % len(TOWNS)]
+        description = (
+            f"Derelict cottage a short drive from {town} or {TOWNS[(i + 3) % len(TOWNS)]}, within an hour's drive "
+            f"of Galway. Close to local schools. Eircode H91 X{i % 10}Y{i % 7}. Folio CE{10000 + i}F. Mains water "
+            f"and septic tank, broadband available, electricity connected. " * int(rng.integers(1, 4))
+        )
+        images = [{"url": f"https://media.daft.ie/{i}/{k}.jpg",
+                   "imageLabels": [{"type": "FLOOR_PLAN"}] if k == 0 and i % 3 == 0 else []}
+                  for k in range(int(rng.integers(1, 15)))]
+        listing = {
+            "id": 5_000_000 + i, "title": f"{i} Old Road, {town}", "seoTitle": f"{i} Old Road {town}",
+            "price": f"€{int(rng.integers(40, 600)) * 1000:,}", "numBedrooms": f"{int(rng.integers(1, 6))} Bed",
+            "numBathrooms": f"{int(rng.integers(1, 4))} Bath", "propertyType": "House",
+            "floorArea": {"unit": "METRES_SQUARED", "value": str(int(rng.integers(40, 250)))},
+            "propertySize": f"{int(rng.integers(40, 250))} m²", "daftShortcode": str(i),
+            "seoFriendlyPath": f"/for-sale/house-{i}/{5_000_000 + i}", "areaName": town,
+            "point": {"coordinates": [float(lons[i]), float(lats[i])]},
+            "publishDate": f"2025-{int(rng.integers(1, 13)):02d}-{int(rng.integers(1, 29)):02d}T10:00:00",
+            "lastUpdateDate": "2025-10-01T09:30:00",
+            "ber": {"rating": BER_RATINGS[i % (len(BER_RATINGS) - 2)]},
+            "seller": {"sellerId": i % 300, "name": f"Agent {i % 300}", "sellerType": "BRANDED_AGENT",
+                       "phone": "01 234 5678", "licenceNumber": str(1000 + i % 300)},
+            "media": {"images": images, "totalImages": len(images), "hasVideo": bool(i % 2)},
+            "description": description, "features": ["Detached", "Large garden"],
+        }
+        pool.append({"props": {"pageProps": {"listing": listing, "amenities": [], "listingViews": int(rng.integers(0, 5000))}}})
+
+    if not unique_ids:
+        for i in range(rows):
+            yield pool[i % len(pool)]
+        return
+    # Row i is pool[i % POOL_SIZE] with its own id, except for a few repeated ids.
+    for i in range(rows):
+        base = pool[i % len(pool)]
+        listing = dict(base["props"]["pageProps"]["listing"])
+        listing["id"] = 5_000_000 + (i - 1 if i % 33 == 32 else i)
+        yield {"props": {"pageProps": {**base["props"]["pageProps"], "listing": listing}}}
+
+
+# --- Benchmarks ---
+
+def _load_cleaning_module():
+    spec = importlib.util.spec_from_file_location("clean_properties_json", CLEANING_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Benchmark(NamedTuple):
+    name: str
+    setup: Callable[[int], Any] # rows -> input; not timed
+    run: Callable[[Any], Any]
+    max_rows: Optional[int] = None # larger sizes are skipped
+
+
+def _rank_properties_setup(rows):
+    return ScoringEngine(SCORING_WEIGHTS, verbose=False), enriched_properties(rows)
+
+
+def _cluster_setup(rows):
+    props = enriched_properties(rows)
+    lats = np.array([p["latitude"] for p in props])
+    lons = np.array([p["longitude"] for p in props])
+    return lats, lons
+
+
+def _each(fn: Callable[[Any], Any]) -> Callable[[List[Any]], None]:
+    """Calls a per-row function on every row; results are dropped so a 1M-row run measures
+    the function rather than a list of a million results."""
+    def run(rows):
+        for row in rows:
+            fn(row)
+    return run
+
+
+def _cluster_score_run(data):
+    lats, lons = data
+    probes = np.linspace(0, len(lats) - 1, min(CLUSTER_PROBES, len(lats))).astype(int)
+    for i in probes:
+        _cluster_score(lats, lons, int(i), CLUSTER_RADIUS_M)
+
+
+def _sustainability_setup(rows):
+    props = enriched_properties(rows)
+    for p in props:
+        p["community_access_score"] = p["amenity_score"]
+    return props
+
+
+def _sustainability_columns_setup(rows):
+    props = _sustainability_setup(rows)
+    return [p["ber"] for p in props], [p["community_access_score"] for p in props], [p["area_m2"] for p in props]
+
+
+def _investment_setup(rows):
+    return InvestmentCalculator(), enriched_properties(rows)
+
+
+def _investment_run(data):
+    calculator, props = data
+    _each(lambda p: calculator.calculate(p["listed_price"], p["renovation_details"], p["listed_price"] * 1.4))(props)
+
+
+def _investment_many_run(data):
+    calculator, props = data
+    calculator.calculate_many([p["listed_price"] for p in props], [p["renovation_details"] for p in props],
+                              [p["listed_price"] * 1.4 for p in props])
+
+
+def _clean_property_setup(rows):
+    return _load_cleaning_module(), raw_daft_listings(rows, unique_ids=False)
+
+
+def _clean_properties_data_setup(rows):
+    module = _load_cleaning_module()
+    workdir = tempfile.mkdtemp(dir=_SCRATCH_DIR)
+    input_file = os.path.join(workdir, "all-properties.json")
+    # Written row by row: at 1M rows the input is ~1.5 GB of JSON.
+    with open(input_file, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i, item in enumerate(iter_raw_daft_listings(rows)):
+            f.write(",\n" if i else "\n")
+            json.dump(item, f, ensure_ascii=False)
+        f.write("\n]")
+    return module, input_file, os.path.join(workdir, "cleaned_properties.ndjson")
+
+
+def _clean_properties_data_run(data):
+    module, input_file, output_file = data
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.clean_properties_data(input_file, output_file)
+
+
+BENCHMARKS = [
+    Benchmark("rank_properties", _rank_properties_setup, lambda d: d[0].rank_properties(d[1])),
+    Benchmark("cluster_score", _cluster_setup, _cluster_score_run),
+    Benchmark("cluster_scores", _cluster_setup, lambda d: _cluster_scores(d[0], d[1], CLUSTER_RADIUS_M)),
+    Benchmark("amenity_access_score", lambda rows: [p["amenity_details"] for p in enriched_properties(rows)],
+              _each(_amenity_access_score)),
+    Benchmark("amenity_access_scores", lambda rows: [p["amenity_details"] for p in enriched_properties(rows)],
+              _amenity_access_scores),
+    Benchmark("sustainability_score", _sustainability_setup, _each(_sustainability_score)),
+    Benchmark("sustainability_scores", _sustainability_columns_setup, lambda columns: _sustainability_scores(*columns)),
+    Benchmark("investment_calculate", _investment_setup, _investment_run),
+    Benchmark("investment_calculate_many", _investment_setup, _investment_many_run),
+    Benchmark("clean_property", _clean_property_setup, lambda d: _each(d[0].clean_property)(d[1])),
+    # Memory stays flat with size; the cap only keeps the generated input (~1.5 GB at 1M) off the default run.
+    Benchmark("clean_properties_data", _clean_properties_data_setup, _clean_properties_data_run, max_rows=100_000),
+]
+
+
+# --- Measurement ---
+
+def measure(benchmark: Benchmark, rows: int, min_time_s: float, max_repeats: int, trace_memory: bool) -> dict:
+    data = benchmark.setup(rows)
+    times = []
+    while len(times) < max_repeats and (not times or sum(times) < min_time_s):
+        gc.collect()
+        started = time.perf_counter()
+        benchmark.run(data)
+        times.append(time.perf_counter() - started)
+
+    peak = None
+    if trace_memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            benchmark.run(data)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    del data
+    gc.collect()
+    return {"time_s": min(times), "mean_s": sum(times) / len(times), "runs": len(times), "peak_bytes": peak}
+
+
+def compare(result: dict, baseline: Optional[dict], time_tolerance: float, memory_tolerance: float) -> List[str]:
+    """Regression messages for one result against its baseline entry."""
+    if not baseline:
+        return []
+    problems = []
+    if (result["time_s"] > baseline["time_s"] * (1 + time_tolerance)
+            and result["time_s"] - baseline["time_s"] > TIME_FLOOR_S):
+        problems.append(f"time {result['time_s']:.4f}s vs baseline {baseline['time_s']:.4f}s "
+                        f"(+{result['time_s'] / baseline['time_s'] - 1:.0%})")
+    if (result["peak_bytes"] is not None and baseline.get("peak_bytes")
+            and result["peak_bytes"] > baseline["peak_bytes"] * (1 + memory_tolerance)
+            and result["peak_bytes"] - baseline["peak_bytes"] > MEMORY_FLOOR_BYTES):
+        problems.append(f"peak memory {_mb(result['peak_bytes'])} vs baseline {_mb(baseline['peak_bytes'])} "
+                        f"(+{result['peak_bytes'] / baseline['peak_bytes'] - 1:.0%})")
+    return problems
+
+
+def _mb(n: Optional[int]) -> str:
+    return "-" if n is None else f"{n / 2**20:.1f} MB"
+
+
+def parse_sizes(text: str) -> List[int]:
+    multipliers = {"k": 1_000, "m": 1_000_000}
+    sizes = []
+    for part in text.lower().split(","):
+        part = part.strip()
+        scale = multipliers.get(part[-1:], 1)
+        sizes.append(int(float(part[:-1] if scale > 1 else part) * scale))
+    return sizes
+
+
+def _label(rows: int) -> str:
+    for suffix, n in (("m", 1_000_000), ("k", 1_000)):
+        if rows >= n and rows % n == 0:
+            return f"{rows // n}{suffix}"
+    return str(rows)
+
+
+def load_baseline(path: str) -> Dict[str, dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("results", {})
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path: str, results: Dict[str, dict]):
+    merged = {**load_baseline(path), **results}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "python": platform.python_version(), "machine": platform.machine(), "processor": platform.processor(),
+            "numpy": np.__version__, "results": dict(sorted(merged.items())),
+        }, f, indent=2)
+        f.write("\n")
+
+
+# --- Hedged request latency (--hedging) ---
+# Async lookups against a fake endpoint that answers in HEDGE_BASE_S, except for
+# HEDGE_TAIL_FRACTION of requests that take HEDGE_TAIL_S, with and without hedging.
+
+HEDGE_BASE_S = 0.01
+HEDGE_TAIL_S = 2.0
+HEDGE_TAIL_FRACTION = 0.02
+HEDGE_CONCURRENCY = 50
+
+
+class _FakeResponse:
+    ok, status, headers = True, 200, {}
+
+    async def json(self, content_type=None):
+        return {}
+
+
+class _FakeSession:
+    """Just enough of aiohttp.ClientSession for ServiceClient.fetch_json_async."""
+
+    def __init__(self, rng: np.random.Generator):
+        self.rng = rng
+        self.requests = 0
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, url, timeout=None, **kwargs):
+        self.requests += 1
+        slow = self.rng.random() < HEDGE_TAIL_FRACTION
+        await asyncio.sleep(HEDGE_TAIL_S if slow else HEDGE_BASE_S)
+        yield _FakeResponse()
+
+
+def hedging_latency(calls: int, hedge_fraction: float, seed: int = 5) -> dict:
+    """p50/p99 latency of `calls` lookups, and the requests sent per lookup."""
+    from engine.service_client import ServiceClient
+
+    client = ServiceClient("bench", rate_per_s=1e6, max_attempts=1, timeout_s=10, deadline_s=10,
+                           hedge_fraction=hedge_fraction)
+    session = _FakeSession(np.random.default_rng(seed))
+    latencies = []
+
+    async def lookup(slots: asyncio.Semaphore):
+        async with slots:
+            started = time.perf_counter()
+            await client.fetch_json_async(session, "GET", "https://bench.invalid/lookup")
+            latencies.append(time.perf_counter() - started)
+
+    async def run():
+        slots = asyncio.Semaphore(HEDGE_CONCURRENCY)
+        await asyncio.gather(*(lookup(slots) for _ in range(calls)))
+
+    asyncio.run(run())
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {"p50_s": float(p50), "p99_s": float(p99), "requests_per_call": session.requests / calls}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"comma-separated row counts (default {DEFAULT_SIZES})")
+    parser.add_argument("--only", help="comma-separated benchmark names")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file (default %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE)
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument("--min-time", type=float, default=0.5, help="keep repeating a run until this many seconds")
+    parser.add_argument("--max-repeats", type=int, default=5)
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced-memory run")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--hedging", type=int, metavar="CALLS",
+                        help="instead, compare lookup latency with and without hedging over CALLS calls")
+    args = parser.parse_args(argv)
+
+    if args.hedging:
+        print(f"{'hedging':<10} {'p50':>9} {'p99':>9} {'requests/call':>14}")
+        for label, fraction in (("off", 0.0), ("on", HEDGE_MAX_FRACTION)):
+            result = hedging_latency(args.hedging, fraction)
+            print(f"{label:<10} {result['p50_s']:>8.3f}s {result['p99_s']:>8.3f}s {result['requests_per_call']:>14.3f}")
+        return 0
+
+    selected = BENCHMARKS
+    if args.only:
+        names = set(args.only.split(","))
+        unknown = names - {b.name for b in BENCHMARKS}
+        if unknown:
+            parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+        selected = [b for b in BENCHMARKS if b.name in names]
+
+    baseline = load_baseline(args.baseline)
+    if not baseline and not args.save_baseline:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one.", file=sys.stderr)
+        return 2
+
+    results, regressions, unchecked = {}, [], []
+    print(f"{'benchmark':<24} {'rows':>6} {'best':>10} {'mean':>10} {'runs':>4} {'peak mem':>11}  vs baseline")
+    for benchmark in selected:
+        for rows in parse_sizes(args.sizes):
+            key = f"{benchmark.name}@{_label(rows)}"
+            if benchmark.max_rows is not None and rows > benchmark.max_rows:
+                print(f"{benchmark.name:<24} {_label(rows):>6}   skipped (max {_label(benchmark.max_rows)} rows)")
+                continue
+            result = measure(benchmark, rows, args.min_time, args.max_repeats, not args.no_memory)
+            results[key] = result
+            problems = compare(result, baseline.get(key), args.time_tolerance, args.memory_tolerance)
+            if key not in baseline:
+                unchecked.append(key)
+            regressions.extend(f"{key}: {p}" for p in problems)
+            reference = baseline.get(key)
+            delta = f"{result['time_s'] / reference['time_s'] - 1:+.0%}" if reference and reference["time_s"] else "-"
+            print(f"{benchmark.name:<24} {_label(rows):>6} {result['time_s']:>9.4f}s {result['mean_s']:>9.4f}s "
+                  f"{result['runs']:>4} {_mb(result['peak_bytes']):>11}  {delta}{'  REGRESSION' if problems else ''}",
+                  flush=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"\nBaseline saved to {args.baseline} ({len(results)} results).")
+        return 0
+    if regressions:
+        print("\nREGRESSIONS:", file=sys.stderr)
+        for line in regressions:
+            print(f"  {line}", file=sys.stderr)
+    if unchecked:
+        # A result with nothing to compare against must not pass as "no regression".
+        print(f"\nNOT IN THE BASELINE (re-run with --save-baseline): {', '.join(unchecked)}", file=sys.stderr)
+    return 1 if regressions or unchecked else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,12 +5,41 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# --- Per-Worker Local Files ---
+# Sharded workers (see "Sharded Execution" below) each set a SHARD_WORKER_ID. With one
+# set, every local file this module names (the spatial index, the caches, the air
+# quality grid, the image store, the journal, the metrics textfile and run report) gets
+# the ID inserted before its extension, e.g. spatial_index.a.sqlite3, so workers on
+# one host never share one. Pointing several workers at the same files is unsupported:
+# each seeds an empty spatial index on its own and their writes race.
+SHARD_WORKER_ID = os.getenv("SHARD_WORKER_ID", "")
+
+
+def _worker_path(path: str) -> str:
+    if not SHARD_WORKER_ID:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{SHARD_WORKER_ID}{ext}"
+
+
+# --- Record / Replay of External Calls ---
+# "record": make every Places, Air Quality, GetHousePrice, image and Gemini call for real
+#           and save the exchanges (with their latencies) under CASSETTE_PATH.
+# "replay": answer those calls from CASSETTE_PATH without any network, after sleeping the
+#           recorded latency times CASSETTE_LATENCY_SCALE (0 = no delay). API keys are not
+#           needed. Point the local caches at empty paths to replay every call.
+# "off":    talk to the live services.
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes")
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "1.0"))
+_REPLAYING = CASSETTE_MODE == "replay"
+
 # --- Google Cloud & Firebase Configuration ---
-MAPS_API_KEY = os.getenv("MAPS_API_KEY")
+MAPS_API_KEY = os.getenv("MAPS_API_KEY") or ("replay" if _REPLAYING else None)
 if not MAPS_API_KEY:
     raise RuntimeError("ERROR: MAPS_API_KEY not found. Please set it in your .env file.")
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or ("replay" if _REPLAYING else None)
 if not GEMINI_API_KEY:
     raise RuntimeError("ERROR: GEMINI_API_KEY not found.")
 
@@ -25,7 +54,166 @@ SCORING_WEIGHTS = {
     "air_quality": 0.10,
 }
 
-DAFT_COOKIE = os.getenv("DAFT_COOKIE")
+# --- Discovery of Unprocessed Properties ---
+# "scan":   page through every property reading only the validityScore field.
+# "marker": let Firestore filter on needsScoring == true (requires the marker to be
+#           maintained; run `python main.py --mark-unscored` once to backfill it).
+# "fingerprint": page through every property reading only the listing inputs, and yield
+#           the unscored ones plus those whose listing fingerprint differs from the one
+#           stored with their scores, so no-op rewrites are skipped. Properties scored
+#           before fingerprints existed have none and count as changed, so the first
+#           run in this mode rescores the whole corpus; that is intended, as those
+#           scores were computed without the floor area and BER inputs.
+DISCOVERY_MODE = os.getenv("DISCOVERY_MODE", "scan")
+DISCOVERY_PAGE_SIZE = int(os.getenv("DISCOVERY_PAGE_SIZE", "300"))
+
+# --- Community Cluster Index ---
+# SQLite file holding every known property's coordinates, so cluster scores are
+# computed against the whole corpus rather than the current chunk.
+SPATIAL_INDEX_PATH = _worker_path(os.getenv("SPATIAL_INDEX_PATH", "spatial_index.sqlite3"))
+
+# --- Amenity Cache ---
+# Places results are cached per grid cell (AMENITY_CELL_DEG degrees, ~1 km) and amenity
+# type, so neighbouring listings share one lookup. Memory plus an SQLite file, LRU-capped.
+AMENITY_CACHE_PATH = _worker_path(os.getenv("AMENITY_CACHE_PATH", "amenity_cache.sqlite3"))
+AMENITY_CACHE_TTL_S = float(os.getenv("AMENITY_CACHE_TTL_DAYS", "30")) * 86400
+AMENITY_CACHE_MAX_ENTRIES = int(os.getenv("AMENITY_CACHE_MAX_ENTRIES", "200000"))
+AMENITY_CELL_DEG = float(os.getenv("AMENITY_CELL_DEG", "0.01"))
+
+# --- Market Prices ---
+# "local": answer from houseprice_data.json in-process (same logic as the getHousePrice
+#          Cloud Function), falling back to the HTTP call if the file cannot be loaded.
+# "http":  always call the Cloud Function.
+MARKET_PRICE_SOURCE = os.getenv("MARKET_PRICE_SOURCE", "local")
+HOUSE_PRICE_DATA_PATH = os.getenv("HOUSE_PRICE_DATA_PATH", os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "firebase", "functions", "src", "getHousePrice", "houseprice_data.json",
+))
+
+# --- Air Quality Grid ---
+# Daily per-cell aggregates written by `python main.py --precompute-air-quality`;
+# enrichment interpolates from them and only calls the API for cells without fresh data.
+AIR_QUALITY_GRID_PATH = _worker_path(os.getenv("AIR_QUALITY_GRID_PATH", "air_quality_grid.sqlite3"))
+AIR_QUALITY_CELL_DEG = float(os.getenv("AIR_QUALITY_CELL_DEG", "0.05"))
+AIR_QUALITY_GRID_MAX_AGE_S = float(os.getenv("AIR_QUALITY_GRID_MAX_AGE_HOURS", "36")) * 3600
+
+# --- Listing Images ---
+# Photos are downscaled to at most IMAGE_MAX_DIMENSION px on the long side (re-encoded as
+# JPEG) before going to Gemini. IMAGE_MEMORY_BUDGET_MB caps the image bytes held by all
+# in-flight properties; each property reserves IMAGE_RESERVE_KB per photo before downloading.
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_MEMORY_BUDGET_BYTES = int(float(os.getenv("IMAGE_MEMORY_BUDGET_MB", "256")) * 1024 * 1024)
+IMAGE_MAX_DOWNLOAD_BYTES = int(float(os.getenv("IMAGE_MAX_DOWNLOAD_MB", "20")) * 1024 * 1024)
+IMAGE_RESERVE_BYTES = int(float(os.getenv("IMAGE_RESERVE_KB", "1024")) * 1024)
+
+# Downloaded photos are kept in a content-addressed store on disk (LRU-evicted above
+# IMAGE_STORE_MAX_MB). Copies older than IMAGE_STORE_MAX_AGE_HOURS are revalidated
+# with a conditional GET rather than downloaded again.
+IMAGE_STORE_PATH = _worker_path(os.getenv("IMAGE_STORE_PATH", "image_store"))
+IMAGE_STORE_MAX_BYTES = int(float(os.getenv("IMAGE_STORE_MAX_MB", "2048")) * 1024 * 1024)
+IMAGE_STORE_MAX_AGE_S = float(os.getenv("IMAGE_STORE_MAX_AGE_HOURS", "24")) * 3600
+
+# --- Renovation Analysis Cache ---
+# Gemini renovation estimates keyed on a hash of the listing photos, prompt and model.
+# Bump RENOVATION_CACHE_VERSION to invalidate every cached analysis.
+RENOVATION_CACHE_PATH = _worker_path(os.getenv("RENOVATION_CACHE_PATH", "renovation_cache.sqlite3"))
+RENOVATION_CACHE_TTL_S = float(os.getenv("RENOVATION_CACHE_TTL_DAYS", "365")) * 86400
+RENOVATION_CACHE_MAX_ENTRIES = int(os.getenv("RENOVATION_CACHE_MAX_ENTRIES", "100000"))
+RENOVATION_CACHE_VERSION = os.getenv("RENOVATION_CACHE_VERSION", "1")
+
+# --- HTTP Response Cache ---
+# Decoded Places / GetHousePrice / Air Quality responses, kept across runs so reruns
+# and crash recovery do not pay for the same calls twice. TTLs are per endpoint.
+# Set HTTP_CACHE_BYPASS=1 to ignore cached entries (fresh responses are still stored).
+HTTP_CACHE_PATH = _worker_path(os.getenv("HTTP_CACHE_PATH", "http_cache.sqlite3"))
+HTTP_CACHE_MAX_ENTRIES = int(os.getenv("HTTP_CACHE_MAX_ENTRIES", "500000"))
+HTTP_CACHE_BYPASS = os.getenv("HTTP_CACHE_BYPASS", "0").lower() in ("1", "true", "yes")
+HTTP_CACHE_TTL_S = {
+    "places": 30 * 86400,
+    "market_price": 7 * 86400,
+    "air_quality_current": 3600,
+    "air_quality_history": 86400,
+}
+
+# --- External Service Quotas ---
+# Sustained request rate per service (requests per minute, matching how the quotas are
+# published). Calls queue for a slot instead of bursting into 429s. Failed calls (429,
+# 5xx, dropped connections) are retried up to SERVICE_MAX_ATTEMPTS times with jittered
+# exponential backoff starting at SERVICE_BACKOFF_BASE_S.
+SERVICE_RATE_PER_MIN = {
+    "places": float(os.getenv("PLACES_RATE_PER_MIN", "600")),
+    "air_quality": float(os.getenv("AIR_QUALITY_RATE_PER_MIN", "6000")),
+    "market_price": float(os.getenv("MARKET_PRICE_RATE_PER_MIN", "3000")),
+    "gemini": float(os.getenv("GEMINI_RATE_PER_MIN", "1000")),
+}
+SERVICE_MAX_ATTEMPTS = int(os.getenv("SERVICE_MAX_ATTEMPTS", "5"))
+SERVICE_BACKOFF_BASE_S = float(os.getenv("SERVICE_BACKOFF_BASE_S", "0.5"))
+SERVICE_BACKOFF_MAX_S = float(os.getenv("SERVICE_BACKOFF_MAX_S", "30"))
+
+# Per-attempt timeout and overall deadline (retries included) per service, in seconds.
+# An endpoint failing CIRCUIT_FAILURE_THRESHOLD times in a row is skipped (its fallback
+# used at once) for CIRCUIT_RESET_S before a probe call is let through. Async calls still
+# running past the endpoint's p95 latency get a duplicate request, for at most
+# HEDGE_MAX_FRACTION of calls (never while a cassette records or replays).
+SERVICE_TIMEOUT_S = {
+    "places": float(os.getenv("PLACES_TIMEOUT_S", "5")),
+    "air_quality": float(os.getenv("AIR_QUALITY_TIMEOUT_S", "10")),
+    "market_price": float(os.getenv("MARKET_PRICE_TIMEOUT_S", "10")),
+    "gemini": float(os.getenv("GEMINI_TIMEOUT_S", "120")),
+}
+SERVICE_DEADLINE_S = {
+    "places": float(os.getenv("PLACES_DEADLINE_S", "15")),
+    "air_quality": float(os.getenv("AIR_QUALITY_DEADLINE_S", "20")),
+    "market_price": float(os.getenv("MARKET_PRICE_DEADLINE_S", "15")),
+    "gemini": float(os.getenv("GEMINI_DEADLINE_S", "300")),
+}
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_S = float(os.getenv("CIRCUIT_RESET_S", "30"))
+HEDGE_MAX_FRACTION = float(os.getenv("HEDGE_MAX_FRACTION", "0.1"))
+
+# Logging and metrics. LOG_FORMAT is "text" (key=value lines) or "json". The Prometheus
+# textfile is rewritten every METRICS_EXPORT_INTERVAL_S during a run (0 = only at the
+# end); the JSON run report is written once the run finishes.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+METRICS_TEXTFILE_PATH = _worker_path(os.getenv("METRICS_TEXTFILE_PATH", "rule_engine.prom"))
+METRICS_EXPORT_INTERVAL_S = float(os.getenv("METRICS_EXPORT_INTERVAL_S", "30"))
+RUN_REPORT_PATH = _worker_path(os.getenv("RUN_REPORT_PATH", "run_report.json"))
+
+# --- Checkpoint Journal ---
+# Each property's lookup, renovation and scoring outputs (and its write status) are
+# appended to this file, fsync'd, so a run that dies resumes where it stopped without
+# repeating external calls. Checkpoints older than JOURNAL_MAX_AGE_DAYS are discarded.
+JOURNAL_PATH = _worker_path(os.getenv("JOURNAL_PATH", "enrichment_journal.log"))
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "1").lower() in ("1", "true", "yes")
+JOURNAL_MAX_AGE_S = float(os.getenv("JOURNAL_MAX_AGE_DAYS", "7")) * 86400
+
+# --- Sharded Execution (`python main.py --sharded`) ---
+# Workers split the properties into SHARD_COUNT document-ID ranges and claim them through
+# lease documents renewed every SHARD_HEARTBEAT_S; a lease not renewed for SHARD_LEASE_S
+# is reclaimed by another worker. Each claim of SHARDS_PER_CLAIM shards reads only their
+# ranges during discovery. SHARD_WORKER_ID (read above) is required in sharded mode:
+# unique per worker and stable across restarts, as it also names the worker's journal
+# and its other local files.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "8"))
+SHARDS_PER_CLAIM = int(os.getenv("SHARDS_PER_CLAIM", "1"))
+SHARD_LEASE_S = float(os.getenv("SHARD_LEASE_S", "120"))
+SHARD_HEARTBEAT_S = float(os.getenv("SHARD_HEARTBEAT_S", "30"))
+
+# --- Stage Refresh (`python main.py --refresh`) ---
+# How long each stored enrichment stage stays valid, in seconds (None = until its inputs
+# change). Air quality and market prices age out; amenities, renovation estimates and the
+# investment analysis are only recomputed when the coordinates, photos or price change.
+STAGE_TTL_S = {
+    "amenity": None,
+    "market_average": float(os.getenv("MARKET_AVERAGE_TTL_DAYS", "30")) * 86400,
+    "air_quality": float(os.getenv("AIR_QUALITY_TTL_HOURS", "24")) * 3600,
+    "renovation": None,
+    "investment": None,
+}
+
+DAFT_COOKIE = os.getenv("DAFT_COOKIE") or ("replay" if _REPLAYING else None)
 if not DAFT_COOKIE:
     raise RuntimeError("ERROR: DAFT_COOKIE not found. Please set it in your .env file.")
 
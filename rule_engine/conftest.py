@@ -0,0 +1,20 @@
+# conftest.py
+"""
+Offline settings for the tests, applied before config is imported: placeholder API
+keys (no test calls a live service) and local caches under a scratch directory, so
+a test run never reads or writes the real cache files.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+_SCRATCH_DIR = tempfile.mkdtemp(prefix="rule_engine_test_")
+atexit.register(shutil.rmtree, _SCRATCH_DIR, ignore_errors=True)
+for _key in ("MAPS_API_KEY", "GEMINI_API_KEY", "DAFT_COOKIE"):
+    os.environ.setdefault(_key, "offline-test")
+for _key, _name in (("HTTP_CACHE_PATH", "http_cache.sqlite3"), ("AMENITY_CACHE_PATH", "amenity_cache.sqlite3"),
+                    ("RENOVATION_CACHE_PATH", "renovation_cache.sqlite3"), ("IMAGE_STORE_PATH", "image_store"),
+                    ("AIR_QUALITY_GRID_PATH", "air_quality_grid.sqlite3"), ("SPATIAL_INDEX_PATH", "spatial_index.sqlite3"),
+                    ("JOURNAL_PATH", "enrichment_journal.log"), ("METRICS_TEXTFILE_PATH", "rule_engine.prom")):
+    os.environ[_key] = os.path.join(_SCRATCH_DIR, _name)
@@ -2,12 +2,14 @@ from enum import Enum
 
 COLLECTION_NAME = "properties"
 COLLECTION_NAME_VALIDITY_DATA = "validity_data"
+COLLECTION_NAME_LEASES = "pipeline_leases" # shard leases of sharded batch runs
 
 
 # Field names from the rules engine
 class FIELD_NAMES_RE(Enum):
     VALIDITY_SCORE = "validity_score"
     COMMUNITY_SCORE = "community_score"
+    LISTING_FINGERPRINT = "listing_fingerprint"
     ID = "id"
 
 
@@ -15,4 +17,8 @@ class FIELD_NAMES_RE(Enum):
 class FIELD_NAMES_FE(Enum):
     VALIDITY_SCORE = "validityScore"
     COMMUNITY_SCORE = "communityScore"
+    # Maintained marker: true on import, false once scores are written.
+    NEEDS_SCORING = "needsScoring"
+    # Hash of the listing inputs the scores were computed from (see data_loader.listing_fingerprint).
+    LISTING_FINGERPRINT = "listingFingerprint"
     ID = "id"
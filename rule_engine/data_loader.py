@@ -1,27 +1,77 @@
 # data_loader.py
+import hashlib
+import logging
+import os
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.auth.credentials import AnonymousCredentials
 from config import PROJECT_ID
+from telemetry import metrics
 import json
 
+log = logging.getLogger(__name__)
+
+FIRESTORE_READ_SECONDS = metrics.histogram(
+    "rule_engine_firestore_read_seconds", "Latency of single property document reads.")
+DOCUMENTS_LOADED = metrics.counter(
+    "rule_engine_documents_loaded_total", "Property documents read from Firestore, by result.", ["result"])
+
+# Fields (dotted paths) of a properties document that load_from_firestore reads. The
+# listing fingerprint covers exactly these, so a rewrite leaving them unchanged is a no-op.
+LISTING_INPUT_PATHS = [
+    "id", "seoFriendlyPath", "price.amount", "title", "location.coordinates",
+    "floorArea", "floorAreaFormatted", "ber.rating", "storageImages",
+]
+
+class _EmulatorCredential(credentials.Base):
+    """Anonymous credential for the local Firestore emulator, so no gcloud login is needed."""
+    def get_credential(self):
+        return AnonymousCredentials()
+
 def initialize_firebase():
-    """Initializes the Firebase Admin SDK using Application Default Credentials."""
+    """
+    Initializes the Firebase Admin SDK using Application Default Credentials,
+    or anonymously when FIRESTORE_EMULATOR_HOST points at a local emulator.
+    """
     try:
-        print(f"Authenticating with Google Cloud Project: {PROJECT_ID} using ADC...")
+        if os.getenv("FIRESTORE_EMULATOR_HOST"):
+            log.info("Using Firestore emulator",
+                     extra={"emulator_host": os.getenv("FIRESTORE_EMULATOR_HOST"), "project": PROJECT_ID})
+            firebase_admin.initialize_app(_EmulatorCredential(), {'projectId': PROJECT_ID})
+            return firestore.client()
+        log.info("Authenticating with Application Default Credentials", extra={"project": PROJECT_ID})
         cred = credentials.ApplicationDefault()
         firebase_admin.initialize_app(cred, {'projectId': PROJECT_ID})
         return firestore.client()
     except Exception as e:
-        print(f"FATAL ERROR: Could not initialize Firebase Admin SDK. {e}")
-        print("Ensure you have authenticated via gcloud: 'gcloud auth application-default login'")
+        log.critical("Could not initialize Firebase Admin SDK. Ensure you have authenticated via gcloud: "
+                     "'gcloud auth application-default login'", extra={"error": str(e)})
         exit()
 
+def _get_path(data, path: str):
+    for key in path.split("."):
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+def listing_fingerprint(data: dict) -> str:
+    """
+    Hash of a properties document's LISTING_INPUT_PATHS. Gives the same value for the
+    full document and for a query projection of just those fields.
+    """
+    inputs = {path: _get_path(data, path) for path in LISTING_INPUT_PATHS}
+    encoded = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
 def load_from_firestore(db, doc_id: str) -> dict:
     """Fetches and transforms a single property document from Firestore."""
     doc_ref = db.collection('properties').document(doc_id)
-    doc = doc_ref.get()
+    with FIRESTORE_READ_SECONDS.time():
+        doc = doc_ref.get()
 
     if not doc.exists:
+        DOCUMENTS_LOADED.inc(result="missing")
         raise FileNotFoundError(f"Document with ID '{doc_id}' not found.")
 
     data = doc.to_dict()
@@ -73,19 +123,26 @@ def load_from_firestore(db, doc_id: str) -> dict:
         # so we no longer need the proxy function.
         image_urls = data.get("storageImages", []) # Safely get the list, default to empty
         if not image_urls:
-            print(f"   WARNING: No images found in 'storageImages' for document {doc_id}.")
+            log.warning("No images found in 'storageImages'", extra={"doc_id": doc_id})
         # ----------------------------------------------------
 
-        return {
+        listing = {
             "property_id": str(data["id"]),
             "url": f"https://www.daft.ie{data['seoFriendlyPath']}",
             "listed_price": price,
             "address": data["title"],
             "latitude": data["location"]["coordinates"][1],
             "longitude": data["location"]["coordinates"][0],
-            "image_urls": image_urls # <-- Use the direct storage URLs
+            "image_urls": image_urls, # <-- Use the direct storage URLs
+            "area_m2": area_m2,
+            "ber": ber_rating,
+            "listing_fingerprint": listing_fingerprint(data),
         }
     except (KeyError, TypeError) as e:
+        DOCUMENTS_LOADED.inc(result="invalid")
         raise ValueError(f"Could not transform Firestore document '{doc_id}'. Invalid or missing key: {e}")
     except ValueError as e:
-        raise ValueError(f"Could not transform Firestore document '{doc_id}'. Invalid value: {e}")
\ No newline at end of file
+        DOCUMENTS_LOADED.inc(result="invalid")
+        raise ValueError(f"Could not transform Firestore document '{doc_id}'. Invalid value: {e}")
+    DOCUMENTS_LOADED.inc(result="ok")
+    return listing
\ No newline at end of file
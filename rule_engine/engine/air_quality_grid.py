@@ -0,0 +1,134 @@
+# engine/air_quality_grid.py
+"""
+Daily air-quality aggregates on a fixed lat/lon grid.
+
+Air quality varies little over a few kilometres, so instead of two Air Quality API
+calls per property a precompute job (`python main.py --precompute-air-quality`)
+fetches current conditions and the 7-day history once per grid cell centre and
+stores a compact aggregate: mean AQI plus a histogram of hourly categories.
+Property lookups bilinearly interpolate the four surrounding cell centres.
+"""
+import json
+import sqlite3
+import threading
+import time
+from math import floor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+Cell = Tuple[int, int]
+
+
+class AirQualityGrid:
+    """SQLite-backed table of per-cell aggregates, held in memory for lookups."""
+
+    def __init__(self, path: str, cell_deg: float, max_age_s: float):
+        if cell_deg <= 0:
+            raise ValueError("cell_deg must be positive")
+        self.path = path
+        self.cell_deg = float(cell_deg)
+        self.max_age_s = max_age_s
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS cells (
+                cell_row   INTEGER NOT NULL,
+                cell_col   INTEGER NOT NULL,
+                avg_aqi    REAL NOT NULL,
+                categories TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (cell_row, cell_col)
+            );
+        """)
+        self._check_cell_size()
+        self._cells: Dict[Cell, Tuple[float, List[list], float]] = {
+            (row, col): (avg_aqi, json.loads(categories), fetched_at)
+            for row, col, avg_aqi, categories, fetched_at in self._conn.execute(
+                "SELECT cell_row, cell_col, avg_aqi, categories, fetched_at FROM cells"
+            )
+        }
+
+    def _check_cell_size(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'cell_deg'").fetchone()
+        if row is None:
+            with self._conn:
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('cell_deg', ?)", (repr(self.cell_deg),))
+        elif float(row[0]) != self.cell_deg:
+            raise ValueError(
+                f"Air quality grid at '{self.path}' uses {row[0]} degree cells, not {self.cell_deg}. "
+                "Delete it to rebuild."
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+    # --- Cell maths ---
+
+    def centre(self, cell: Cell) -> Tuple[float, float]:
+        return (cell[0] + 0.5) * self.cell_deg, (cell[1] + 0.5) * self.cell_deg
+
+    def _corners(self, lat: float, lon: float):
+        """The four cells whose centres surround the point, with bilinear weights."""
+        y = lat / self.cell_deg - 0.5
+        x = lon / self.cell_deg - 0.5
+        row, col = floor(y), floor(x)
+        ty, tx = y - row, x - col
+        return [
+            ((row, col), (1 - ty) * (1 - tx)),
+            ((row, col + 1), (1 - ty) * tx),
+            ((row + 1, col), ty * (1 - tx)),
+            ((row + 1, col + 1), ty * tx),
+        ]
+
+    def cells_for(self, points: Iterable[Tuple[float, float]]) -> Set[Cell]:
+        """Every cell an interpolated lookup at these points can read."""
+        return {cell for lat, lon in points for cell, _ in self._corners(lat, lon)}
+
+    def is_fresh(self, cell: Cell, now: Optional[float] = None) -> bool:
+        entry = self._cells.get(cell)
+        return entry is not None and (now or time.time()) - entry[2] <= self.max_age_s
+
+    # --- Reading and writing ---
+
+    def store(self, aggregates: Iterable[Tuple[Cell, float, List[list]]]):
+        """Saves (cell, mean AQI, [[category, hours], ...]) rows fetched just now."""
+        now = time.time()
+        rows = [(cell[0], cell[1], avg_aqi, json.dumps(categories), now) for cell, avg_aqi, categories in aggregates]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cells (cell_row, cell_col, avg_aqi, categories, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            for row, col, avg_aqi, categories, fetched_at in rows:
+                self._cells[(row, col)] = (avg_aqi, json.loads(categories), fetched_at)
+
+    def lookup(self, lat: float, lon: float) -> Optional[Tuple[float, str]]:
+        """
+        Interpolated (mean AQI, dominant category) at a point, or None if none of the
+        surrounding cells has fresh data. Missing cells are left out and the remaining
+        weights renormalised.
+        """
+        now = time.time()
+        present = [(cell, w) for cell, w in self._corners(lat, lon) if self.is_fresh(cell, now)]
+        if not present:
+            return None
+        total = sum(w for _, w in present)
+        if total <= 0:
+            # Only zero-weight corners are fresh (the point lies on a missing centre's row or column).
+            present = [(cell, 1.0) for cell, _ in present]
+            total = float(len(present))
+
+        avg_aqi = 0.0
+        histogram: Dict[str, float] = {}
+        # Heaviest cell first, so category ties go to the closest cell's earliest hour.
+        for cell, weight in sorted(present, key=lambda cw: -cw[1]):
+            cell_aqi, categories, _ = self._cells[cell]
+            avg_aqi += weight / total * cell_aqi
+            hours = sum(n for _, n in categories) or 1
+            for category, n in categories:
+                histogram[category] = histogram.get(category, 0.0) + weight * n / hours
+        return avg_aqi, max(histogram, key=histogram.get)
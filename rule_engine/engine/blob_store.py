@@ -0,0 +1,183 @@
+# engine/blob_store.py
+"""
+Disk-backed, content-addressed store for downloaded listing photos.
+
+Blobs live under <root>/objects/<aa>/<bb>/<sha256>, so identical photos behind
+different URLs are stored once and no directory grows too large. An SQLite index
+maps each URL to its blob plus the ETag / Last-Modified validators the server sent,
+so a stale entry is revalidated with a conditional GET and a 304 costs no transfer.
+Total size is capped; the least recently used blobs are evicted first. Reads are
+memory-mapped, so a blob is paged in straight from the OS cache.
+"""
+import hashlib
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import NamedTuple, Optional
+
+
+class UrlEntry(NamedTuple):
+    digest: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+
+class BlobStore:
+    def __init__(self, root: str, max_bytes: int):
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be positive")
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+
+        self.hits = 0
+        self.revalidated = 0
+        self.downloaded_bytes = 0
+        self.bytes_saved = 0
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """The index, opened on first use so that importing a module-level store creates no files."""
+        if self._conn is None:
+            with self._open_lock:
+                if self._conn is None:
+                    self._conn = self._open()
+        return self._conn
+
+    def _open(self) -> sqlite3.Connection:
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), check_same_thread=False)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest      TEXT PRIMARY KEY,
+                size        INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_blobs_accessed ON blobs (accessed_at);
+            CREATE TABLE IF NOT EXISTS urls (
+                url           TEXT PRIMARY KEY,
+                digest        TEXT NOT NULL,
+                etag          TEXT,
+                last_modified TEXT,
+                fetched_at    REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_urls_digest ON urls (digest);
+        """)
+        self._total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        return conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @property
+    def total_bytes(self) -> int:
+        """Bytes stored; 0 until the store is first used (metrics must not open it)."""
+        return self._total_bytes
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest[2:4], digest)
+
+    # --- Lookups ---
+
+    def lookup(self, url: str) -> Optional[UrlEntry]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT u.digest, b.size, u.etag, u.last_modified, u.fetched_at "
+                "FROM urls u JOIN blobs b ON b.digest = u.digest WHERE u.url = ?",
+                (url,),
+            ).fetchone()
+        return UrlEntry(*row) if row else None
+
+    def read(self, url: str, entry: UrlEntry, revalidated: bool = False):
+        """
+        Memory-mapped contents of a blob (a read-only buffer), or None if the file has
+        gone missing. Counts the bytes as saved, as a cache hit or a 304 revalidation.
+        """
+        try:
+            with open(self._path(entry.digest), "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): # ValueError: empty file cannot be mapped
+            with self._lock, self._db:
+                self._forget_blob_locked(entry.digest)
+            return None
+
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("UPDATE blobs SET accessed_at = ? WHERE digest = ?", (now, entry.digest))
+            if revalidated:
+                self._db.execute("UPDATE urls SET fetched_at = ? WHERE url = ?", (now, url))
+                self.revalidated += 1
+            else:
+                self.hits += 1
+            self.bytes_saved += entry.size
+        return data
+
+    # --- Writes ---
+
+    def put(self, url: str, data: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None) -> str:
+        """Stores a freshly downloaded body for url; returns its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        now = time.time()
+        with self._lock:
+            known = self._db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if not known or not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        with self._lock, self._db:
+            inserted = self._db.execute(
+                "INSERT OR IGNORE INTO blobs (digest, size, accessed_at) VALUES (?, ?, ?)",
+                (digest, len(data), now),
+            ).rowcount
+            if inserted:
+                self._total_bytes += len(data)
+            else:
+                self._db.execute("UPDATE blobs SET accessed_at = ? WHERE digest = ?", (now, digest))
+            self._db.execute(
+                "INSERT OR REPLACE INTO urls (url, digest, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (url, digest, etag, last_modified, now),
+            )
+            self.downloaded_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict_locked(keep=digest)
+        return digest
+
+    def _forget_blob_locked(self, digest: str):
+        size = self._db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        self._db.execute("DELETE FROM urls WHERE digest = ?", (digest,))
+        if size:
+            self._total_bytes -= size[0]
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict_locked(self, keep: str):
+        # Evicting a blob that is currently mapped is safe: the mapping outlives the unlink.
+        for digest, in self._db.execute(
+            "SELECT digest FROM blobs WHERE digest != ? ORDER BY accessed_at", (keep,)
+        ).fetchall():
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._forget_blob_locked(digest)
+
+    def summary(self) -> str:
+        return (f"{self.hits} hits, {self.revalidated} revalidated (304), "
+                f"{self.downloaded_bytes / 2**20:.1f} MB downloaded, {self.bytes_saved / 2**20:.1f} MB saved, "
+                f"{self._total_bytes / 2**20:.1f} MB on disk")
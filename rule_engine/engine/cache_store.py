@@ -0,0 +1,237 @@
+# engine/cache_store.py
+"""
+Two-level key/value cache: an in-memory LRU in front of an optional SQLite file.
+
+Values are anything json.dumps accepts. Every entry remembers when it was stored,
+and the caller passes the maximum age it will accept on each get(), so one store
+can hold data with different lifetimes. Both levels are size-capped and evict the
+least recently used entries first; the on-disk level survives between runs.
+
+The SQLite file is opened on first use, not when the store is created. New entries
+and the access times of hits reach it in batches (every _FLUSH_ENTRIES changes or
+_FLUSH_INTERVAL_S seconds, on close and at exit) rather than one commit per lookup.
+Coroutines use get_async() and put_async(): memory hits are answered inline, and
+anything that touches the file runs in a worker thread.
+"""
+import asyncio
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# Trim the on-disk table in one go once it is this far over its cap, rather than
+# issuing a DELETE for every insert.
+_EVICTION_SLACK = 0.05
+
+# Pending writes (new entries plus access times) committed together.
+_FLUSH_ENTRIES = 256
+_FLUSH_INTERVAL_S = 5.0
+
+
+class CacheStore:
+    """
+    LRU + TTL cache. path=None keeps everything in memory.
+
+    get() returns None on a miss, so None itself cannot be cached.
+    """
+
+    def __init__(self, path: Optional[str], max_entries: int = 100_000, memory_entries: int = 10_000):
+        if max_entries < 1 or memory_entries < 1:
+            raise ValueError("Cache sizes must be positive")
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_entries = min(memory_entries, max_entries)
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._closed = False
+        self._disk_entries = 0
+        # Not yet on disk: new entries, and the latest access time of hits.
+        self._unwritten: Dict[str, tuple] = {}
+        self._touched: Dict[str, float] = {}
+        self._flushed_at = time.monotonic()
+        if path is not None:
+            atexit.register(self.flush)
+
+        self.hits = 0
+        self.misses = 0
+
+    def _connection_locked(self) -> Optional[sqlite3.Connection]:
+        if self._conn is None and self.path is not None and not self._closed:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key         TEXT PRIMARY KEY,
+                    value       TEXT NOT NULL,
+                    stored_at   REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed_at);
+            """)
+            self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return self._conn
+
+    def __len__(self) -> int:
+        with self._lock:
+            if self.path is None:
+                return len(self._memory)
+            self._flush_locked()
+            return self._disk_entries
+
+    def flush(self):
+        """Writes pending entries and access times to disk."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self._closed = True
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: str, max_age_s: Optional[float] = None) -> Any:
+        """Return the cached value, or None if absent or older than max_age_s."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory_entry_locked(key)
+            conn = self._connection_locked() if entry is None else None
+            if conn is not None:
+                row = conn.execute("SELECT value, stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+                    self._remember_locked(key, entry)
+            value = self._count_locked(key, entry, max_age_s, now)
+            self._maybe_flush_locked()
+            return value
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._put_locked(key, value)
+            self._maybe_flush_locked()
+
+    async def get_async(self, key: str, max_age_s: Optional[float] = None) -> Any:
+        """get() for coroutines: a memory hit is answered inline, a disk read runs in a thread."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory_entry_locked(key)
+            if entry is not None or self.path is None:
+                return self._count_locked(key, entry, max_age_s, now)
+        return await asyncio.to_thread(self.get, key, max_age_s)
+
+    async def put_async(self, key: str, value: Any):
+        """put() for coroutines: the entry is queued inline, a due flush runs in a thread."""
+        with self._lock:
+            self._put_locked(key, value)
+            due = self._flush_due_locked()
+        if due:
+            await asyncio.to_thread(self.flush)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._unwritten.pop(key, None)
+            self._touched.pop(key, None)
+            conn = self._connection_locked()
+            if conn is not None:
+                with conn:
+                    self._disk_entries -= conn.execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount
+
+    def clear(self) -> int:
+        """Drops every entry; returns how many were stored on disk (or in memory without a file)."""
+        with self._lock:
+            removed = len(self._memory)
+            self._memory.clear()
+            self._touched.clear()
+            conn = self._connection_locked()
+            if conn is not None:
+                removed = len(self._unwritten)
+                with conn:
+                    removed += conn.execute("DELETE FROM entries").rowcount
+                self._disk_entries = 0
+            self._unwritten.clear()
+            return removed
+
+    def _memory_entry_locked(self, key: str) -> Optional[tuple]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            return entry
+        entry = self._unwritten.get(key)
+        if entry is not None:
+            self._remember_locked(key, entry)
+        return entry
+
+    def _count_locked(self, key: str, entry: Optional[tuple], max_age_s: Optional[float], now: float) -> Any:
+        if entry is None or (max_age_s is not None and now - entry[1] > max_age_s):
+            self.misses += 1
+            return None
+        if self.path is not None and key not in self._unwritten:
+            self._touched[key] = now
+        self.hits += 1
+        return entry[0]
+
+    def _put_locked(self, key: str, value: Any):
+        entry = (value, time.time())
+        self._remember_locked(key, entry)
+        if self.path is not None:
+            self._unwritten[key] = entry
+            self._touched.pop(key, None)
+
+    def _flush_due_locked(self) -> bool:
+        pending = len(self._unwritten) + len(self._touched)
+        return pending >= _FLUSH_ENTRIES or (
+            pending > 0 and time.monotonic() - self._flushed_at >= _FLUSH_INTERVAL_S)
+
+    def _maybe_flush_locked(self):
+        if self._flush_due_locked():
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._flushed_at = time.monotonic()
+        if not (self._unwritten or self._touched):
+            return
+        conn = self._connection_locked()
+        if conn is None:
+            return
+        with conn:
+            for key, (value, stored_at) in self._unwritten.items():
+                encoded = json.dumps(value)
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO entries (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, encoded, stored_at, stored_at),
+                ).rowcount
+                if inserted:
+                    self._disk_entries += 1
+                else:
+                    conn.execute(
+                        "UPDATE entries SET value = ?, stored_at = ?, accessed_at = ? WHERE key = ?",
+                        (encoded, stored_at, stored_at, key),
+                    )
+            conn.executemany(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()],
+            )
+            if self._disk_entries > self.max_entries * (1 + _EVICTION_SLACK):
+                self._evict_locked()
+        self._unwritten.clear()
+        self._touched.clear()
+
+    def _remember_locked(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        limit = self.memory_entries if self.path is not None else self.max_entries
+        while len(self._memory) > limit:
+            self._memory.popitem(last=False)
+
+    def _evict_locked(self):
+        excess = self._disk_entries - self.max_entries
+        self._conn.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)",
+            (excess,),
+        )
+        self._disk_entries = self.max_entries
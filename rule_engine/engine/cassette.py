@@ -0,0 +1,514 @@
+# engine/cassette.py
+"""
+Record / replay of the external calls (Places, Air Quality, GetHousePrice, listing
+photos, Gemini), so whole runs can be benchmarked and profiled with no network.
+
+In "record" mode the HTTP sessions and the Gemini calls are wrapped: every exchange
+is made for real and appended to <root>/exchanges.jsonl (status, a few response
+headers, latency), with bodies stored once under <root>/bodies/<sha256>. In "replay"
+mode nothing leaves the machine: each request is answered from the cassette after
+sleeping its recorded latency times `latency_scale` (0 = as fast as possible).
+
+Requests are matched on method, URL, query parameters and JSON body. API keys are
+never part of the match nor written to disk, and top-level body fields listed in
+`ignore_fields` (e.g. a time window that moves with the clock) are left out of the
+match. Repeated requests for the same key get the recorded exchanges in order (so a
+recorded 429 followed by a 200 replays as a retry), the last one repeating once they
+run out. A request missing from the cassette is answered with a 404 (HTTP) or an
+error with code 404 (Gemini), which the callers treat as a non-retryable failure.
+
+Recording always fetches whole bodies (conditional request headers are dropped), so
+a replay can answer whatever the local image store holds at the time: a replayed
+request carrying a matching If-None-Match / If-Modified-Since gets a 304.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import aiohttp
+import requests
+from multidict import CIMultiDict, CIMultiDictProxy
+from requests.structures import CaseInsensitiveDict
+from yarl import URL
+
+log = logging.getLogger(__name__)
+
+MODES = ("off", "record", "replay")
+
+# Query parameters and request headers that carry credentials.
+SECRET_PARAMS = {"key"}
+CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since")
+# Response headers worth keeping: what the callers read, and the validators for 304s.
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Retry-After")
+
+
+class Exchange(NamedTuple):
+    status: Optional[int]
+    headers: Dict[str, str]
+    body: Optional[str]     # sha256 of the body under <root>/bodies, None if empty
+    error: Optional[str]    # "timeout" or "connection" for transport failures, else the SDK error
+    latency_s: float
+
+
+class ReplayedError(Exception):
+    """A recorded (or missing) Gemini failure; carries the HTTP status as `.code` like google.api_core errors."""
+
+    def __init__(self, message: str, code: Optional[int]):
+        super().__init__(message)
+        self.code = code
+
+
+class ReplayedText(NamedTuple):
+    """Stands in for a Gemini response: the callers only read `.text`."""
+    text: str
+
+
+def _strip_secrets(url: str) -> str:
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class Cassette:
+    def __init__(self, root: str, mode: str = "off", latency_scale: float = 1.0, ignore_fields=()):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, got {mode!r}")
+        if latency_scale < 0:
+            raise ValueError("latency_scale must not be negative")
+        self.root = root
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.ignore_fields = set(ignore_fields)
+        self._lock = threading.Lock()
+        self._exchanges: Dict[str, List[Exchange]] = {}
+        self._cursors: Dict[str, int] = {}
+
+        self.recorded = 0
+        self.replayed = 0
+        self.missed = 0
+
+        if mode == "record":
+            os.makedirs(os.path.join(root, "bodies"), exist_ok=True)
+        elif mode == "replay":
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    # --- Matching ---
+
+    def key(self, method: str, url: str, params=None, json_body=None, data=None) -> str:
+        if isinstance(params, dict):
+            params = params.items()
+        query = sorted((str(k), str(v)) for k, v in (params or ()) if k not in SECRET_PARAMS)
+        if isinstance(json_body, dict):
+            json_body = {k: v for k, v in json_body.items() if k not in self.ignore_fields}
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        payload = [method.upper(), _strip_secrets(url), query, json_body,
+                   hashlib.sha256(data).hexdigest() if isinstance(data, bytes) else None]
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    # --- Storage ---
+
+    def _load(self):
+        path = os.path.join(self.root, "exchanges.jsonl")
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # a line cut short by a crash while recording
+                    exchange = Exchange(record["status"], record["headers"], record["body"],
+                                        record["error"], record["latency_s"])
+                    self._exchanges.setdefault(record["key"], []).append(exchange)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No cassette to replay at '{path}'; record one with CASSETTE_MODE=record first.")
+        log.info("Cassette loaded for replay", extra={
+            "path": self.root, "requests": len(self._exchanges),
+            "exchanges": sum(len(v) for v in self._exchanges.values())})
+
+    def _body_path(self, digest: str) -> str:
+        return os.path.join(self.root, "bodies", digest)
+
+    def record(self, key: str, method: str, url: str, status: Optional[int] = None, headers=None,
+               body: bytes = b"", error: Optional[str] = None, latency_s: float = 0.0):
+        digest = None
+        if body:
+            digest = hashlib.sha256(body).hexdigest()
+            path = self._body_path(digest)
+            if not os.path.exists(path):
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)
+        kept = {name: headers[name] for name in KEPT_HEADERS if headers and headers.get(name) is not None}
+        line = json.dumps({
+            "key": key, "method": method, "url": _strip_secrets(url), "status": status, "headers": kept,
+            "body": digest, "error": error, "latency_s": round(latency_s, 6),
+        })
+        with self._lock:
+            with open(os.path.join(self.root, "exchanges.jsonl"), "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.recorded += 1
+
+    def next(self, key: str, url: str) -> Optional[Exchange]:
+        """The exchange to replay for this request, or None if it was never recorded."""
+        with self._lock:
+            exchanges = self._exchanges.get(key)
+            if not exchanges:
+                self.missed += 1
+            else:
+                cursor = self._cursors.get(key, 0)
+                self._cursors[key] = cursor + 1
+                self.replayed += 1
+                return exchanges[min(cursor, len(exchanges) - 1)]
+        log.warning("Request not in cassette, answering 404", extra={"url": _strip_secrets(url)})
+        return None
+
+    def body(self, exchange: Exchange) -> bytes:
+        if exchange.body is None:
+            return b""
+        with open(self._body_path(exchange.body), "rb") as f:
+            return f.read()
+
+    def _delay(self, exchange: Optional[Exchange]) -> float:
+        return exchange.latency_s * self.latency_scale if exchange is not None else 0.0
+
+    def _answer(self, exchange: Optional[Exchange], request_headers):
+        """(status, headers, body) to serve, applying conditional request headers."""
+        if exchange is None:
+            return 404, {}, b"not recorded in cassette"
+        headers = request_headers or {}
+        if exchange.status == 200 and any(
+                exchange.headers.get(name) and headers.get(header) == exchange.headers[name]
+                for header, name in (("If-None-Match", "ETag"), ("If-Modified-Since", "Last-Modified"))):
+            return 304, exchange.headers, b""
+        return exchange.status, exchange.headers, self.body(exchange)
+
+    # --- Session factories ---
+
+    def sync_http(self, http=requests):
+        """What blocking callers should call .request()/.get() on: `http` itself when off."""
+        if self.mode == "record":
+            return RecordingSession(self, http)
+        if self.mode == "replay":
+            return ReplaySession(self)
+        return http
+
+    def sync_session(self):
+        """A requests.Session (usable as a context manager), wrapped for record / replay."""
+        if self.mode == "replay":
+            return ReplaySession(self)
+        return self.sync_http(requests.Session())
+
+    def client_session(self, connection_limit: int = 100):
+        """An aiohttp.ClientSession (usable with `async with`), wrapped for record / replay."""
+        if self.mode == "replay":
+            return ReplayClientSession(self)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connection_limit))
+        return RecordingClientSession(self, session) if self.mode == "record" else session
+
+    # --- SDK calls ---
+
+    def wrap_call(self, key: str, fn):
+        """fn(*args, **kwargs) recorded or replayed under `key`; its result must have `.text`."""
+        if self.mode == "off":
+            return fn
+        url = getattr(fn, "__qualname__", "call")
+
+        if self.mode == "record":
+            @functools.wraps(fn)
+            def recorded(*args, **kwargs):
+                started = time.monotonic()
+                try:
+                    result = fn(*args, **kwargs)
+                    text = result.text
+                except Exception as e:
+                    self.record(key, "CALL", url, getattr(e, "code", None), error=str(e) or type(e).__name__,
+                                latency_s=time.monotonic() - started)
+                    raise
+                self.record(key, "CALL", url, 200, body=text.encode("utf-8"), latency_s=time.monotonic() - started)
+                return result
+            return recorded
+
+        @functools.wraps(fn)
+        def replayed(*args, **kwargs):
+            exchange = self.next(key, url)
+            time.sleep(self._delay(exchange))
+            return self._replayed_result(exchange)
+        return replayed
+
+    def wrap_call_async(self, key: str, fn):
+        if self.mode == "off":
+            return fn
+        url = getattr(fn, "__qualname__", "call")
+
+        if self.mode == "record":
+            @functools.wraps(fn)
+            async def recorded(*args, **kwargs):
+                started = time.monotonic()
+                try:
+                    result = await fn(*args, **kwargs)
+                    text = result.text
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.record(key, "CALL", url, getattr(e, "code", None), error=str(e) or type(e).__name__,
+                                latency_s=time.monotonic() - started)
+                    raise
+                self.record(key, "CALL", url, 200, body=text.encode("utf-8"), latency_s=time.monotonic() - started)
+                return result
+            return recorded
+
+        @functools.wraps(fn)
+        async def replayed(*args, **kwargs):
+            exchange = self.next(key, url)
+            await asyncio.sleep(self._delay(exchange))
+            return self._replayed_result(exchange)
+        return replayed
+
+    def _replayed_result(self, exchange: Optional[Exchange]) -> ReplayedText:
+        if exchange is None:
+            raise ReplayedError("not recorded in cassette", 404)
+        if exchange.error is not None:
+            raise ReplayedError(exchange.error, exchange.status)
+        return ReplayedText(self.body(exchange).decode("utf-8"))
+
+
+def _request_key(cassette: Cassette, method: str, url: str, kwargs) -> str:
+    return cassette.key(method, url, kwargs.get("params"), kwargs.get("json"), kwargs.get("data"))
+
+def _without_conditional(headers):
+    if not headers:
+        return headers
+    return {k: v for k, v in headers.items() if k not in CONDITIONAL_HEADERS}
+
+
+# --- Blocking (requests) ---
+
+class RecordingSession:
+    """Proxies a requests.Session (or the requests module), appending each exchange to the cassette."""
+
+    def __init__(self, cassette: Cassette, http):
+        self.cassette = cassette
+        self.http = http
+
+    @property
+    def headers(self):
+        return self.http.headers
+
+    def request(self, method: str, url: str, **kwargs):
+        key = _request_key(self.cassette, method, url, kwargs)
+        kwargs["headers"] = _without_conditional(kwargs.get("headers"))
+        started = time.monotonic()
+        try:
+            response = self.http.request(method, url, **kwargs)
+            body = response.content # read it all, even for stream=True
+        except requests.exceptions.Timeout:
+            self.cassette.record(key, method, url, error="timeout", latency_s=time.monotonic() - started)
+            raise
+        except requests.exceptions.ConnectionError:
+            self.cassette.record(key, method, url, error="connection", latency_s=time.monotonic() - started)
+            raise
+        self.cassette.record(key, method, url, response.status_code, response.headers, body,
+                             latency_s=time.monotonic() - started)
+        return response
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        if isinstance(self.http, requests.Session):
+            self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplaySession:
+    """Answers requests.Session-style calls from the cassette, with recorded latencies."""
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self.headers = CaseInsensitiveDict()
+
+    def request(self, method: str, url: str, timeout=None, **kwargs):
+        exchange = self.cassette.next(_request_key(self.cassette, method, url, kwargs), url)
+        delay = self.cassette._delay(exchange)
+        timeout_s = timeout[-1] if isinstance(timeout, tuple) else timeout
+        if timeout_s is not None and delay > timeout_s:
+            time.sleep(timeout_s)
+            raise requests.exceptions.ReadTimeout(f"replayed latency {delay:.2f}s exceeds timeout {timeout_s}s")
+        time.sleep(delay)
+        if exchange is not None and exchange.error == "timeout":
+            raise requests.exceptions.ReadTimeout("replayed timeout")
+        if exchange is not None and exchange.error is not None:
+            raise requests.exceptions.ConnectionError("replayed connection failure")
+        status, headers, body = self.cassette._answer(exchange, CaseInsensitiveDict(kwargs.get("headers") or {}))
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response._content_consumed = True
+        response.encoding = "utf-8"
+        response.url = url
+        return response
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+# --- asyncio (aiohttp) ---
+
+class _Content:
+    def __init__(self, body: bytes):
+        self._body = body
+
+    async def iter_chunked(self, n: int):
+        for i in range(0, len(self._body), n):
+            yield self._body[i:i + n]
+
+    async def read(self) -> bytes:
+        return self._body
+
+
+class CassetteResponse:
+    """The parts of aiohttp.ClientResponse the callers use, over a body already in memory."""
+
+    def __init__(self, method: str, url: str, status: int, headers, body: bytes):
+        self.method = method
+        self.url = URL(url)
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.content = _Content(body)
+        self._body = body
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = "utf-8") -> str:
+        return self._body.decode(encoding, errors="replace")
+
+    async def json(self, content_type=None):
+        return json.loads(self._body)
+
+    def raise_for_status(self):
+        if not self.ok:
+            request_info = aiohttp.RequestInfo(self.url, self.method, CIMultiDictProxy(CIMultiDict()), self.url)
+            raise aiohttp.ClientResponseError(request_info, (), status=self.status, message="replayed",
+                                              headers=self.headers)
+
+    def release(self):
+        pass
+
+
+class _RequestContext:
+    """What session.request() returns: usable with `async with` or awaited directly."""
+
+    def __init__(self, coro):
+        self._coro = coro
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        return await self._coro
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class _ClientSessionBase:
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs):
+        return _RequestContext(self._request(method, url, **kwargs))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class RecordingClientSession(_ClientSessionBase):
+    """Proxies an aiohttp.ClientSession, appending each exchange to the cassette."""
+
+    def __init__(self, cassette: Cassette, session: aiohttp.ClientSession):
+        self.cassette = cassette
+        self.session = session
+
+    async def _request(self, method: str, url: str, **kwargs) -> CassetteResponse:
+        key = _request_key(self.cassette, method, url, kwargs)
+        kwargs["headers"] = _without_conditional(kwargs.get("headers"))
+        started = time.monotonic()
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                body = await response.read()
+                status, headers = response.status, response.headers
+        except asyncio.TimeoutError:
+            self.cassette.record(key, method, url, error="timeout", latency_s=time.monotonic() - started)
+            raise
+        except aiohttp.ClientError:
+            self.cassette.record(key, method, url, error="connection", latency_s=time.monotonic() - started)
+            raise
+        self.cassette.record(key, method, url, status, headers, body, latency_s=time.monotonic() - started)
+        return CassetteResponse(method, url, status, {k: v for k, v in headers.items()}, body)
+
+    async def close(self):
+        await self.session.close()
+
+
+class ReplayClientSession(_ClientSessionBase):
+    """Answers aiohttp-style calls from the cassette, with recorded latencies."""
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+
+    async def _request(self, method: str, url: str, timeout=None, **kwargs) -> CassetteResponse:
+        exchange = self.cassette.next(_request_key(self.cassette, method, url, kwargs), url)
+        delay = self.cassette._delay(exchange)
+        timeout_s = getattr(timeout, "total", None)
+        if timeout_s is not None and delay > timeout_s:
+            await asyncio.sleep(timeout_s)
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(delay)
+        if exchange is not None and exchange.error == "timeout":
+            raise asyncio.TimeoutError()
+        if exchange is not None and exchange.error is not None:
+            raise aiohttp.ClientConnectionError("replayed connection failure")
+        status, headers, body = self.cassette._answer(exchange, CIMultiDict(kwargs.get("headers") or {}))
+        return CassetteResponse(method, url, status, headers, body)
+
+    async def close(self):
+        pass
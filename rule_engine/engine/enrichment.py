@@ -1,7 +1,19 @@
+import asyncio
+import logging
+
 from .models import PropertyListing
 from . import external_services
+from . import stage_results
 from config import MAPS_API_KEY
 from .investment_calculator import InvestmentCalculator # <-- Import the new calculator
+from telemetry import metrics
+
+log = logging.getLogger(__name__)
+
+PROPERTIES_ENRICHED = metrics.counter(
+    "rule_engine_properties_enriched_total", "Properties taken through the investment analysis.")
+DEGRADED_LOOKUPS = metrics.counter(
+    "rule_engine_degraded_lookups_total", "Properties scored with a service's fallback value.", ["service"])
 
 class DataEnricher:
     """Enriches raw property data with calculated metrics."""
@@ -9,50 +21,189 @@ class DataEnricher:
     def __init__(self):
         # Instantiate the calculator so we can use it
         self.investment_calculator = InvestmentCalculator()
-        print("Data Enricher Initialized (with Investment Calculator).")
+        log.debug("Data enricher initialized (with investment calculator)")
 
     def enrich_property(self, property_data: dict) -> dict:
         """Processes a single property to add all calculated scores and details."""
+        enriched_data = self.enrich_lookups(property_data)
+        enriched_data = self.fetch_images(enriched_data)
+        enriched_data = self.analyse_renovation(enriched_data)
+        return self.calculate_investment(enriched_data)
+
+    # --- Individual stages (also driven one by one by the batch pipeline) ---
+
+    def enrich_lookups(self, property_data: dict) -> dict:
+        """Stage 1: validation plus the cheap HTTP lookups (amenities, market price, air quality)."""
+        prop, enriched_data = self._validate(property_data)
+        lat, lon = prop.latitude, prop.longitude
+
+        # --- Standard Enrichment ---
+        amenity_result = external_services.get_amenity_details(lat, lon, MAPS_API_KEY)
+        market_average = external_services.get_market_average(lat, lon)
+        air_quality = external_services.get_air_quality_score(lat, lon, MAPS_API_KEY)
+        return self._apply_lookups(prop, enriched_data, amenity_result, market_average, air_quality)
+
+    def _validate(self, property_data: dict):
         prop = PropertyListing.model_validate(property_data)
         enriched_data = prop.model_dump(mode='json')
         enriched_data['area_m2'] = property_data.get('area_m2')
         enriched_data['ber'] = property_data.get('ber')
-        lat, lon = prop.latitude, prop.longitude
+        enriched_data['listing_fingerprint'] = property_data.get('listing_fingerprint')
 
-        print(f"Enriching property ID: {prop.property_id} ({prop.address})...")
-        
-        # --- Standard Enrichment ---
-        amenity_result = external_services.get_amenity_details(lat, lon, MAPS_API_KEY)
+        log.info("Enriching property", extra={"property_id": prop.property_id, "address": prop.address})
+        return prop, enriched_data
+
+    def _apply_lookups(self, prop, enriched_data: dict, amenity_result, market_average, air_quality) -> dict:
+        self._apply_amenity(enriched_data, amenity_result)
+        self._apply_market_average(prop, enriched_data, market_average)
+        return self._apply_air_quality(enriched_data, air_quality)
+
+    def _apply_amenity(self, enriched_data: dict, amenity_result) -> dict:
         enriched_data['amenity_details'] = amenity_result.model_dump(mode='json')
         enriched_data['amenity_score'] = amenity_result.score
-        
-        market_average = external_services.get_market_average(lat, lon)
-        enriched_data['market_average_price'] = market_average # Store this for later use
+        return self._stamp(enriched_data, "amenity", amenity_result.degraded)
 
+    def _apply_market_average(self, prop, enriched_data: dict, market_average) -> dict:
+        market_average, market_degraded = market_average
+        enriched_data['market_average_price'] = market_average # Store this for later use
         enriched_data['price_attractiveness_score'] = self._calculate_price_attractiveness(
             prop.listed_price, market_average
         )
-        
-        # enriched_data['air_quality_score'] = external_services.get_air_quality_score(lat, lon, MAPS_API_KEY)
-        air_quality_score, air_quality_index, air_quality_category = external_services.get_air_quality_score(lat, lon, MAPS_API_KEY)
+        return self._stamp(enriched_data, "market_average", market_degraded)
+
+    def _apply_air_quality(self, enriched_data: dict, air_quality) -> dict:
+        air_quality_score, air_quality_index, air_quality_category, air_quality_degraded = air_quality
         enriched_data['air_quality_score'] = air_quality_score
         enriched_data['air_quality_index'] = air_quality_index
         enriched_data['air_quality_category'] = air_quality_category
-        
-        renovation_details = external_services.get_renovation_cost(
-            enriched_data['image_urls']
-        )
+        return self._stamp(enriched_data, "air_quality", air_quality_degraded)
+
+    def _apply_renovation(self, enriched_data: dict, renovation_details) -> dict:
         enriched_data['renovation_details'] = renovation_details.model_dump(mode='json')
+        return self._stamp(enriched_data, "renovation", renovation_details.degraded)
+
+    def _stamp(self, enriched_data: dict, stage: str, degraded: bool) -> dict:
+        """Records the stage's version, time and input fingerprint (see engine/stage_results.py)."""
+        stage_results.stamp(enriched_data, stage, degraded=degraded)
+        # Services whose fallback (not a real answer) went into this property's scores.
+        enriched_data['degraded_services'] = stage_results.degraded_services(enriched_data)
+        if degraded:
+            DEGRADED_LOOKUPS.inc(service=stage_results.STAGE_SERVICES[stage])
+        return enriched_data
+
+    def fetch_images(self, enriched_data: dict) -> dict:
+        """Stage 2: download listing images. Held under a private key until Gemini has run."""
+        enriched_data['_image_parts'] = external_services.download_images(enriched_data['image_urls'])
+        return enriched_data
+
+    def analyse_renovation(self, enriched_data: dict) -> dict:
+        """Stage 3: Gemini renovation estimate from the downloaded images."""
+        image_parts = enriched_data.pop('_image_parts', None)
+        if image_parts is None:
+            image_parts = external_services.download_images(enriched_data['image_urls'])
+        renovation_details = external_services.analyse_renovation_images(image_parts)
+        return self._apply_renovation(enriched_data, renovation_details)
+
+    # --- Async variants: a property's independent lookups run concurrently ---
+
+    async def enrich_property_async(self, session, property_data: dict) -> dict:
+        """Same result as enrich_property; wall time is roughly that of the slowest dependency."""
+        prop, enriched_data = self._validate(property_data)
+        lookups, image_parts = await asyncio.gather(
+            self._lookups_async(session, prop),
+            external_services.download_images_async(session, enriched_data['image_urls']),
+            return_exceptions=True,
+        )
+        if isinstance(lookups, BaseException) or isinstance(image_parts, BaseException):
+            if not isinstance(image_parts, BaseException):
+                external_services.release_image_parts(image_parts)
+            raise lookups if isinstance(lookups, BaseException) else image_parts
+
+        enriched_data = self._apply_lookups(prop, enriched_data, *lookups)
+        enriched_data['_image_parts'] = image_parts
+        enriched_data = await self.analyse_renovation_async(enriched_data)
+        return self.calculate_investment(enriched_data)
+
+    async def enrich_lookups_async(self, session, property_data: dict) -> dict:
+        """Stage 1: amenities, market price and air quality, all in flight at once."""
+        prop, enriched_data = self._validate(property_data)
+        return self._apply_lookups(prop, enriched_data, *await self._lookups_async(session, prop))
+
+    async def _lookups_async(self, session, prop):
+        lat, lon = prop.latitude, prop.longitude
+        return await asyncio.gather(
+            external_services.get_amenity_details_async(session, lat, lon, MAPS_API_KEY),
+            external_services.get_market_average_async(session, lat, lon),
+            external_services.get_air_quality_score_async(session, lat, lon, MAPS_API_KEY),
+        )
+
+    async def fetch_images_async(self, session, enriched_data: dict) -> dict:
+        """Stage 2: concurrent, downscaled image downloads within the shared image memory budget."""
+        enriched_data['_image_parts'] = await external_services.download_images_async(session, enriched_data['image_urls'])
+        return enriched_data
+
+    async def analyse_renovation_async(self, enriched_data: dict) -> dict:
+        """Stage 3; frees the property's image bytes from the budget once Gemini has answered."""
+        image_parts = enriched_data.pop('_image_parts', None) or []
+        try:
+            renovation_details = await external_services.analyse_renovation_images_async(image_parts)
+        finally:
+            external_services.release_image_parts(image_parts)
+        return self._apply_renovation(enriched_data, renovation_details)
+
+    async def refresh_property_async(self, session, property_data: dict, stored: dict):
+        """
+        Re-enriches a scored property, recomputing only its stale stages (see
+        engine/stage_results.py) and carrying the others over from `stored`, its
+        validity_data document. Returns None when every stage is still fresh.
+        """
+        # Fingerprints are compared on validated fields, as stamped (URLs normalized and so on).
+        current = PropertyListing.model_validate(property_data).model_dump(mode='json')
+        stale = stage_results.stale_stages(stored, current)
+        if not stale:
+            return None
+        prop, enriched_data = self._validate(property_data)
+        stage_results.carry_over(enriched_data, stored, [s for s in stage_results.STAGES if s not in stale])
+        if "market_average" not in stale: # the listed price may still have changed
+            enriched_data['price_attractiveness_score'] = self._calculate_price_attractiveness(
+                prop.listed_price, enriched_data['market_average_price']
+            )
+        lat, lon = prop.latitude, prop.longitude
+
+        lookups = {}
+        if "amenity" in stale:
+            lookups["amenity"] = external_services.get_amenity_details_async(session, lat, lon, MAPS_API_KEY)
+        if "market_average" in stale:
+            lookups["market_average"] = external_services.get_market_average_async(session, lat, lon)
+        if "air_quality" in stale:
+            lookups["air_quality"] = external_services.get_air_quality_score_async(session, lat, lon, MAPS_API_KEY)
+        results = dict(zip(lookups, await asyncio.gather(*lookups.values())))
+        if "amenity" in results:
+            self._apply_amenity(enriched_data, results["amenity"])
+        if "market_average" in results:
+            self._apply_market_average(prop, enriched_data, results["market_average"])
+        if "air_quality" in results:
+            self._apply_air_quality(enriched_data, results["air_quality"])
+
+        if "renovation" in stale:
+            enriched_data = await self.fetch_images_async(session, enriched_data)
+            enriched_data = await self.analyse_renovation_async(enriched_data)
+        enriched_data['degraded_services'] = stage_results.degraded_services(enriched_data)
+        log.debug("Stale stages recomputed", extra={"property_id": prop.property_id, "stages": stale})
+        # Cheap and dependent on the other stages, so always recomputed.
+        return self.calculate_investment(enriched_data)
 
-        # --- NEW: Investment Analysis Step ---
-        print("   -> Running Investment Viability Analysis...")
+    def calculate_investment(self, enriched_data: dict) -> dict:
+        """Stage 4: investment viability analysis (CPU only)."""
         investment_analysis = self.investment_calculator.calculate(
-            listed_price=prop.listed_price,
+            listed_price=enriched_data['listed_price'],
             renovation_details=enriched_data['renovation_details'],
-            market_average_price=market_average
+            market_average_price=enriched_data['market_average_price']
         )
         enriched_data['investment_analysis'] = investment_analysis.model_dump(mode='json')
-        print("   -> Investment Analysis Complete.")
+        stage_results.stamp(enriched_data, "investment")
+        PROPERTIES_ENRICHED.inc()
+        log.debug("Investment analysis complete", extra={"property_id": enriched_data.get('property_id')})
 
         return enriched_data
 
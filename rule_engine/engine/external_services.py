@@ -1,7 +1,19 @@
+import asyncio
+import hashlib
 import requests
+import aiohttp
 import json
+import logging
+import numpy as np
 import re
-from typing import List
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from math import floor
+from typing import List, Optional, Tuple
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 # New imports for the Gemini service
@@ -10,16 +22,117 @@ from geopy.distance import great_circle
 
 # Our existing models and config
 from .models import RenovationItem, RenovationCost, Amenity, AmenityResult
+from .cache_store import CacheStore
+from .http_cache import ResponseCache
+from .air_quality_grid import AirQualityGrid
+from .image_processing import ByteBudget, prepare_image
+from .blob_store import BlobStore
+from .service_client import ServiceClient, ServiceError
+from .cassette import Cassette
+from . import market_price
 from config import GEMINI_API_KEY, DAFT_COOKIE # <-- Import the new key
+from config import AMENITY_CACHE_PATH, AMENITY_CACHE_TTL_S, AMENITY_CACHE_MAX_ENTRIES, AMENITY_CELL_DEG
+from config import MARKET_PRICE_SOURCE, HOUSE_PRICE_DATA_PATH
+from config import AIR_QUALITY_GRID_PATH, AIR_QUALITY_CELL_DEG, AIR_QUALITY_GRID_MAX_AGE_S
+from config import RENOVATION_CACHE_PATH, RENOVATION_CACHE_TTL_S, RENOVATION_CACHE_MAX_ENTRIES, RENOVATION_CACHE_VERSION
+from config import IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_MEMORY_BUDGET_BYTES, IMAGE_MAX_DOWNLOAD_BYTES, IMAGE_RESERVE_BYTES
+from config import IMAGE_STORE_PATH, IMAGE_STORE_MAX_BYTES, IMAGE_STORE_MAX_AGE_S
+from config import HTTP_CACHE_PATH, HTTP_CACHE_TTL_S, HTTP_CACHE_MAX_ENTRIES, HTTP_CACHE_BYPASS
+from config import SERVICE_RATE_PER_MIN, SERVICE_MAX_ATTEMPTS, SERVICE_BACKOFF_BASE_S, SERVICE_BACKOFF_MAX_S
+from config import SERVICE_TIMEOUT_S, SERVICE_DEADLINE_S, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_S, HEDGE_MAX_FRACTION
+from config import CASSETTE_MODE, CASSETTE_PATH, CASSETTE_LATENCY_SCALE
+from telemetry import metrics, Sample
+
+log = logging.getLogger(__name__)
 
 # This is more efficient than creating a client on every call
 genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025')
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-09-2025'
+gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 
 # --- NEW: Cloud Function Configuration ---
 GET_HOUSE_PRICE_URL = "https://gethouseprice-gp7bcz6nya-uc.a.run.app/"
 DEFAULT_MARKET_PRICE = 300000.0
 
+PLACES_NEARBY_URL = "https://places.googleapis.com/v1/places:searchNearby"
+AIR_QUALITY_CURRENT_URL = "https://airquality.googleapis.com/v1/currentConditions:lookup"
+AIR_QUALITY_HISTORY_URL = "https://airquality.googleapis.com/v1/history:lookup"
+
+AMENITY_TYPES = ['supermarket', 'school', 'bus_station', 'train_station', 'park', 'hospital', 'pharmacy']
+# Define a max search radius, which will also be our scoring boundary
+MAX_RADIUS_KM = 5.0
+MAX_IMAGES = 10
+
+# Record / replay of every external exchange (CASSETTE_MODE). The history lookup's time
+# window moves with the clock, so it is not part of the request match.
+cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_LATENCY_SCALE, ignore_fields=("period",))
+
+def http_session(connection_limit: int = 100) -> aiohttp.ClientSession:
+    """The aiohttp session every async lookup should use (wrapped when recording or replaying)."""
+    return cassette.client_session(connection_limit)
+
+# Decoded responses of the Places, GetHousePrice and Air Quality calls, shared across runs.
+response_cache = ResponseCache(HTTP_CACHE_PATH, HTTP_CACHE_TTL_S, HTTP_CACHE_MAX_ENTRIES, bypass=HTTP_CACHE_BYPASS)
+
+# One rate-limited, retrying client per external service, with per-attempt timeouts, an
+# overall deadline, hedging and circuit breakers. Lookups whose service stays unavailable
+# fall back to defaults and report the result as degraded. Hedging is off while a
+# cassette is active: a duplicate request would record, or consume, a second exchange.
+services = {
+    name: ServiceClient(
+        name, per_min / 60, SERVICE_MAX_ATTEMPTS, SERVICE_BACKOFF_BASE_S, SERVICE_BACKOFF_MAX_S,
+        timeout_s=SERVICE_TIMEOUT_S[name], deadline_s=SERVICE_DEADLINE_S[name],
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_after_s=CIRCUIT_RESET_S,
+        hedge_fraction=0.0 if cassette.enabled else HEDGE_MAX_FRACTION, http=cassette.sync_http(),
+    )
+    for name, per_min in SERVICE_RATE_PER_MIN.items()
+}
+
+IMAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# Every *_async function below takes an aiohttp session and mirrors its blocking
+# counterpart: same requests, same parsing, same fallbacks. Only the transport differs.
+
+def service_summary() -> str:
+    return "\n".join(client.summary() for client in services.values())
+
+
+def _collect_metrics():
+    """Exports the running totals kept by the service clients, caches and image store."""
+    for client in services.values():
+        for field, help in (("calls", "Attempts made"), ("retries", "Attempts retried"),
+                            ("throttled", "429 responses"), ("hedged", "Hedged duplicate requests"),
+                            ("short_circuited", "Calls skipped by an open circuit breaker"),
+                            ("failures", "Calls that gave up (caller fell back)")):
+            yield Sample(f"rule_engine_service_{field}_total", "counter", f"{help}, per external service.",
+                         {"service": client.name}, getattr(client, field))
+    for endpoint, (hits, misses) in response_cache.lookups().items():
+        for result, n in (("hit", hits), ("miss", misses)):
+            yield Sample("rule_engine_cache_lookups_total", "counter", "Cache lookups, per cache and result.",
+                         {"cache": f"http:{endpoint}", "result": result}, n)
+    for name, cache in (("renovation", _renovation_cache), ("amenity_cells", _amenity_cache)):
+        for result, n in (("hit", cache.hits), ("miss", cache.misses)):
+            yield Sample("rule_engine_cache_lookups_total", "counter", "Cache lookups, per cache and result.",
+                         {"cache": name, "result": result}, n)
+    for result, n in (("hit", image_store.hits), ("revalidated", image_store.revalidated)):
+        yield Sample("rule_engine_cache_lookups_total", "counter", "Cache lookups, per cache and result.",
+                     {"cache": "image_store", "result": result}, n)
+    yield Sample("rule_engine_image_store_downloaded_bytes_total", "counter",
+                 "Image bytes downloaded into the image store.", {}, image_store.downloaded_bytes)
+    yield Sample("rule_engine_image_store_saved_bytes_total", "counter",
+                 "Image bytes served locally instead of downloaded.", {}, image_store.bytes_saved)
+    yield Sample("rule_engine_image_store_bytes", "gauge", "Size of the image store on disk.", {}, image_store.total_bytes)
+    yield Sample("rule_engine_image_memory_peak_bytes", "gauge", "Peak image bytes held in memory.", {},
+                 image_budget.peak_bytes)
+    if cassette.enabled:
+        for result, n in (("recorded", cassette.recorded), ("replayed", cassette.replayed), ("missed", cassette.missed)):
+            yield Sample("rule_engine_cassette_exchanges_total", "counter", "Exchanges recorded or replayed, by result.",
+                         {"mode": cassette.mode, "result": result}, n)
+
+metrics.add_collector(_collect_metrics)
+
 
 def _clean_and_parse_json(raw_text: str) -> list:
     """
@@ -33,60 +146,285 @@ def _clean_and_parse_json(raw_text: str) -> list:
     else:
         # Assume the whole string is the JSON if no markdown block is found
         clean_str = raw_text
-    
+
     return json.loads(clean_str)
 
 def get_renovation_cost(image_urls: List[str]) -> RenovationCost:
     """Calls the Gemini vision model to get renovation cost details from images."""
-    print("   -> [LIVE] Calling Gemini Vision API for renovation analysis...")
-    image_parts = []
+    return analyse_renovation_images(download_images(image_urls))
 
-    # Use a session for efficient downloading
-    with requests.Session() as session:
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
-
-        # Process a maximum of 10 images to balance detail and speed/cost
-        for url in image_urls[:10]:
-            try:
-                response = session.get(url, stream=True, timeout=15)
+
+async def get_renovation_cost_async(session: aiohttp.ClientSession, image_urls: List[str]) -> RenovationCost:
+    return await analyse_renovation_images_async(await download_images_async(session, image_urls))
+
+
+# Image bytes held in memory by the async pipeline, from download until Gemini has answered.
+image_budget = ByteBudget(IMAGE_MEMORY_BUDGET_BYTES)
+
+def _prepare(data: bytes, url: str) -> Optional[dict]:
+    part = prepare_image(data, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY)
+    if part is None:
+        log.warning("Image is not in a usable format, skipping", extra={"url": url})
+    return part
+
+
+# --- Local image store ---
+# Raw photo bytes on disk, keyed by content hash. A copy younger than
+# IMAGE_STORE_MAX_AGE_S is used without asking the server; an older one is revalidated
+# with If-None-Match / If-Modified-Since, so an unchanged photo is never transferred twice.
+image_store = BlobStore(IMAGE_STORE_PATH, IMAGE_STORE_MAX_BYTES)
+
+def _stored_image(url: str):
+    """(local copy if fresh enough to use as is, store entry to revalidate or None)."""
+    entry = image_store.lookup(url)
+    if entry is None:
+        return None, None
+    if time.time() - entry.fetched_at <= IMAGE_STORE_MAX_AGE_S:
+        data = image_store.read(url, entry)
+        return data, (entry if data is not None else None)
+    return None, entry
+
+def _revalidation_headers(entry) -> dict:
+    headers = {}
+    if entry is not None and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry is not None and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    return headers
+
+def _store_image(url: str, data: bytes, etag: Optional[str], last_modified: Optional[str]):
+    try:
+        image_store.put(url, data, etag, last_modified)
+    except (OSError, sqlite3.Error) as e:
+        log.warning("Could not store image locally", extra={"url": url, "error": str(e)})
+
+def _download_image(session: requests.Session, url: str) -> Optional[dict]:
+    data, entry = _stored_image(url)
+    if data is not None:
+        return _prepare(data, url)
+    try:
+        with session.get(url, stream=True, timeout=15, headers=_revalidation_headers(entry)) as response:
+            if response.status_code == 304 and entry is not None:
+                data = image_store.read(url, entry, revalidated=True)
+            else:
                 response.raise_for_status()
-                image_parts.append({
-                    "mime_type": "image/jpeg",
-                    "data": response.content
-                })
-            except requests.exceptions.RequestException as e:
-                print(f"   WARNING: Could not download image {url}. Skipping. Error: {e}")
-                continue
+                chunks, size = [], 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > IMAGE_MAX_DOWNLOAD_BYTES:
+                        log.warning("Image too large, skipping", extra={"url": url, "max_bytes": IMAGE_MAX_DOWNLOAD_BYTES})
+                        return None
+                    chunks.append(chunk)
+                data = b"".join(chunks)
+                _store_image(url, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        if data is None:
+            # Not modified, but the local copy was evicted since the lookup: fetch it whole.
+            return _download_image(session, url)
+        return _prepare(data, url)
+    except requests.exceptions.RequestException as e:
+        log.warning("Could not download image, skipping", extra={"url": url, "error": str(e) or type(e).__name__})
+        return None
+
+def download_images(image_urls: List[str]) -> List[dict]:
+    """Downloads up to 10 listing images concurrently as (downscaled) Gemini inline-data parts."""
+    # Process a maximum of 10 images to balance detail and speed/cost
+    urls = image_urls[:MAX_IMAGES]
+    if not urls:
+        return []
+
+    # Use a session for efficient downloading
+    with cassette.sync_session() as session, ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        session.headers.update(IMAGE_HEADERS)
+        parts = list(pool.map(lambda url: _download_image(session, url), urls))
+
+    return [part for part in parts if part is not None]
+
+
+class _Reservation:
+    """Bytes a property reserved up front; downloaded chunks are counted against it first."""
+
+    def __init__(self, n_bytes: int):
+        self.remaining = n_bytes
+
+    def take(self, n_bytes: int):
+        covered = min(n_bytes, self.remaining)
+        self.remaining -= covered
+        image_budget.force(n_bytes - covered)
+
+
+# Running estimate of raw bytes per listing photo, used to size each property's reservation.
+_raw_image_bytes_estimate = float(IMAGE_RESERVE_BYTES)
+
+async def _download_image_async(session: aiohttp.ClientSession, url: str, reservation: _Reservation) -> Optional[dict]:
+    global _raw_image_bytes_estimate
+    loop = asyncio.get_running_loop()
+    held = 0
+    try:
+        # Store lookups and writes touch SQLite and the disk; keep them off the event loop.
+        data, entry = await loop.run_in_executor(None, _stored_image, url)
+        if data is None:
+            headers = {**IMAGE_HEADERS, **_revalidation_headers(entry)}
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                if response.status == 304 and entry is not None:
+                    data = await loop.run_in_executor(None, image_store.read, url, entry, True)
+                    if data is None:
+                        # Not modified, but the local copy was evicted since the lookup: fetch it whole.
+                        return await _download_image_async(session, url, reservation)
+                else:
+                    response.raise_for_status()
+                    chunks = []
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        held += len(chunk)
+                        reservation.take(len(chunk))
+                        if held > IMAGE_MAX_DOWNLOAD_BYTES:
+                            log.warning("Image too large, skipping", extra={"url": url, "max_bytes": IMAGE_MAX_DOWNLOAD_BYTES})
+                            return None
+                        chunks.append(chunk)
+                    data = b"".join(chunks)
+                    await loop.run_in_executor(None, _store_image, url, data,
+                                               response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        if not held: # a local copy is read into memory just like a download
+            held = len(data)
+            reservation.take(held)
+        _raw_image_bytes_estimate = 0.9 * _raw_image_bytes_estimate + 0.1 * held
+        # Decoding and resizing is CPU work; keep it off the event loop.
+        part = await loop.run_in_executor(None, _prepare, data, url)
+        if part is not None:
+            image_budget.force(len(part["data"]))
+        return part
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log.warning("Could not download image, skipping", extra={"url": url, "error": str(e) or type(e).__name__})
+        return None
+    finally:
+        image_budget.release(held) # the raw download; only the prepared part stays accounted
+
+
+async def download_images_async(session: aiohttp.ClientSession, image_urls: List[str]) -> List[dict]:
+    """
+    Downloads a listing's images concurrently, keeping their original order.
+
+    Waits for room in image_budget first. The returned parts stay counted against
+    the budget until release_image_parts() is called on them.
+    """
+    urls = image_urls[:MAX_IMAGES]
+    reservation = _Reservation(int(len(urls) * _raw_image_bytes_estimate))
+    await image_budget.acquire(reservation.remaining)
+    try:
+        parts = await asyncio.gather(*(_download_image_async(session, url, reservation) for url in urls))
+    finally:
+        image_budget.release(reservation.remaining)
+    return [part for part in parts if part is not None]
+
+
+def release_image_parts(image_parts: List[dict]):
+    image_budget.release(sum(len(part["data"]) for part in image_parts))
+
+
+RENOVATION_PROMPT = "Play a role as an expert property evaluator. Analyze the uploaded photos and provide a list of broken or degraded items that require renovation. Return a JSON list where each object has 'item', 'reason', 'material', 'amount', and 'price' (estimated in EUR, e.g., '€1500'). Focus only on damaged items. For outdoor photos, evaluate only the building's exterior (walls, roof, windows, doors). Do not include landscaping. The final output must be only the raw JSON list, without any extra text or markdown."
+
+
+# --- Renovation analysis cache ---
+# Validated Gemini answers keyed on the image bytes plus prompt, model and
+# RENOVATION_CACHE_VERSION: editing the prompt or switching model never reuses old
+# answers. Bump the version, or run `python main.py --invalidate-renovation-cache`,
+# to force a re-analysis for any other reason.
+_renovation_cache = CacheStore(RENOVATION_CACHE_PATH, max_entries=RENOVATION_CACHE_MAX_ENTRIES)
+
+def _renovation_cache_key(image_parts: List[dict]) -> str:
+    digest = hashlib.sha256()
+    for text in (RENOVATION_CACHE_VERSION, GEMINI_MODEL_NAME, RENOVATION_PROMPT):
+        digest.update(text.encode("utf-8") + b"\0")
+    for part in image_parts:
+        digest.update(part["mime_type"].encode("utf-8") + b"\0")
+        digest.update(hashlib.sha256(part["data"]).digest())
+    return digest.hexdigest()
+
+def _cached_renovation_cost(cache_key: str) -> Optional[RenovationCost]:
+    return _renovation_cost_from_cache(_renovation_cache.get(cache_key, RENOVATION_CACHE_TTL_S))
+
+async def _cached_renovation_cost_async(cache_key: str) -> Optional[RenovationCost]:
+    return _renovation_cost_from_cache(await _renovation_cache.get_async(cache_key, RENOVATION_CACHE_TTL_S))
+
+def _renovation_cost_from_cache(cached: Optional[dict]) -> Optional[RenovationCost]:
+    if cached is None:
+        return None
+    renovation_cost = RenovationCost.model_validate(cached)
+    log.info("Renovation analysis served from cache", extra={"total_cost": renovation_cost.total_cost})
+    return renovation_cost
 
+def invalidate_renovation_cache() -> int:
+    """Forgets every cached renovation analysis; returns how many were dropped."""
+    return _renovation_cache.clear()
+
+def _renovation_cost_from_text(raw_text: str) -> RenovationCost:
+    parsed_data = _clean_and_parse_json(raw_text)
+
+    # This assumes you have updated the RenovationItem model as I previously recommended
+    validated_items = [RenovationItem.model_validate(item) for item in parsed_data]
+    total_cost = sum(item.price for item in validated_items)
+
+    log.info("Gemini analysis complete", extra={"total_cost": total_cost})
+    return RenovationCost(items=validated_items, total_cost=total_cost)
+
+
+def analyse_renovation_images(image_parts: List[dict]) -> RenovationCost:
+    """Sends downloaded image parts to the Gemini vision model for a renovation estimate."""
+    cache_key = _renovation_cache_key(image_parts) if image_parts else None
+    cached = _cached_renovation_cost(cache_key) if cache_key else None
+    if cached is not None:
+        return cached
+
+    log.debug("Calling Gemini Vision API for renovation analysis", extra={"images": len(image_parts)})
     if not image_parts:
-        print("   -> ERROR: No valid images could be loaded. Returning zero cost.")
-        return RenovationCost(items=[], total_cost=0.0)
+        log.error("No valid images could be loaded, returning zero cost (degraded)")
+        return RenovationCost(items=[], total_cost=0.0, degraded=True)
 
-    prompt = "Play a role as an expert property evaluator. Analyze the uploaded photos and provide a list of broken or degraded items that require renovation. Return a JSON list where each object has 'item', 'reason', 'material', 'amount', and 'price' (estimated in EUR, e.g., '€1500'). Focus only on damaged items. For outdoor photos, evaluate only the building's exterior (walls, roof, windows, doors). Do not include landscaping. The final output must be only the raw JSON list, without any extra text or markdown."
-    
-    contents = [prompt, *image_parts]
+    contents = [RENOVATION_PROMPT, *image_parts]
 
     try:
-        response = gemini_model.generate_content(contents)
-        parsed_data = _clean_and_parse_json(response.text)
-        
-        # This assumes you have updated the RenovationItem model as I previously recommended
-        validated_items = [RenovationItem.model_validate(item) for item in parsed_data]
-        total_cost = sum(item.price for item in validated_items)
-        
-        print(f"   -> SUCCESS: Gemini analysis complete. Estimated Renovation Cost: €{total_cost:,.2f}")
-        return RenovationCost(items=validated_items, total_cost=total_cost)
+        generate = cassette.wrap_call(cache_key, gemini_model.generate_content)
+        response = services["gemini"].call(generate, contents, request_options={"timeout": SERVICE_TIMEOUT_S["gemini"]})
+        renovation_cost = _renovation_cost_from_text(response.text)
+        _renovation_cache.put(cache_key, renovation_cost.model_dump(mode='json'))
+        return renovation_cost
 
     except (json.JSONDecodeError, ValueError) as e:
-        print(f"   -> ERROR: Failed to parse or validate JSON response from Gemini. Error: {e}")
-        # Also print the raw response text to see what the model returned
-        print(f"   [RAW RESPONSE]: {response.text if 'response' in locals() else 'No response object'}")
+        # Also log the raw response text to see what the model returned
+        log.error("Failed to parse or validate JSON response from Gemini", extra={
+            "error": str(e), "raw_response": response.text if 'response' in locals() else None})
     except Exception as e:
-        print(f"   -> ERROR: An unexpected error occurred during Gemini API call. Error: {e}")
-    
-    return RenovationCost(items=[], total_cost=0.0)
+        log.error("Unexpected error during Gemini API call", extra={"error": str(e)})
+
+    return RenovationCost(items=[], total_cost=0.0, degraded=True)
+
+
+async def analyse_renovation_images_async(image_parts: List[dict]) -> RenovationCost:
+    cache_key = _renovation_cache_key(image_parts) if image_parts else None
+    cached = await _cached_renovation_cost_async(cache_key) if cache_key else None
+    if cached is not None:
+        return cached
+
+    log.debug("Calling Gemini Vision API for renovation analysis", extra={"images": len(image_parts)})
+    if not image_parts:
+        log.error("No valid images could be loaded, returning zero cost (degraded)")
+        return RenovationCost(items=[], total_cost=0.0, degraded=True)
+
+    contents = [RENOVATION_PROMPT, *image_parts]
+
+    try:
+        generate = cassette.wrap_call_async(cache_key, gemini_model.generate_content_async)
+        response = await services["gemini"].call_async(generate, contents)
+        renovation_cost = _renovation_cost_from_text(response.text)
+        await _renovation_cache.put_async(cache_key, renovation_cost.model_dump(mode='json'))
+        return renovation_cost
+
+    except (json.JSONDecodeError, ValueError) as e:
+        log.error("Failed to parse or validate JSON response from Gemini", extra={
+            "error": str(e), "raw_response": response.text if 'response' in locals() else None})
+    except Exception as e:
+        log.error("Unexpected error during Gemini API call", extra={"error": str(e)})
+
+    return RenovationCost(items=[], total_cost=0.0, degraded=True)
 
 
 def _parse_price_string(price_str: str) -> float:
@@ -103,120 +441,312 @@ def _parse_price_string(price_str: str) -> float:
     except (ValueError, TypeError):
         return 0.0
 
-def get_market_average(latitude: float, longitude: float) -> float:
+def _market_price_from_response(data: dict) -> float:
+    # --- THE FIX ---
+    # Try to get the price from a key named 'price' first. If that fails,
+    # fall back to trying 'median'.
+    price_str = data.get("price") or data.get("median")
+
+    if price_str:
+        price = _parse_price_string(price_str)
+        if price > 0:
+            log.debug("Market average found", extra={"price": price})
+            return price
+
+    log.warning("Invalid market price string, falling back to default", extra={"price_str": price_str})
+    return DEFAULT_MARKET_PRICE
+
+def _local_price_index() -> Optional[market_price.MarketPriceIndex]:
+    if MARKET_PRICE_SOURCE != "local":
+        return None
+    return market_price.load_index(HOUSE_PRICE_DATA_PATH)
+
+def get_market_averages(latitudes, longitudes) -> np.ndarray:
+    """Vectorized market averages for a whole batch of locations, from the local index only."""
+    index = market_price.load_index(HOUSE_PRICE_DATA_PATH)
+    if index is None:
+        return np.full(len(latitudes), DEFAULT_MARKET_PRICE)
+    town_prices = np.array([_parse_price_string(price) for _, _, price in index.towns] + [_parse_price_string(market_price.DEFAULT_PRICE)])
+    town_prices[town_prices <= 0] = DEFAULT_MARKET_PRICE
+    towns, _ = index.lookup_many(latitudes, longitudes)
+    return town_prices[towns] # -1 picks the trailing default entry
+
+def get_market_average(latitude: float, longitude: float) -> Tuple[float, bool]:
     """
-    Fetches the average market price from the external GetHousePrice Cloud Function.
-    Falls back to a default value if the API call fails.
+    Fetches the average market price from the local house price index, or from the
+    external GetHousePrice Cloud Function when that is unavailable.
+    Returns (price, degraded); degraded means the API could not answer and the
+    default price was used.
     """
-    print(f"   -> [LIVE] Calling GetHousePrice API for market average...")
+    index = _local_price_index()
+    if index is not None:
+        return _market_price_from_response(index.lookup(latitude, longitude)), False
+
+    log.debug("Calling GetHousePrice API for market average")
     params = {"lat": latitude, "lon": longitude}
     try:
-        response = requests.get(GET_HOUSE_PRICE_URL, params=params, timeout=10)
-        response.raise_for_status()
-
-        data = response.json()
-        
-        # --- THE FIX ---
-        # Try to get the price from a key named 'price' first. If that fails,
-        # fall back to trying 'median'.
-        price_str = data.get("price") or data.get("median")
-
-        if price_str:
-            price = _parse_price_string(price_str)
-            if price > 0:
-                print(f"   -> SUCCESS: Market average found: €{price:,.2f}")
-                return price
-        
-        print(f"   -> WARNING: API returned an invalid price string ('{price_str}'). Falling back to default.")
-        return DEFAULT_MARKET_PRICE
+        data = response_cache.get("market_price", params)
+        if data is None:
+            data = services["market_price"].fetch_json("GET", GET_HOUSE_PRICE_URL, params=params)
+            response_cache.put("market_price", params, data)
+        return _market_price_from_response(data), False
 
-    except requests.exceptions.RequestException as e:
-        print(f"   -> ERROR: Could not connect to GetHousePrice API: {e}. Falling back to default price.")
-        return DEFAULT_MARKET_PRICE
-    except json.JSONDecodeError:
-        print(f"   -> ERROR: Failed to parse JSON from GetHousePrice API. Falling back to default price.")
-        return DEFAULT_MARKET_PRICE
+    except ServiceError as e:
+        log.error("GetHousePrice API unavailable, falling back to default price (degraded)", extra={"error": str(e)})
+        return DEFAULT_MARKET_PRICE, True
 
 
-def get_amenity_details(latitude: float, longitude: float, api_key: str) -> AmenityResult:
-    """
-    Finds nearby amenities, calculates their distance, and returns a score and detailed list.
-    The score is now distance-weighted: closer amenities result in a higher score.
-    """
-    print("   -> Checking for amenities using Places API...")
-    
-    amenity_types = ['supermarket', 'school', 'bus_station', 'train_station', 'park', 'hospital', 'pharmacy']
-    found_amenities_list = []
-    
+async def get_market_average_async(session: aiohttp.ClientSession, latitude: float, longitude: float) -> Tuple[float, bool]:
+    index = _local_price_index()
+    if index is not None:
+        return _market_price_from_response(index.lookup(latitude, longitude)), False
+
+    log.debug("Calling GetHousePrice API for market average")
+    params = {"lat": latitude, "lon": longitude}
+    try:
+        data = await response_cache.get_async("market_price", params)
+        if data is None:
+            query = {"lat": str(latitude), "lon": str(longitude)}
+            data = await services["market_price"].fetch_json_async(session, "GET", GET_HOUSE_PRICE_URL, params=query)
+            await response_cache.put_async("market_price", params, data)
+        return _market_price_from_response(data), False
+
+    except ServiceError as e:
+        log.error("GetHousePrice API unavailable, falling back to default price (degraded)", extra={"error": str(e)})
+        return DEFAULT_MARKET_PRICE, True
+
+
+def _places_request(latitude: float, longitude: float, place_type: str, api_key: str,
+                    radius_km: float = MAX_RADIUS_KM, max_results: int = 1):
+    """Headers and payload for a single Places searchNearby call, nearest results first."""
     headers = {
         'Content-Type': 'application/json',
         'X-Goog-Api-Key': api_key,
         'X-Goog-FieldMask': 'places.displayName,places.types,places.location'
     }
-    
-    property_coords = (latitude, longitude)
-    
-    # Define a max search radius, which will also be our scoring boundary
-    MAX_RADIUS_KM = 5.0
-
-    for place_type in amenity_types:
-        payload = {
-            "includedTypes": [place_type],
-            "maxResultCount": 1, # Get the closest one
-            "locationRestriction": {
-                "circle": {
-                    "center": {"latitude": latitude, "longitude": longitude},
-                    "radius": MAX_RADIUS_KM * 1000 # API expects radius in meters
-                }
+    payload = {
+        "includedTypes": [place_type],
+        "maxResultCount": max_results,
+        "rankPreference": "DISTANCE",
+        "locationRestriction": {
+            "circle": {
+                "center": {"latitude": latitude, "longitude": longitude},
+                "radius": radius_km * 1000 # API expects radius in meters
             }
         }
-        try:
-            response = requests.post("https://places.googleapis.com/v1/places:searchNearby", json=payload, headers=headers, timeout=5)
-            if response.ok and response.json().get('places'):
-                place = response.json()['places'][0]
-                
-                place_coords = (place['location']['latitude'], place['location']['longitude'])
-                distance_km = round(great_circle(property_coords, place_coords).kilometers, 2)
-                
-                amenity = Amenity(
-                    name=place['displayName']['text'],
-                    type=place_type.replace('_', ' '),
-                    distance_km=distance_km
-                )
-                found_amenities_list.append(amenity)
-
-        except requests.exceptions.RequestException:
-            # Silently fail on API error to not stop the whole process
-            continue
-            
+    }
+    return headers, payload
+
+def _search_places(headers: dict, payload: dict) -> dict:
+    """Cached searchNearby call; raises ServiceError if Places cannot answer."""
+    cache_params = {"fieldMask": headers['X-Goog-FieldMask'], "body": payload}
+    data = response_cache.get("places", cache_params)
+    if data is None:
+        data = services["places"].fetch_json("POST", PLACES_NEARBY_URL, json=payload, headers=headers)
+        response_cache.put("places", cache_params, data)
+    return data
+
+async def _search_places_async(session: aiohttp.ClientSession, headers: dict, payload: dict) -> dict:
+    cache_params = {"fieldMask": headers['X-Goog-FieldMask'], "body": payload}
+    data = await response_cache.get_async("places", cache_params)
+    if data is None:
+        data = await services["places"].fetch_json_async(session, "POST", PLACES_NEARBY_URL, json=payload, headers=headers)
+        await response_cache.put_async("places", cache_params, data)
+    return data
+
+def _amenity_from_places(data: dict, property_coords, place_type: str) -> Optional[Amenity]:
+    if not data.get('places'):
+        return None
+    place = data['places'][0]
+
+    place_coords = (place['location']['latitude'], place['location']['longitude'])
+    distance_km = round(great_circle(property_coords, place_coords).kilometers, 2)
+
+    return Amenity(
+        name=place['displayName']['text'],
+        type=place_type.replace('_', ' '),
+        distance_km=distance_km
+    )
+
+def _amenity_result(found_amenities_list: List[Amenity], degraded: bool = False) -> AmenityResult:
     # --- NEW DISTANCE-WEIGHTED SCORING LOGIC ---
     if not found_amenities_list:
-        return AmenityResult(score=0.0, found_amenities=[])
+        return AmenityResult(score=0.0, found_amenities=[], degraded=degraded)
 
     total_score_points = 0
-    num_searched_types = len(amenity_types)
+    num_searched_types = len(AMENITY_TYPES)
 
     for amenity in found_amenities_list:
         # Calculate a score for this amenity (100 for 0km, 0 for MAX_RADIUS_KM)
         # using a linear decay.
         amenity_score = 100 * (1 - (min(amenity.distance_km, MAX_RADIUS_KM) / MAX_RADIUS_KM))
         total_score_points += amenity_score
-    print("Found amenities: ", found_amenities_list)  
-    print("Total score: ", total_score_points)  
+    log.debug("Amenities found", extra={
+        "amenities": [a.model_dump(mode='json') for a in found_amenities_list],
+        "total_score": total_score_points, "searched_types": num_searched_types})
     # Average the score across all *searched* amenity types. This correctly
     # penalizes the score if some amenity types were not found.
-    print("Number of searched types: ", num_searched_types)  
     final_score = round(total_score_points / num_searched_types, 2)
-    
-    return AmenityResult(score=final_score, found_amenities=found_amenities_list)
 
+    return AmenityResult(score=final_score, found_amenities=found_amenities_list, degraded=degraded)
+
+# --- Geo-cell amenity cache ---
+# Places is queried once per grid cell and amenity type, from the cell centre with the
+# search radius widened by the cell's half-diagonal, for the nearest MAX_CELL_CANDIDATES
+# places. Every property in the cell then picks its own nearest place from that list;
+# when the list cannot prove it holds the true nearest, the property is queried directly.
+
+MAX_CELL_CANDIDATES = 20 # Places' maxResultCount limit
+
+_amenity_cache = CacheStore(AMENITY_CACHE_PATH, max_entries=AMENITY_CACHE_MAX_ENTRIES)
+_amenity_cell_fetches = {} # cell key -> in-flight fetch task, shared by concurrent misses
+_amenity_cell_fetches_lock = threading.Lock() # the stages' event loops run on separate threads
+
+def _forget_amenity_cell_fetch(cell_key: str, task: asyncio.Future):
+    # Only the finished task: a newer one (e.g. on another loop) may have replaced it.
+    with _amenity_cell_fetches_lock:
+        if _amenity_cell_fetches.get(cell_key) is task:
+            del _amenity_cell_fetches[cell_key]
+
+def _amenity_cell(latitude: float, longitude: float):
+    """Cache key, centre and search radius (km) of the grid cell holding a point."""
+    row, col = floor(latitude / AMENITY_CELL_DEG), floor(longitude / AMENITY_CELL_DEG)
+    centre = ((row + 0.5) * AMENITY_CELL_DEG, (col + 0.5) * AMENITY_CELL_DEG)
+    half_diagonal_km = max(
+        great_circle(centre, ((row + dr) * AMENITY_CELL_DEG, (col + dc) * AMENITY_CELL_DEG)).kilometers
+        for dr in (0, 1) for dc in (0, 1)
+    )
+    return f"{AMENITY_CELL_DEG}:{row}:{col}", centre, MAX_RADIUS_KM + half_diagonal_km
+
+def _cell_candidates(data: dict) -> dict:
+    places = [
+        [place['displayName']['text'], place['location']['latitude'], place['location']['longitude']]
+        for place in data.get('places', [])
+    ]
+    # A short list means every place within the widened radius was returned.
+    return {"places": places, "complete": len(places) < MAX_CELL_CANDIDATES}
+
+def _nearest_cached_amenity(cell: dict, centre, property_coords, place_type: str):
+    """
+    Returns (amenity or None, exact). exact is False when an uncached place could be
+    nearer to the property than the best cached one.
+    """
+    best_name, best_km = None, None
+    for name, lat, lon in cell["places"]:
+        distance_km = great_circle(property_coords, (lat, lon)).kilometers
+        if distance_km <= MAX_RADIUS_KM and (best_km is None or distance_km < best_km):
+            best_name, best_km = name, distance_km
+
+    exact = cell["complete"]
+    if not exact:
+        # Places are ranked by distance from the centre, so anything not returned is at
+        # least (last candidate's distance - property's offset from centre) away.
+        _, last_lat, last_lon = cell["places"][-1]
+        bound_km = great_circle(centre, (last_lat, last_lon)).kilometers - great_circle(centre, property_coords).kilometers
+        exact = best_km <= bound_km if best_km is not None else bound_km > MAX_RADIUS_KM
+
+    if best_name is None:
+        return None, exact
+    return Amenity(name=best_name, type=place_type.replace('_', ' '), distance_km=round(best_km, 2)), exact
+
+def _fetch_amenity_cell(cell_key: str, centre, radius_km: float, place_type: str, api_key: str) -> dict:
+    headers, payload = _places_request(centre[0], centre[1], place_type, api_key, radius_km, MAX_CELL_CANDIDATES)
+    cell = _cell_candidates(_search_places(headers, payload))
+    _amenity_cache.put(cell_key, cell)
+    return cell
+
+def _amenity_of_type(latitude: float, longitude: float, place_type: str, api_key: str) -> Optional[Amenity]:
+    """Nearest amenity of one type within MAX_RADIUS_KM; raises ServiceError if Places cannot answer."""
+    key, centre, radius_km = _amenity_cell(latitude, longitude)
+    cell_key = f"places:{place_type}:{key}"
+    cell = _amenity_cache.get(cell_key, AMENITY_CACHE_TTL_S)
+    if cell is None:
+        cell = _fetch_amenity_cell(cell_key, centre, radius_km, place_type, api_key)
+    amenity, exact = _nearest_cached_amenity(cell, centre, (latitude, longitude), place_type)
+    if exact:
+        return amenity
+
+    headers, payload = _places_request(latitude, longitude, place_type, api_key)
+    return _amenity_from_places(_search_places(headers, payload), (latitude, longitude), place_type)
 
-def get_air_quality_score(latitude: float, longitude: float, api_key: str) -> float:
-    # ... (no change)
-    url = "https://airquality.googleapis.com/v1/currentConditions:lookup"
-    payload = {"location": {"latitude": latitude, "longitude": longitude}}
+def get_amenity_details(latitude: float, longitude: float, api_key: str) -> AmenityResult:
+    """
+    Finds nearby amenities, calculates their distance, and returns a score and detailed list.
+    The score is now distance-weighted: closer amenities result in a higher score.
+    Types that could not be searched count as not found and mark the result degraded.
+    """
+    log.debug("Checking for amenities using Places API")
 
-    historical_url = "https://airquality.googleapis.com/v1/history:lookup"
+    found_amenities_list, degraded = [], False
+    for place_type in AMENITY_TYPES:
+        try:
+            amenity = _amenity_of_type(latitude, longitude, place_type, api_key)
+        except ServiceError as e:
+            log.warning("Could not search for amenity type", extra={"place_type": place_type, "error": str(e)})
+            degraded = True
+            continue
+        if amenity:
+            found_amenities_list.append(amenity)
+
+    return _amenity_result(found_amenities_list, degraded)
+
+
+async def _fetch_amenity_cell_async(session: aiohttp.ClientSession, cell_key: str, centre, radius_km: float,
+                                    place_type: str, api_key: str) -> dict:
+    headers, payload = _places_request(centre[0], centre[1], place_type, api_key, radius_km, MAX_CELL_CANDIDATES)
+    cell = _cell_candidates(await _search_places_async(session, headers, payload))
+    await _amenity_cache.put_async(cell_key, cell)
+    return cell
+
+async def _amenity_cell_async(session: aiohttp.ClientSession, cell_key: str, centre, radius_km: float,
+                              place_type: str, api_key: str) -> dict:
+    """Cached cell, with concurrent misses for the same cell sharing one Places call."""
+    cell = await _amenity_cache.get_async(cell_key, AMENITY_CACHE_TTL_S)
+    if cell is not None:
+        return cell
+    with _amenity_cell_fetches_lock:
+        task = _amenity_cell_fetches.get(cell_key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(_fetch_amenity_cell_async(session, cell_key, centre, radius_km, place_type, api_key))
+            _amenity_cell_fetches[cell_key] = task
+            task.add_done_callback(partial(_forget_amenity_cell_fetch, cell_key))
+    return await asyncio.shield(task)
+
+async def _amenity_of_type_async(session: aiohttp.ClientSession, latitude: float, longitude: float,
+                                 place_type: str, api_key: str) -> Optional[Amenity]:
+    key, centre, radius_km = _amenity_cell(latitude, longitude)
+    cell = await _amenity_cell_async(session, f"places:{place_type}:{key}", centre, radius_km, place_type, api_key)
+    amenity, exact = _nearest_cached_amenity(cell, centre, (latitude, longitude), place_type)
+    if exact:
+        return amenity
+
+    headers, payload = _places_request(latitude, longitude, place_type, api_key)
+    return _amenity_from_places(await _search_places_async(session, headers, payload), (latitude, longitude), place_type)
+
+
+async def get_amenity_details_async(session: aiohttp.ClientSession, latitude: float, longitude: float,
+                                    api_key: str) -> AmenityResult:
+    """All amenity types are searched concurrently; results keep AMENITY_TYPES order."""
+    log.debug("Checking for amenities using Places API")
+    amenities = await asyncio.gather(*(
+        _amenity_of_type_async(session, latitude, longitude, place_type, api_key) for place_type in AMENITY_TYPES
+    ), return_exceptions=True)
+
+    found_amenities_list, degraded = [], False
+    for place_type, amenity in zip(AMENITY_TYPES, amenities):
+        if isinstance(amenity, ServiceError):
+            log.warning("Could not search for amenity type", extra={"place_type": place_type, "error": str(amenity)})
+            degraded = True
+        elif isinstance(amenity, BaseException):
+            raise amenity
+        elif amenity is not None:
+            found_amenities_list.append(amenity)
+    return _amenity_result(found_amenities_list, degraded)
+
+
+def _air_quality_payloads(latitude: float, longitude: float):
+    """Payloads for the current-conditions and 7-day history lookups."""
+    payload = {"location": {"latitude": latitude, "longitude": longitude}}
 
     # Current date and time in Ireland timezone
     ireland_tz = ZoneInfo("Europe/Dublin")
@@ -231,36 +761,156 @@ def get_air_quality_score(latitude: float, longitude: float, api_key: str) -> fl
         "startTime":seven_days_ago_iso,
         "endTime":one_days_ago_iso
     }}
-    # print(payload)
-    
-    
+    return payload, historical_payload
+
+def _air_quality_aggregate(data: dict, historical_data: dict):
+    """Mean AQI over the history plus the current reading, and hourly category counts (first-seen order)."""
+    uaqi = next((idx['aqi'] for idx in data['indexes'] if idx['code'] == 'uaqi'), 75)
+
+    historical_hour_data = historical_data['hoursInfo']
+    list_aqi = [hour['indexes'][0]['aqi'] for hour in historical_hour_data]
+    category_counts = Counter(hour['indexes'][0]['category'] for hour in historical_hour_data)
+
+    list_aqi.append(uaqi)
+    avg_aqi = sum(list_aqi) / len(list_aqi)
+    return avg_aqi, [[category, n] for category, n in category_counts.items()]
+
+# Returned (flagged as degraded) when air quality cannot be looked up.
+AIR_QUALITY_FALLBACK = (50.0, 100, "Good air quality")
+
+def _air_quality_result(avg_aqi: float, most_frequent_category: str):
+    max_aqi = 500
+    if avg_aqi < 0:
+        avg_aqi = 0
+    elif avg_aqi > max_aqi:
+        avg_aqi = max_aqi
+    score = (1 - avg_aqi / max_aqi) * 100
+    return round(score, 2), round(avg_aqi, 2), most_frequent_category
+
+def _air_quality_from_responses(data: dict, historical_data: dict):
+    log.debug("Air quality data", extra={"current": data, "history": historical_data})
+    avg_aqi, categories = _air_quality_aggregate(data, historical_data)
+    # Ties go to the category seen first, as max(list, key=list.count) did.
+    most_frequent_category = max(categories, key=lambda cn: cn[1])[0]
+    return _air_quality_result(avg_aqi, most_frequent_category)
+
+# --- Precomputed air-quality grid ---
+
+_air_quality_grid: Optional[AirQualityGrid] = None
+_air_quality_grid_lock = threading.Lock()
+
+def air_quality_grid() -> AirQualityGrid:
+    """
+    The grid, opened and loaded from SQLite on first use. Call it before starting an
+    event loop that looks up air quality, so the load does not block the loop.
+    """
+    global _air_quality_grid
+    with _air_quality_grid_lock:
+        if _air_quality_grid is None:
+            _air_quality_grid = AirQualityGrid(AIR_QUALITY_GRID_PATH, AIR_QUALITY_CELL_DEG, AIR_QUALITY_GRID_MAX_AGE_S)
+        return _air_quality_grid
+
+async def _air_quality_grid_async() -> AirQualityGrid:
+    if _air_quality_grid is not None:
+        return _air_quality_grid
+    return await asyncio.get_running_loop().run_in_executor(None, air_quality_grid)
+
+def _air_quality_from_grid(latitude: float, longitude: float, grid: Optional[AirQualityGrid] = None):
+    interpolated = (grid if grid is not None else air_quality_grid()).lookup(latitude, longitude)
+    if interpolated is None:
+        return None
+    return _air_quality_result(*interpolated)
+
+async def _fetch_air_quality_cell(session: aiohttp.ClientSession, grid: AirQualityGrid, cell, api_key: str):
+    lat, lon = grid.centre(cell)
+    payload, historical_payload = _air_quality_payloads(lat, lon)
+    client = services["air_quality"]
+
+    try:
+        data, historical_data = await asyncio.gather(
+            client.fetch_json_async(session, "POST", AIR_QUALITY_CURRENT_URL, params={"key": api_key}, json=payload),
+            client.fetch_json_async(session, "POST", AIR_QUALITY_HISTORY_URL, params={"key": api_key}, json=historical_payload),
+        )
+        avg_aqi, categories = _air_quality_aggregate(data, historical_data)
+    except (ServiceError, KeyError, IndexError) as e:
+        log.warning("Air quality lookup for grid cell failed", extra={"cell": cell, "error": str(e)})
+        return None
+    if not categories:
+        return None
+    return cell, avg_aqi, categories
+
+async def refresh_air_quality_grid_async(points, api_key: str, concurrency: int = 20) -> int:
+    """
+    Fetches every grid cell that lookups at these (lat, lon) points would read and that
+    has no fresh aggregate yet. Returns the number of cells refreshed.
+    """
+    grid = await _air_quality_grid_async()
+    stale = sorted(cell for cell in grid.cells_for(points) if not grid.is_fresh(cell))
+    log.info("Refreshing air quality grid cells", extra={"cells": len(stale)})
+    slots = asyncio.Semaphore(concurrency)
+
+    async def fetch(session, cell):
+        async with slots:
+            return await _fetch_air_quality_cell(session, grid, cell, api_key)
+
+    async with http_session() as session:
+        results = await asyncio.gather(*(fetch(session, cell) for cell in stale))
+    aggregates = [r for r in results if r is not None]
+    await asyncio.get_running_loop().run_in_executor(None, grid.store, aggregates)
+    return len(aggregates)
+
+def get_air_quality_score(latitude: float, longitude: float, api_key: str):
+    """
+    Interpolated from the precomputed grid; live API calls only where the grid has no
+    fresh data. Returns (score, mean AQI, category, degraded); degraded means the API
+    could not answer and AIR_QUALITY_FALLBACK was used.
+    """
+    from_grid = _air_quality_from_grid(latitude, longitude)
+    if from_grid is not None:
+        return (*from_grid, False)
+
+    payload, historical_payload = _air_quality_payloads(latitude, longitude)
+    client = services["air_quality"]
+
+    try:
+        data = response_cache.get("air_quality_current", payload)
+        if data is None:
+            data = client.fetch_json("POST", AIR_QUALITY_CURRENT_URL, params={"key": api_key}, json=payload)
+            response_cache.put("air_quality_current", payload, data)
+
+        # The history window moves with the clock, so it is cached per location (see HTTP_CACHE_TTL_S).
+        historical_data = response_cache.get("air_quality_history", payload)
+        if historical_data is None:
+            historical_data = client.fetch_json("POST", AIR_QUALITY_HISTORY_URL, params={"key": api_key}, json=historical_payload)
+            response_cache.put("air_quality_history", payload, historical_data)
+
+        return (*_air_quality_from_responses(data, historical_data), False)
+    except (ServiceError, KeyError, IndexError, ValueError) as e:
+        log.warning("Air quality lookup failed, using fallback (degraded)", extra={"error": str(e)})
+        return (*AIR_QUALITY_FALLBACK, True)
+
+
+async def get_air_quality_score_async(session: aiohttp.ClientSession, latitude: float, longitude: float, api_key: str):
+    """Current conditions and history are requested concurrently (when the grid cannot answer)."""
+    from_grid = _air_quality_from_grid(latitude, longitude, await _air_quality_grid_async())
+    if from_grid is not None:
+        return (*from_grid, False)
+
+    payload, historical_payload = _air_quality_payloads(latitude, longitude)
+
+    async def _post(endpoint, url, body):
+        data = await response_cache.get_async(endpoint, payload)
+        if data is None:
+            data = await services["air_quality"].fetch_json_async(session, "POST", url, params={"key": api_key}, json=body)
+            await response_cache.put_async(endpoint, payload, data)
+        return data
+
     try:
-        response = requests.post(f"{url}?key={api_key}", json=payload)
-        response.raise_for_status()
-        data = response.json()
-        print("Air quality data: ", data)
-        uaqi = next((idx['aqi'] for idx in data['indexes'] if idx['code'] == 'uaqi'), 75)
-
-        historical_response = requests.post(f"{historical_url}?key={api_key}", json=historical_payload)
-        historical_data = historical_response.json()
-        print("Air quality data: ", historical_data)
-
-        historical_hour_data = historical_data['hoursInfo']
-        list_aqi = [hour['indexes'][0]['aqi'] for hour in historical_hour_data]
-        list_categories = [hour['indexes'][0]['category'] for hour in historical_hour_data]
-        most_frequent_category = max(list_categories, key=list_categories.count)
-
-        list_aqi.append(uaqi)
-        avg_aqi = sum(list_aqi) / len(list_aqi)
-
-        max_aqi = 500
-        if avg_aqi < 0:
-            avg_aqi = 0
-        elif avg_aqi > max_aqi:
-            avg_aqi = max_aqi
-        score = (1 - avg_aqi / max_aqi) * 100
-        # score = 100 - (min(uaqi, 150) / 150 * 100)
-        # historical_data = requests.post(f"https://airquality.googleapis.com/v1/historicalConditions:lookup?key={api_key}&location={latitude},{longitude}&startDate=2024-01-01&endDate=2024-12-31")
-        return round(score, 2), round(avg_aqi, 2), most_frequent_category
-    except requests.exceptions.RequestException:
-        return 50.0, 100, "Good air quality"
\ No newline at end of file
+        data, historical_data = await asyncio.gather(
+            _post("air_quality_current", AIR_QUALITY_CURRENT_URL, payload),
+            _post("air_quality_history", AIR_QUALITY_HISTORY_URL, historical_payload),
+        )
+        return (*_air_quality_from_responses(data, historical_data), False)
+    except (ServiceError, KeyError, IndexError, ValueError) as e:
+        log.warning("Air quality lookup failed, using fallback (degraded)", extra={"error": str(e)})
+        return (*AIR_QUALITY_FALLBACK, True)
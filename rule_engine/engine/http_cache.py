@@ -0,0 +1,92 @@
+# engine/http_cache.py
+"""
+Persistent cache of decoded JSON responses from the enrichment APIs.
+
+Requests are keyed on endpoint name plus normalized parameters: dict keys are
+sorted and coordinates rounded, so the same lookup from a rerun (or a retry after
+a crash) is served from disk instead of costing latency and API quota. Secrets
+such as API keys are never part of the key. Only successful responses are stored.
+"""
+import json
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from .cache_store import CacheStore
+
+# ~1 m at Irish latitudes: finer than any of the lookups can tell apart.
+COORDINATE_DECIMALS = 5
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, float):
+        return round(value, COORDINATE_DECIMALS)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+class ResponseCache:
+    """
+    Per-endpoint TTLs on top of a CacheStore.
+
+    With bypass=True every lookup is a miss but responses are still stored, which
+    refreshes the cache without reading from it.
+    """
+
+    def __init__(self, path: Optional[str], ttls: Dict[str, float], max_entries: int = 500_000,
+                 bypass: bool = False):
+        self.store = CacheStore(path, max_entries=max_entries)
+        self.ttls = dict(ttls)
+        self.bypass = bypass
+        # Updated from pipeline threads and the event loop alike.
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+
+    @staticmethod
+    def key(endpoint: str, params: dict) -> str:
+        return f"{endpoint}:{json.dumps(_normalize(params), sort_keys=True, separators=(',', ':'))}"
+
+    def get(self, endpoint: str, params: dict) -> Any:
+        if endpoint not in self.ttls:
+            raise KeyError(f"No cache TTL configured for endpoint '{endpoint}'")
+        data = None if self.bypass else self.store.get(self.key(endpoint, params), self.ttls[endpoint])
+        return self._count(endpoint, data)
+
+    async def get_async(self, endpoint: str, params: dict) -> Any:
+        """get() for coroutines; see CacheStore.get_async()."""
+        if endpoint not in self.ttls:
+            raise KeyError(f"No cache TTL configured for endpoint '{endpoint}'")
+        data = None if self.bypass else await self.store.get_async(self.key(endpoint, params), self.ttls[endpoint])
+        return self._count(endpoint, data)
+
+    def _count(self, endpoint: str, data: Any) -> Any:
+        with self._lock:
+            counter = self.misses if data is None else self.hits
+            counter[endpoint] = counter.get(endpoint, 0) + 1
+        return data
+
+    def put(self, endpoint: str, params: dict, data: Any):
+        if data is not None:
+            self.store.put(self.key(endpoint, params), data)
+
+    async def put_async(self, endpoint: str, params: dict, data: Any):
+        if data is not None:
+            await self.store.put_async(self.key(endpoint, params), data)
+
+    def lookups(self) -> Dict[str, Tuple[int, int]]:
+        """(hits, misses) per endpoint, as a consistent snapshot."""
+        with self._lock:
+            return {endpoint: (self.hits.get(endpoint, 0), self.misses.get(endpoint, 0))
+                    for endpoint in sorted(set(self.hits) | set(self.misses))}
+
+    def summary(self) -> str:
+        lines = []
+        for endpoint, (hits, misses) in self.lookups().items():
+            lines.append(f"  {endpoint:<22} hits={hits:<6} misses={misses:<6} hit rate={hits / (hits + misses):.0%}")
+        return "\n".join(lines) or "  (no cached endpoints used)"
+
+    def close(self):
+        self.store.close()
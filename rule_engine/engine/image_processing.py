@@ -0,0 +1,141 @@
+# engine/image_processing.py
+"""
+Preparation of listing photos before they are sent to Gemini.
+
+Downloaded bytes are sniffed for their real format (listing sites serve PNG and
+WebP too, and the old code labelled everything image/jpeg). Images larger than
+IMAGE_MAX_DIMENSION, or in a format Gemini does not accept, are downscaled and
+re-encoded as JPEG. Pillow is optional: without it images pass through unchanged,
+apart from formats Gemini cannot read, which are dropped.
+
+ByteBudget caps the image bytes held in memory across all in-flight properties.
+"""
+import asyncio
+import io
+import threading
+from collections import deque
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError: # Pillow not installed: no downscaling
+    Image = None
+
+# Formats Gemini accepts as inline image data.
+GEMINI_MIME_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+
+
+def sniff_mime(data: bytes) -> Optional[str]:
+    """Image MIME type from the file's magic bytes, or None if unrecognised."""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:2] == b"BM":
+        return "image/bmp"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in (b"heic", b"heix", b"hevc", b"hevx"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1", b"heif"):
+            return "image/heif"
+        if brand == b"avif":
+            return "image/avif"
+    return None
+
+
+def prepare_image(data: bytes, max_dimension: int, jpeg_quality: int) -> Optional[dict]:
+    """
+    Returns a Gemini inline-data part ({"mime_type", "data"}) for the downloaded
+    bytes (or any read-only buffer, e.g. a memory-mapped blob), or None if the image
+    cannot be used.
+    """
+    mime_type = sniff_mime(data)
+    data_bytes = lambda: data if isinstance(data, bytes) else bytes(data)
+    if Image is None:
+        return {"mime_type": mime_type, "data": data_bytes()} if mime_type in GEMINI_MIME_TYPES else None
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if mime_type in GEMINI_MIME_TYPES and max(image.size) <= max_dimension:
+                return {"mime_type": mime_type, "data": data_bytes()}
+            image.draft("RGB", (max_dimension, max_dimension)) # JPEG: decode at reduced scale
+            image = image.convert("RGB")
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, format="JPEG", quality=jpeg_quality, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Pillow cannot decode it (e.g. HEIC without a plugin); pass through if Gemini can.
+        return {"mime_type": mime_type, "data": data_bytes()} if mime_type in GEMINI_MIME_TYPES else None
+    return {"mime_type": "image/jpeg", "data": out.getvalue()}
+
+
+class ByteBudget:
+    """
+    Counts image bytes held in memory, shared by every thread and event loop.
+
+    acquire() waits until the reservation fits (a request always fits when nothing
+    is held, so an oversized one cannot stall forever); force() records bytes that
+    are already in memory without waiting. Callers reserve up front, before holding
+    anything, so a waiter never blocks others that could free memory.
+    """
+
+    def __init__(self, limit_bytes: int):
+        if limit_bytes < 1:
+            raise ValueError("limit_bytes must be positive")
+        self.limit_bytes = limit_bytes
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self._lock = threading.Lock()
+        self._waiters = deque() # [n, loop, future, granted]
+
+    def _fits_locked(self, n: int) -> bool:
+        return self.used_bytes == 0 or self.used_bytes + n <= self.limit_bytes
+
+    def _take_locked(self, n: int):
+        self.used_bytes += n
+        self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+
+    async def acquire(self, n: int):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._fits_locked(n):
+                self._take_locked(n)
+                return
+            waiter = [n, loop, loop.create_future(), False]
+            self._waiters.append(waiter)
+        try:
+            await waiter[2]
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter[3]
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                self.release(n)
+            raise
+
+    def force(self, n: int):
+        with self._lock:
+            self._take_locked(n)
+
+    def release(self, n: int):
+        if n <= 0:
+            return
+        with self._lock:
+            self.used_bytes -= n
+            # First come, first served: a large waiter is not starved by smaller ones.
+            while self._waiters and self._fits_locked(self._waiters[0][0]):
+                waiter = self._waiters.popleft()
+                waiter[3] = True
+                self._take_locked(waiter[0])
+                waiter[1].call_soon_threadsafe(_resolve, waiter[2])
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -1,4 +1,8 @@
-from typing import List
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
 from .models import InvestmentAnalysis, AppliedGrant, RenovationItem
 from config import (
     LABOUR_COST_PERCENTAGE,
@@ -21,8 +25,12 @@ class InvestmentCalculator:
         Identifies potential government grants based on the nature of the property
         and the renovation items identified by the vision model.
         """
+        renovation_text = " ".join(item.item.lower() + " " + item.reason.lower() for item in renovation_items)
+        return self._grants_for_keywords(_matched_keywords(renovation_text))
+
+    @staticmethod
+    def _grants_for_keywords(keywords: Tuple[str, ...]) -> List[AppliedGrant]:
         grants = []
-        applied_grant_types = set()
 
         # 1. Vacant & Derelict Property Grants
         # We assume the property is eligible as the tool's purpose is to find them.
@@ -36,17 +44,14 @@ class InvestmentCalculator:
             amount=DERELICT_PROPERTY_TOP_UP_GRANT,
             reason="Potential top-up grant for derelict properties."
         ))
-        
-        # 2. SEAI Grants (based on keywords)
-        renovation_text = " ".join(item.item.lower() + " " + item.reason.lower() for item in renovation_items)
-        for keyword, amount in SEAI_GRANT_KEYWORDS.items():
-            if keyword in renovation_text and keyword not in applied_grant_types:
-                grants.append(AppliedGrant(
-                    name=f"SEAI Grant - {keyword.capitalize()}",
-                    amount=amount,
-                    reason=f"Keyword '{keyword}' found in renovation items."
-                ))
-                applied_grant_types.add(keyword)
+
+        # 2. SEAI Grants (based on keywords found in the renovation items)
+        for keyword in keywords:
+            grants.append(AppliedGrant(
+                name=f"SEAI Grant - {keyword.capitalize()}",
+                amount=SEAI_GRANT_KEYWORDS[keyword],
+                reason=f"Keyword '{keyword}' found in renovation items."
+            ))
 
         return grants
 
@@ -90,4 +95,62 @@ class InvestmentCalculator:
             estimated_after_repair_value=round(estimated_arv, 2),
             potential_profit=round(potential_profit, 2),
             return_on_investment_percent=round(roi, 2)
-        )
\ No newline at end of file
+        )
+
+    def calculate_many(
+        self,
+        listed_prices: Sequence[float],
+        renovation_details: Sequence[dict],
+        market_average_prices: Sequence[float],
+    ) -> List[dict]:
+        """
+        calculate() for many properties at once, from stored renovation_details dicts.
+        The arithmetic runs over whole columns; returns the same dicts as
+        calculate(...).model_dump(mode='json').
+        """
+        listed = np.asarray(listed_prices, dtype=float)
+        arv = np.asarray(market_average_prices, dtype=float)
+        materials = np.array([details['total_cost'] for details in renovation_details], dtype=float)
+        grants = [
+            _grant_dicts(_matched_keywords(" ".join(
+                str(item['item']).lower() + " " + str(item['reason']).lower() for item in details['items']
+            )))
+            for details in renovation_details
+        ]
+        total_grants = np.array([total for total, _ in grants], dtype=float)
+
+        labour = materials * LABOUR_COST_PERCENTAGE
+        total_project = listed + materials + labour
+        net_project = total_project - total_grants
+        profit = arv - net_project
+        with np.errstate(divide='ignore', invalid='ignore'):
+            roi = np.where(net_project > 0, profit / net_project * 100, 0.0)
+
+        # Builtin round(), as in calculate(), so unchanged results compare equal.
+        return [
+            {
+                "estimated_labour_cost": round(l, 2),
+                "total_project_cost": round(t, 2),
+                "potential_grants": [dict(grant) for grant in g[1]],
+                "total_grant_amount": round(tg, 2),
+                "net_project_cost": round(n, 2),
+                "estimated_after_repair_value": round(a, 2),
+                "potential_profit": round(p, 2),
+                "return_on_investment_percent": round(r, 2),
+            }
+            for l, t, g, tg, n, a, p, r in zip(
+                labour.tolist(), total_project.tolist(), grants, total_grants.tolist(),
+                net_project.tolist(), arv.tolist(), profit.tolist(), roi.tolist())
+        ]
+
+
+def _matched_keywords(renovation_text: str) -> Tuple[str, ...]:
+    """SEAI_GRANT_KEYWORDS found in the renovation text, in configuration order."""
+    return tuple(keyword for keyword in SEAI_GRANT_KEYWORDS if keyword in renovation_text)
+
+
+@lru_cache(maxsize=None)
+def _grant_dicts(keywords: Tuple[str, ...]) -> Tuple[float, Tuple[dict, ...]]:
+    """(total amount, grant dicts) per set of matched keywords; only a few distinct sets occur."""
+    grants = InvestmentCalculator._grants_for_keywords(keywords)
+    return sum(grant.amount for grant in grants), tuple(grant.model_dump(mode='json') for grant in grants)
@@ -1,17 +1,21 @@
 # engine/main.py
+import asyncio
+import logging
 from typing import List, Dict, Any
 from pydantic import ValidationError
 from .models import PropertyListing
 from .enrichment import DataEnricher
 from .scoring import ScoringEngine
+from .spatial_index import PersistentSpatialIndex
+
+log = logging.getLogger(__name__)
 
 class ViabilityEngine:
     """Orchestrates validation, enrichment, and ranking."""
-    def __init__(self, weights: Dict[str, float]):
-        print("Weights: ", weights)
+    def __init__(self, weights: Dict[str, float], spatial_index: PersistentSpatialIndex | None = None):
         self.enricher = DataEnricher()
-        self.scorer = ScoringEngine(weights)
-        print("Viability Engine Initialized.")
+        self.scorer = ScoringEngine(weights, spatial_index=spatial_index)
+        log.info("Viability engine initialized", extra={"weights": weights})
 
     def run(self, raw_properties_data: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Executes the full validation and ranking pipeline."""
@@ -29,6 +33,23 @@ class ViabilityEngine:
             "total_failed_validation": len(validation_errors)
         }
 
+    async def run_async(self, raw_properties_data: List[Dict[str, Any]], session) -> Dict[str, Any]:
+        """Like run(), but every property is enriched concurrently on the given aiohttp session."""
+        validated_properties, validation_errors = self._validate_data(raw_properties_data)
+
+        enriched_data = await asyncio.gather(
+            *(self.enricher.enrich_property_async(session, prop) for prop in validated_properties)
+        )
+
+        ranked_data = self.scorer.rank_properties(list(enriched_data))
+
+        return {
+            "ranked_properties": ranked_data,
+            "validation_errors": validation_errors,
+            "total_processed": len(validated_properties),
+            "total_failed_validation": len(validation_errors)
+        }
+
     def _validate_data(self, raw_data: List[Dict]) -> (List[Dict], List[Dict]):
             """Validates a list of raw property data and returns plain dictionaries."""
             validated, errors = [], []
@@ -0,0 +1,169 @@
+# engine/market_price.py
+"""
+In-process version of the getHousePrice Cloud Function.
+
+Loads houseprice_data.json once and answers the same three ways the function does:
+  exact   - the first town (in file order) whose bounding box contains the point;
+  nearest - otherwise the town whose bounds centre is closest (haversine, km);
+  default - no town has bounds at all.
+
+Single lookups go through a grid of cells listing the boxes that overlap each cell,
+so only a handful of boxes are tested. lookup_many() resolves a whole array of
+points at once with blocked NumPy comparisons against every box and centre.
+"""
+import json
+import logging
+from math import radians, sin, cos, sqrt, atan2, floor, isfinite
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PRICE = "€300,000"
+DEFAULT_TOWN = "Ireland (National Average)"
+EARTH_RADIUS_KM = 6371.0
+
+# Grid cell size for the bounding-box lookup (towns are at most a few km across).
+CELL_DEG = 0.05
+
+# Rows of the (points x towns) distance matrix computed at once in lookup_many.
+_BLOCK_ROWS = 4096
+
+# Candidates this close to the best vectorized distance are re-ranked with the scalar
+# formula, so ties resolve exactly as in the sequential scan.
+_TIE_TOLERANCE_KM = 1e-9
+
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Haversine distance, written exactly as getDistance() in the Cloud Function."""
+    d_lat = radians(lat2 - lat1)
+    d_lon = radians(lon2 - lon1)
+    a = sin(d_lat / 2) * sin(d_lat / 2) + cos(radians(lat1)) * cos(radians(lat2)) * sin(d_lon / 2) * sin(d_lon / 2)
+    return EARTH_RADIUS_KM * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+
+def _distance_km_vec(lat1, lon1, lat2, lon2) -> np.ndarray:
+    d_lat = np.radians(lat2 - lat1)
+    d_lon = np.radians(lon2 - lon1)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(d_lon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+class MarketPriceIndex:
+    """Town price lookup over the houseprice_data.json structure ({county: {"towns": [...]}})."""
+
+    def __init__(self, data: Dict[str, dict]):
+        self.towns: List[Tuple[str, str, str]] = [] # (county, town, price), file order
+        south, west, north, east = [], [], [], []
+        for county, city_data in data.items():
+            for town in (city_data or {}).get("towns") or []:
+                bounds = town.get("bounds")
+                if not bounds:
+                    continue
+                self.towns.append((county, town["town"], town.get("price") or DEFAULT_PRICE))
+                south.append(bounds["southwest"]["lat"])
+                west.append(bounds["southwest"]["lng"])
+                north.append(bounds["northeast"]["lat"])
+                east.append(bounds["northeast"]["lng"])
+
+        self.south = np.array(south, dtype=float)
+        self.west = np.array(west, dtype=float)
+        self.north = np.array(north, dtype=float)
+        self.east = np.array(east, dtype=float)
+        self.centre_lat = (self.north + self.south) / 2
+        self.centre_lon = (self.east + self.west) / 2
+
+        # Boxes overlapping each grid cell, in file order so the first hit wins.
+        self._cells: Dict[Tuple[int, int], List[int]] = {}
+        for i in range(len(self.towns)):
+            for row in range(floor(self.south[i] / CELL_DEG), floor(self.north[i] / CELL_DEG) + 1):
+                for col in range(floor(self.west[i] / CELL_DEG), floor(self.east[i] / CELL_DEG) + 1):
+                    self._cells.setdefault((row, col), []).append(i)
+
+    @classmethod
+    def from_file(cls, path: str) -> "MarketPriceIndex":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self.towns)
+
+    # --- Single lookups ---
+
+    def _exact(self, lat: float, lon: float) -> int:
+        for i in self._cells.get((floor(lat / CELL_DEG), floor(lon / CELL_DEG)), ()):
+            if self.south[i] <= lat <= self.north[i] and self.west[i] <= lon <= self.east[i]:
+                return i
+        return -1
+
+    def _nearest(self, lat: float, lon: float) -> Tuple[int, float]:
+        approx = _distance_km_vec(lat, lon, self.centre_lat, self.centre_lon)
+        best, best_km = -1, float("inf")
+        for i in np.flatnonzero(approx <= approx.min() + _TIE_TOLERANCE_KM):
+            d = distance_km(lat, lon, self.centre_lat[i], self.centre_lon[i])
+            if d < best_km:
+                best, best_km = int(i), d
+        return best, best_km
+
+    def lookup(self, lat: float, lon: float) -> dict:
+        """Same JSON body the Cloud Function would return for ?lat=..&lon=.."""
+        if len(self.towns) and isfinite(lat) and isfinite(lon):
+            i = self._exact(lat, lon)
+            if i >= 0:
+                county, town, price = self.towns[i]
+                return {"town": town, "price": price, "matchType": "exact", "county": county}
+            i, d = self._nearest(lat, lon)
+            county, town, price = self.towns[i]
+            return {"town": town, "price": price, "matchType": "nearest", "county": county,
+                    "distanceKm": floor(d * 10 + 0.5) / 10} # Math.round, not banker's rounding
+        return {"town": DEFAULT_TOWN, "price": DEFAULT_PRICE, "matchType": "default"}
+
+    # --- Batch lookups ---
+
+    def lookup_many(self, lats, lons) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Resolves many points at once. Returns (town index per point, exact-match flag);
+        the index is -1 where the default answer applies.
+        """
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        result = np.full(lats.shape, -1, dtype=np.int64)
+        exact = np.zeros(lats.shape, dtype=bool)
+        if not len(self.towns):
+            return result, exact
+
+        valid = np.flatnonzero(np.isfinite(lats) & np.isfinite(lons))
+        for start in range(0, len(valid), _BLOCK_ROWS):
+            rows = valid[start:start + _BLOCK_ROWS]
+            q_lat, q_lon = lats[rows, None], lons[rows, None]
+
+            inside = (self.south <= q_lat) & (q_lat <= self.north) & (self.west <= q_lon) & (q_lon <= self.east)
+            hit = inside.any(axis=1)
+            result[rows[hit]] = inside[hit].argmax(axis=1)
+            exact[rows[hit]] = True
+
+            missed = rows[~hit]
+            if len(missed):
+                d = _distance_km_vec(lats[missed, None], lons[missed, None], self.centre_lat, self.centre_lon)
+                best = d.argmin(axis=1)
+                result[missed] = best
+                # Near-ties are settled by the scalar formula, as in lookup().
+                ties = (d <= d[np.arange(len(missed)), best][:, None] + _TIE_TOLERANCE_KM).sum(axis=1) > 1
+                for j in np.flatnonzero(ties):
+                    result[missed[j]] = self._nearest(lats[missed[j]], lons[missed[j]])[0]
+        return result, exact
+
+
+_indexes: Dict[str, Optional[MarketPriceIndex]] = {}
+
+
+def load_index(path: str) -> Optional[MarketPriceIndex]:
+    """Loads the shared index for path once; None if the data file is unavailable."""
+    if path not in _indexes:
+        try:
+            _indexes[path] = MarketPriceIndex.from_file(path)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Could not load house price data", extra={"path": path, "error": str(e)})
+            _indexes[path] = None
+    return _indexes[path]
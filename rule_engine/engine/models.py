@@ -55,6 +55,7 @@ class RenovationCost(BaseModel):
     """Represents the full output from the image scanning service."""
     items: List[RenovationItem]
     total_cost: float
+    degraded: bool = False # True when the estimate is a fallback, not a Gemini answer
 
 class Amenity(BaseModel):
     """Represents a single nearby amenity."""
@@ -66,6 +67,7 @@ class AmenityResult(BaseModel):
     """Holds the full results of the amenity search."""
     score: float
     found_amenities: List[Amenity]
+    degraded: bool = False # True when some amenity types could not be searched
 
 class AppliedGrant(BaseModel):
     """Represents a potential grant applied to the project."""
@@ -0,0 +1,455 @@
+# engine/service_client.py
+"""
+Rate limiting, retries and tail-latency control for the external APIs (Places, Air
+Quality, GetHousePrice, Gemini).
+
+Each service gets one ServiceClient, shared by every thread and event loop. Calls
+first take a slot from the service's token bucket, so a run proceeds at the quota's
+sustained rate instead of bursting into 429s. A 429 or 5xx (or a dropped connection)
+is retried with exponential backoff and full jitter; a Retry-After header is honoured,
+and a 429 pauses the whole service, not just the call that hit it.
+
+Every attempt has a timeout and every call an overall deadline, retries included.
+Each endpoint keeps its recent latencies and a circuit breaker: an async call still
+running past the endpoint's p95 gets a duplicate (hedged) request, first answer wins,
+and an endpoint that keeps failing is skipped outright until a probe succeeds. Once a
+call cannot succeed, ServiceError is raised so callers fall back and flag the result
+as degraded.
+"""
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, NamedTuple, Optional
+
+import aiohttp
+import requests
+
+from telemetry import metrics
+
+# Statuses worth retrying: quota exhausted or a transient server-side failure.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Hedging starts once an endpoint has this many latency samples.
+MIN_LATENCY_SAMPLES = 20
+# Never hedge sooner than this, however fast the endpoint usually is.
+MIN_HEDGE_DELAY_S = 0.05
+
+REQUEST_SECONDS = metrics.histogram(
+    "rule_engine_external_request_seconds", "Latency of one attempt at an external service call.",
+    ["service", "outcome"])
+
+
+class ServiceError(Exception):
+    """A service call failed for good (non-retryable status, out of attempts or time, or circuit open)."""
+
+    def __init__(self, service: str, message: str, status: Optional[int] = None):
+        super().__init__(f"{service}: {message}")
+        self.service = service
+        self.status = status
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delay-seconds or HTTP-date form)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket (as a GCRA: one "theoretical arrival time" instead of a
+    token count). Allows `burst` calls at once and `rate_per_s` sustained.
+    """
+
+    def __init__(self, rate_per_s: float, burst: float = 1.0):
+        if rate_per_s <= 0 or burst < 1:
+            raise ValueError("rate_per_s must be positive and burst at least 1")
+        self.interval = 1.0 / rate_per_s
+        self.tolerance = (burst - 1) * self.interval
+        self._tat = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes the next slot; returns how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            self._tat = tat + self.interval
+            return max(0.0, tat - self.tolerance - now)
+
+    def try_reserve(self) -> bool:
+        """Takes a slot only if one is free right now."""
+        with self._lock:
+            now = time.monotonic()
+            tat = max(self._tat, now)
+            if tat - self.tolerance > now:
+                return False
+            self._tat = tat + self.interval
+            return True
+
+    def pause(self, seconds: float):
+        """No slot is handed out for the next `seconds`; afterwards calls resume one interval apart."""
+        with self._lock:
+            self._tat = max(self._tat, time.monotonic() + seconds + self.tolerance)
+
+
+class EndpointHealth:
+    """
+    Recent latencies and a circuit breaker for one endpoint.
+
+    The breaker opens after `failure_threshold` consecutive failures (timeouts, dropped
+    connections, 5xx) and then refuses calls. After `reset_after_s` a single probe is let
+    through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_after_s: float, window: int = 200):
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self._latencies = deque(maxlen=window)
+        self._p95: Optional[float] = None
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_after_s:
+                return False
+            # Half-open: one probe at a time (a probe that never reports back is replaced).
+            if self._probe_started is not None and now - self._probe_started < self.reset_after_s:
+                return False
+            self._probe_started = now
+            return True
+
+    def record_success(self, latency_s: float):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = self._probe_started = None
+            self._latencies.append(latency_s)
+            self._p95 = None
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._probe_started = None
+            if self._consecutive_failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+
+    def p95(self) -> Optional[float]:
+        """95th percentile of recent successful latencies, or None with too few samples."""
+        with self._lock:
+            if len(self._latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            if self._p95 is None:
+                ordered = sorted(self._latencies)
+                self._p95 = ordered[int(0.95 * (len(ordered) - 1))]
+            return self._p95
+
+
+class _Outcome(NamedTuple):
+    """Result of one HTTP attempt; error is None on success."""
+    data: Any = None
+    error: Optional[str] = None
+    status: Optional[int] = None
+    retryable: bool = False
+    retry_after: Optional[float] = None
+
+
+class ServiceClient:
+    def __init__(self, name: str, rate_per_s: float, max_attempts: int = 5,
+                 base_delay_s: float = 0.5, max_delay_s: float = 30.0,
+                 timeout_s: float = 10.0, deadline_s: float = 30.0,
+                 failure_threshold: int = 5, reset_after_s: float = 30.0, hedge_fraction: float = 0.1,
+                 http=None):
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.name = name
+        self.bucket = TokenBucket(rate_per_s, burst=max(1.0, rate_per_s))
+        self.max_attempts = max_attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.timeout_s = timeout_s
+        self.deadline_s = deadline_s
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self.hedge_fraction = hedge_fraction
+        self.http = http or requests # what blocking calls go through when no session is given
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0 # 429 responses
+        self.hedged = 0
+        self.short_circuited = 0
+        self.failures = 0
+
+    def endpoint(self, key: str) -> EndpointHealth:
+        with self._lock:
+            health = self._endpoints.get(key)
+            if health is None:
+                health = self._endpoints[key] = EndpointHealth(self.failure_threshold, self.reset_after_s)
+            return health
+
+    def _admit(self, health: EndpointHealth, deadline: float) -> float:
+        """Slot wait before an attempt; raises ServiceError if the breaker is open or the deadline would pass."""
+        if not health.allow():
+            self._count("short_circuited")
+            raise ServiceError(self.name, "circuit open, endpoint unhealthy")
+        wait = self.bucket.reserve()
+        if time.monotonic() + wait >= deadline:
+            raise self._give_up("deadline exceeded waiting for quota")
+        return wait
+
+    def _attempt_timeout(self, deadline: float) -> float:
+        return max(0.01, min(self.timeout_s, deadline - time.monotonic()))
+
+    def _retry_delay(self, attempt: int, status: Optional[int], retry_after: Optional[float]) -> float:
+        """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+        delay = random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay_s))
+        if status == 429:
+            self._count("throttled")
+            self.bucket.pause(delay) # everyone slows down, not just this caller
+        self._count("retries")
+        return delay
+
+    def _give_up(self, message: str, status: Optional[int] = None) -> ServiceError:
+        self._count("failures")
+        return ServiceError(self.name, message, status)
+
+    def _count(self, counter: str):
+        # Counters are bumped from pipeline threads and the event loop alike.
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _may_hedge(self) -> bool:
+        # Hedges are capped at a fraction of all calls and only use spare quota.
+        with self._lock:
+            if self.hedged >= self.hedge_fraction * self.calls or not self.bucket.try_reserve():
+                return False
+            self.hedged += 1
+            return True
+
+    # --- JSON over HTTP ---
+
+    def _observe(self, started: float, ok: bool):
+        REQUEST_SECONDS.observe(time.monotonic() - started, service=self.name, outcome="ok" if ok else "error")
+
+    def _attempt(self, http, method: str, url: str, health: EndpointHealth, timeout_s: float, kwargs) -> _Outcome:
+        started = time.monotonic()
+        outcome = self._request(http, method, url, health, started, timeout_s, kwargs)
+        self._observe(started, outcome.error is None)
+        return outcome
+
+    def _request(self, http, method: str, url: str, health: EndpointHealth, started: float,
+                 timeout_s: float, kwargs) -> _Outcome:
+        self._count("calls")
+        try:
+            response = http.request(method, url, timeout=timeout_s, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            health.record_failure()
+            return _Outcome(error=str(e), retryable=True)
+        except requests.exceptions.RequestException as e:
+            return _Outcome(error=str(e))
+        if response.ok:
+            try:
+                data = response.json()
+            except ValueError as e:
+                return _Outcome(error=f"invalid JSON: {e}", status=response.status_code)
+            health.record_success(time.monotonic() - started)
+            return _Outcome(data=data)
+        status = response.status_code
+        if status >= 500:
+            health.record_failure()
+        return _Outcome(error=f"HTTP {status}: {response.text[:200]}", status=status,
+                        retryable=status in RETRY_STATUSES,
+                        retry_after=parse_retry_after(response.headers.get("Retry-After")))
+
+    def fetch_json(self, method: str, url: str, session=None, **kwargs):
+        """Blocking call through `session` (or the client's default); returns the decoded JSON body."""
+        http = session or self.http
+        health = self.endpoint(url)
+        deadline = time.monotonic() + self.deadline_s
+        outcome = _Outcome(error="no attempt made")
+        for attempt in range(self.max_attempts):
+            time.sleep(self._admit(health, deadline))
+            outcome = self._attempt(http, method, url, health, self._attempt_timeout(deadline), kwargs)
+            if outcome.error is None:
+                return outcome.data
+            if not outcome.retryable:
+                raise self._give_up(outcome.error, outcome.status)
+            if attempt + 1 == self.max_attempts:
+                break
+            delay = self._retry_delay(attempt, outcome.status, outcome.retry_after)
+            if time.monotonic() + delay >= deadline:
+                raise self._give_up(f"deadline exceeded after {attempt + 1} attempts ({outcome.error})", outcome.status)
+            time.sleep(delay)
+        raise self._give_up(f"gave up after {self.max_attempts} attempts ({outcome.error})", outcome.status)
+
+    async def _attempt_async(self, session: aiohttp.ClientSession, method: str, url: str,
+                             health: EndpointHealth, timeout_s: float, kwargs) -> _Outcome:
+        # A hedged attempt that loses the race is cancelled here and not observed.
+        started = time.monotonic()
+        outcome = await self._request_async(session, method, url, health, started, timeout_s, kwargs)
+        self._observe(started, outcome.error is None)
+        return outcome
+
+    async def _request_async(self, session: aiohttp.ClientSession, method: str, url: str,
+                             health: EndpointHealth, started: float, timeout_s: float, kwargs) -> _Outcome:
+        self._count("calls")
+        try:
+            async with session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout_s), **kwargs) as response:
+                if response.ok:
+                    try:
+                        data = await response.json(content_type=None)
+                    except ValueError as e:
+                        return _Outcome(error=f"invalid JSON: {e}", status=response.status)
+                    health.record_success(time.monotonic() - started)
+                    return _Outcome(data=data)
+                status = response.status
+                error = f"HTTP {status}: {(await response.text())[:200]}"
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            health.record_failure()
+            return _Outcome(error=str(e) or type(e).__name__, retryable=True)
+        if status >= 500:
+            health.record_failure()
+        return _Outcome(error=error, status=status, retryable=status in RETRY_STATUSES, retry_after=retry_after)
+
+    async def _hedged_attempt_async(self, session: aiohttp.ClientSession, method: str, url: str,
+                                    health: EndpointHealth, deadline: float, kwargs) -> _Outcome:
+        """One attempt, plus a duplicate if it is still running after the endpoint's p95."""
+        def start():
+            timeout_s = self._attempt_timeout(deadline)
+            return asyncio.ensure_future(self._attempt_async(session, method, url, health, timeout_s, kwargs))
+
+        tasks = [start()]
+        try:
+            hedge_after = health.p95()
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=max(hedge_after, MIN_HEDGE_DELAY_S))
+                if not done and self._may_hedge():
+                    tasks.append(start())
+
+            outcome, pending = None, set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outcome = task.result()
+                    if outcome.error is None:
+                        return outcome
+            return outcome
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_json_async(self, session: aiohttp.ClientSession, method: str, url: str, **kwargs):
+        """Same as fetch_json, on an aiohttp session, with hedged attempts."""
+        health = self.endpoint(url)
+        deadline = time.monotonic() + self.deadline_s
+        outcome = _Outcome(error="no attempt made")
+        for attempt in range(self.max_attempts):
+            await asyncio.sleep(self._admit(health, deadline))
+            outcome = await self._hedged_attempt_async(session, method, url, health, deadline, kwargs)
+            if outcome.error is None:
+                return outcome.data
+            if not outcome.retryable:
+                raise self._give_up(outcome.error, outcome.status)
+            if attempt + 1 == self.max_attempts:
+                break
+            delay = self._retry_delay(attempt, outcome.status, outcome.retry_after)
+            if time.monotonic() + delay >= deadline:
+                raise self._give_up(f"deadline exceeded after {attempt + 1} attempts ({outcome.error})", outcome.status)
+            await asyncio.sleep(delay)
+        raise self._give_up(f"gave up after {self.max_attempts} attempts ({outcome.error})", outcome.status)
+
+    # --- SDK calls (Gemini) ---
+    # google.api_core errors carry the HTTP status as `.code`. These calls are expensive,
+    # so they are never hedged.
+
+    def call(self, fn, *args, **kwargs):
+        """Blocking SDK call; fn must enforce its own per-attempt timeout."""
+        health = self.endpoint(getattr(fn, "__name__", "call"))
+        deadline = time.monotonic() + self.deadline_s
+        for attempt in range(self.max_attempts):
+            time.sleep(self._admit(health, deadline))
+            self._count("calls")
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._observe(started, False)
+                status = getattr(e, "code", None)
+                if status not in RETRY_STATUSES:
+                    raise
+                if status != 429:
+                    health.record_failure()
+                if attempt + 1 == self.max_attempts:
+                    raise self._give_up(f"gave up after {self.max_attempts} attempts ({e})", status) from e
+                delay = self._retry_delay(attempt, status, None)
+                if time.monotonic() + delay >= deadline:
+                    raise self._give_up(f"deadline exceeded after {attempt + 1} attempts ({e})", status) from e
+                time.sleep(delay)
+            else:
+                self._observe(started, True)
+                health.record_success(time.monotonic() - started)
+                return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        health = self.endpoint(getattr(fn, "__name__", "call"))
+        deadline = time.monotonic() + self.deadline_s
+        for attempt in range(self.max_attempts):
+            await asyncio.sleep(self._admit(health, deadline))
+            self._count("calls")
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(fn(*args, **kwargs), self._attempt_timeout(deadline))
+            except Exception as e:
+                self._observe(started, False)
+                status = 504 if isinstance(e, asyncio.TimeoutError) else getattr(e, "code", None)
+                if status not in RETRY_STATUSES:
+                    raise
+                if status != 429:
+                    health.record_failure()
+                if attempt + 1 == self.max_attempts:
+                    raise self._give_up(f"gave up after {self.max_attempts} attempts ({e!r})", status) from e
+                delay = self._retry_delay(attempt, status, None)
+                if time.monotonic() + delay >= deadline:
+                    raise self._give_up(f"deadline exceeded after {attempt + 1} attempts ({e!r})", status) from e
+                await asyncio.sleep(delay)
+            else:
+                self._observe(started, True)
+                health.record_success(time.monotonic() - started)
+                return result
+
+    def summary(self) -> str:
+        with self._lock:
+            endpoints = list(self._endpoints.values())
+        trips = sum(health.trips for health in endpoints)
+        open_now = sum(health.is_open for health in endpoints)
+        return (f"{self.name:<14} {self.calls:>7} calls, {self.retries} retried, "
+                f"{self.throttled} throttled (429), {self.hedged} hedged, {self.failures} failed, "
+                f"{self.short_circuited} short-circuited ({trips} breaker trips, {open_now} open)")
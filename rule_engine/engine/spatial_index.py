@@ -0,0 +1,376 @@
+# engine/spatial_index.py
+"""
+Grid-bucketed neighbour index for fixed-radius queries over lat/lon points.
+
+Points are hashed into cells that are at least one search radius wide, so every
+neighbour of a point lies in its own cell or one of the eight around it. The
+candidate pairs from those cells are then checked with a vectorized haversine,
+which keeps radius counting close to O(n log n) instead of the O(n²) double loop.
+
+GridIndex is an in-memory index built once per scoring batch; PersistentSpatialIndex
+keeps the same cell layout in SQLite so the whole corpus can be queried across runs.
+"""
+import sqlite3
+import threading
+from math import radians, degrees, sin, cos, asin, sqrt, floor, ceil, isfinite
+from typing import Iterable, List, Set, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+
+# Upper bound on candidate pairs materialised at once (keeps memory flat for dense towns).
+MAX_PAIRS_PER_BLOCK = 2_000_000
+
+# Pairs whose vectorized distance lands this close to the radius are re-checked with
+# the scalar formula, so counts match the pure-Python implementation exactly.
+_BORDER_TOLERANCE_M = 1e-6
+
+# IDs bound per `IN (...)` query, below SQLite's historical limit of 999 variables.
+MAX_IDS_PER_QUERY = 500
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Return distance in metres between two lat/lon coordinates."""
+    R = EARTH_RADIUS_M
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return 2 * R * asin(sqrt(a))
+
+
+def haversine_m_vec(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """NumPy version of haversine_m over equally shaped arrays."""
+    dlat = np.radians(lat2 - lat1)
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class GridIndex:
+    """
+    Static spatial index over a set of points for "how many points within radius_m" queries.
+
+    Points with non-finite coordinates are kept out of the index (they can never be
+    within any radius, matching the behaviour of haversine_m on NaN input).
+    """
+
+    def __init__(self, latitudes, longitudes, radius_m: float):
+        if radius_m <= 0:
+            raise ValueError("radius_m must be positive")
+        self.radius_m = float(radius_m)
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+
+        valid = np.isfinite(self.latitudes) & np.isfinite(self.longitudes)
+        self._valid_ids = np.flatnonzero(valid)
+
+        # Latitude: a great-circle distance d never spans more than d / R radians of latitude.
+        self.cell_lat_deg = degrees(self.radius_m / EARTH_RADIUS_M) * (1 + 1e-6)
+        self.n_cols, self.cell_lon_deg = self._longitude_cells(self.latitudes[valid])
+
+        keys = self._cell_keys(self.latitudes[valid], self.longitudes[valid])
+        order = np.argsort(keys, kind="stable")
+        self._sorted_keys = keys[order]
+        self._sorted_ids = self._valid_ids[order]
+
+    def __len__(self) -> int:
+        return len(self._sorted_ids)
+
+    def _longitude_cells(self, valid_lats: np.ndarray):
+        """Choose a column width that no within-radius pair can span at these latitudes."""
+        if valid_lats.size == 0:
+            return 1, 360.0
+        phi_max = min(90.0, float(np.max(np.abs(valid_lats))) + self.cell_lat_deg)
+        c = cos(radians(phi_max))
+        s = sin(self.radius_m / (2 * EARTH_RADIUS_M)) / c if c > 0 else 2.0
+        if s >= 1.0:
+            return 1, 360.0
+        min_width = degrees(2 * asin(s)) * (1 + 1e-6)
+        # Equal-width columns so that wrapping across the antimeridian stays one column away.
+        n_cols = max(1, int(360.0 // min_width))
+        return n_cols, 360.0 / n_cols
+
+    def _rows_cols(self, lats: np.ndarray, lons: np.ndarray):
+        rows = np.floor((lats + 90.0) / self.cell_lat_deg).astype(np.int64)
+        cols = np.floor(((lons + 180.0) % 360.0) / self.cell_lon_deg).astype(np.int64) % self.n_cols
+        return rows, cols
+
+    def _cell_keys(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        rows, cols = self._rows_cols(lats, lons)
+        return rows * self.n_cols + cols
+
+    def _neighbour_offsets(self):
+        col_offsets = sorted({d % self.n_cols for d in (-1, 0, 1)})
+        return [(dr, dc) for dr in (-1, 0, 1) for dc in col_offsets]
+
+    def count_within(self, query_lats, query_lons, query_ids=None) -> np.ndarray:
+        """
+        Count indexed points within radius_m (inclusive) of each query point.
+
+        query_ids optionally gives, per query, the index of the indexed point that
+        represents the query itself so it is not counted as its own neighbour
+        (use -1 for queries that are not in the index).
+        """
+        q_lats = np.asarray(query_lats, dtype=float)
+        q_lons = np.asarray(query_lons, dtype=float)
+        n_queries = len(q_lats)
+        counts = np.zeros(n_queries, dtype=np.int64)
+        if n_queries == 0 or len(self) == 0:
+            return counts
+        q_self = (np.full(n_queries, -1, dtype=np.int64) if query_ids is None
+                  else np.asarray(query_ids, dtype=np.int64))
+
+        q_valid = np.flatnonzero(np.isfinite(q_lats) & np.isfinite(q_lons))
+        rows, cols = self._rows_cols(q_lats[q_valid], q_lons[q_valid])
+
+        # One candidate range [start, end) into the sorted keys per (query, neighbour cell).
+        starts, lens, owners = [], [], []
+        for dr, dc in self._neighbour_offsets():
+            keys = (rows + dr) * self.n_cols + (cols + dc) % self.n_cols
+            lo = np.searchsorted(self._sorted_keys, keys, side="left")
+            hi = np.searchsorted(self._sorted_keys, keys, side="right")
+            starts.append(lo)
+            lens.append(hi - lo)
+            owners.append(q_valid)
+        starts = np.concatenate(starts)
+        lens = np.concatenate(lens)
+        owners = np.concatenate(owners)
+        keep = lens > 0
+        starts, lens, owners = starts[keep], lens[keep], owners[keep]
+
+        # Materialise candidate pairs in blocks to bound memory in dense clusters.
+        cum = np.cumsum(lens)
+        block_start = 0
+        while block_start < len(lens):
+            base = cum[block_start - 1] if block_start else 0
+            block_end = int(np.searchsorted(cum, base + MAX_PAIRS_PER_BLOCK, side="right"))
+            block_end = max(block_end, block_start + 1)
+            self._count_block(
+                starts[block_start:block_end], lens[block_start:block_end],
+                owners[block_start:block_end], q_lats, q_lons, q_self, counts,
+            )
+            block_start = block_end
+        return counts
+
+    def _count_block(self, starts, lens, owners, q_lats, q_lons, q_self, counts):
+        total = int(lens.sum())
+        q = np.repeat(owners, lens)
+        first = np.repeat(np.cumsum(lens) - lens, lens)
+        cand = self._sorted_ids[np.repeat(starts, lens) + (np.arange(total) - first)]
+
+        d = haversine_m_vec(q_lats[q], q_lons[q], self.latitudes[cand], self.longitudes[cand])
+        not_self = cand != q_self[q]
+        hit = (d <= self.radius_m) & not_self
+
+        border = np.flatnonzero(not_self & (np.abs(d - self.radius_m) <= _BORDER_TOLERANCE_M))
+        for k in border:
+            exact = haversine_m(float(q_lats[q[k]]), float(q_lons[q[k]]),
+                                float(self.latitudes[cand[k]]), float(self.longitudes[cand[k]]))
+            hit[k] = exact <= self.radius_m
+
+        counts += np.bincount(q[hit], minlength=len(counts))
+
+    def neighbour_counts(self) -> np.ndarray:
+        """For every indexed point, count the *other* indexed points within radius_m."""
+        ids = np.arange(len(self.latitudes))
+        return self.count_within(self.latitudes, self.longitudes, query_ids=ids)
+
+
+class PersistentSpatialIndex:
+    """
+    On-disk (SQLite) index of every known property's coordinates, bucketed into
+    fixed cells so a radius query is a handful of B-tree range scans, i.e. O(log n).
+
+    Besides coordinates it remembers the community access/cluster scores each
+    property was last written with. When a property lands near already scored
+    ones, those neighbours are flagged stale so their cluster score can be
+    recomputed lazily against the whole corpus.
+    """
+
+    def __init__(self, path: str, radius_m: float):
+        if radius_m <= 0:
+            raise ValueError("radius_m must be positive")
+        self.path = path
+        self.radius_m = float(radius_m)
+        self.cell_deg = degrees(self.radius_m / EARTH_RADIUS_M) * (1 + 1e-6)
+        self.n_cols = max(1, int(360.0 // self.cell_deg))
+        self.cell_lon_deg = 360.0 / self.n_cols
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS points (
+                property_id   TEXT PRIMARY KEY,
+                latitude      REAL NOT NULL,
+                longitude     REAL NOT NULL,
+                cell_row      INTEGER NOT NULL,
+                cell_col      INTEGER NOT NULL,
+                access_score  REAL,
+                cluster_score REAL,
+                stale         INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_points_cell ON points (cell_row, cell_col);
+            CREATE INDEX IF NOT EXISTS idx_points_stale ON points (stale) WHERE stale = 1;
+        """)
+        self._check_radius()
+
+    def _check_radius(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'radius_m'").fetchone()
+        if row is None:
+            with self._conn:
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('radius_m', ?)", (repr(self.radius_m),))
+        elif float(row[0]) != self.radius_m:
+            raise ValueError(
+                f"Spatial index at '{self.path}' was built for radius {row[0]} m, not {self.radius_m} m. "
+                "Delete it to rebuild."
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM points").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- Cell maths ---
+
+    def _cell(self, lat: float, lon: float):
+        row = floor((lat + 90.0) / self.cell_deg)
+        col = floor(((lon + 180.0) % 360.0) / self.cell_lon_deg) % self.n_cols
+        return row, col
+
+    def _search_cells(self, lat: float, lon: float):
+        """Rows and columns that can hold a point within radius_m of (lat, lon)."""
+        row, col = self._cell(lat, lon)
+        phi_max = min(90.0, abs(lat) + 2 * self.cell_deg)
+        c = cos(radians(phi_max))
+        s = sin(self.radius_m / (2 * EARTH_RADIUS_M)) / c if c > 0 else 2.0
+        if s >= 1.0:
+            cols = list(range(self.n_cols))
+        else:
+            span = int(ceil(degrees(2 * asin(s)) * (1 + 1e-6) / self.cell_lon_deg))
+            cols = sorted({(col + d) % self.n_cols for d in range(-span, span + 1)})
+        return row - 1, row + 1, cols
+
+    def _neighbours_locked(self, lat: float, lon: float, exclude_id: str | None = None) -> List[str]:
+        row_lo, row_hi, cols = self._search_cells(lat, lon)
+        placeholders = ",".join("?" * len(cols))
+        rows = self._conn.execute(
+            f"SELECT property_id, latitude, longitude FROM points "
+            f"WHERE cell_row BETWEEN ? AND ? AND cell_col IN ({placeholders})",
+            (row_lo, row_hi, *cols),
+        ).fetchall()
+        return [
+            pid for pid, plat, plon in rows
+            if pid != exclude_id and haversine_m(lat, lon, plat, plon) <= self.radius_m
+        ]
+
+    # --- Queries ---
+
+    def neighbours(self, lat: float, lon: float, exclude_id: str | None = None) -> List[str]:
+        """IDs of indexed properties within radius_m (inclusive) of the given point."""
+        if not (isfinite(lat) and isfinite(lon)):
+            return []
+        with self._lock:
+            return self._neighbours_locked(float(lat), float(lon), exclude_id)
+
+    def count_within(self, lat: float, lon: float, exclude_id: str | None = None) -> int:
+        return len(self.neighbours(lat, lon, exclude_id))
+
+    def count_within_many(self, property_ids, latitudes, longitudes) -> np.ndarray:
+        """
+        count_within for a whole batch, each property excluding itself. The index is
+        loaded once into a GridIndex and queried in one vectorized pass, which beats
+        per-point queries once the batch is a sizeable part of the corpus.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT property_id, latitude, longitude FROM points").fetchall()
+        position = {pid: i for i, (pid, _, _) in enumerate(rows)}
+        grid = GridIndex([r[1] for r in rows], [r[2] for r in rows], self.radius_m)
+        query_ids = np.array([position.get(str(pid), -1) for pid in property_ids], dtype=np.int64)
+        return grid.count_within(latitudes, longitudes, query_ids=query_ids)
+
+    def location(self, property_id: str):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT latitude, longitude FROM points WHERE property_id = ?", (property_id,)
+            ).fetchone()
+
+    # --- Updates ---
+
+    def upsert(self, points: Iterable[Tuple[str, float, float]], mark_stale: bool = True) -> Set[str]:
+        """
+        Add or move properties. Already scored neighbours of every new or moved
+        point (at both its old and new position) are flagged stale.
+        Returns the IDs that were newly flagged.
+        """
+        flagged: Set[str] = set()
+        with self._lock, self._conn:
+            for property_id, lat, lon in points:
+                if not (isfinite(lat) and isfinite(lon)):
+                    continue
+                property_id, lat, lon = str(property_id), float(lat), float(lon)
+                old = self._conn.execute(
+                    "SELECT latitude, longitude FROM points WHERE property_id = ?", (property_id,)
+                ).fetchone()
+                if old == (lat, lon):
+                    continue
+
+                touched = set()
+                if mark_stale:
+                    touched.update(self._neighbours_locked(lat, lon, property_id))
+                    if old is not None:
+                        touched.update(self._neighbours_locked(old[0], old[1], property_id))
+
+                row, col = self._cell(lat, lon)
+                self._conn.execute(
+                    "INSERT INTO points (property_id, latitude, longitude, cell_row, cell_col) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (property_id) DO UPDATE SET "
+                    "latitude = excluded.latitude, longitude = excluded.longitude, "
+                    "cell_row = excluded.cell_row, cell_col = excluded.cell_col",
+                    (property_id, lat, lon, row, col),
+                )
+                if old is not None:
+                    # A moved property needs its own cluster score refreshed too.
+                    touched.add(property_id)
+                if mark_stale and touched:
+                    flagged.update(self._flag_stale_locked(touched))
+        return flagged
+
+    def _flag_stale_locked(self, ids: Iterable[str]) -> List[str]:
+        ids = list(ids)
+        flagged = []
+        for start in range(0, len(ids), MAX_IDS_PER_QUERY):
+            chunk = ids[start:start + MAX_IDS_PER_QUERY]
+            placeholders = ",".join("?" * len(chunk))
+            flagged.extend(r[0] for r in self._conn.execute(
+                f"SELECT property_id FROM points WHERE property_id IN ({placeholders}) "
+                f"AND access_score IS NOT NULL AND stale = 0",
+                chunk,
+            ))
+        self._conn.executemany("UPDATE points SET stale = 1 WHERE property_id = ?", [(i,) for i in flagged])
+        return flagged
+
+    def record_scores(self, scores: Iterable[Tuple[str, float, float]]):
+        """Remember (property_id, access_score, cluster_score) as written, clearing staleness."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE points SET access_score = ?, cluster_score = ?, stale = 0 WHERE property_id = ?",
+                [(float(a), float(c), str(pid)) for pid, a, c in scores],
+            )
+
+    def mark_all_scored_stale(self) -> int:
+        with self._lock, self._conn:
+            cur = self._conn.execute("UPDATE points SET stale = 1 WHERE access_score IS NOT NULL")
+            return cur.rowcount
+
+    def stale_entries(self, limit: int | None = None) -> List[Tuple[str, float, float, float, float]]:
+        """(property_id, latitude, longitude, access_score, cluster_score) for stale properties."""
+        sql = ("SELECT property_id, latitude, longitude, access_score, cluster_score "
+               "FROM points WHERE stale = 1")
+        with self._lock:
+            if limit is not None:
+                return self._conn.execute(sql + " LIMIT ?", (int(limit),)).fetchall()
+            return self._conn.execute(sql).fetchall()
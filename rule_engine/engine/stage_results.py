@@ -0,0 +1,124 @@
+# engine/stage_results.py
+"""
+Versioned, independently expiring enrichment stage results.
+
+Each stage's output (the fields in STAGE_FIELDS) is stamped in the property's
+`stage_results` map with the stage version, when it was computed, a fingerprint
+of its inputs and whether it is a degraded fallback. A stored stage is stale when
+its stamp or fields are missing, its version was bumped, its inputs changed (the
+property moved, its photos or price changed), it is older than its STAGE_TTL_S,
+or it was degraded. A refresh run recomputes only the stale stages.
+
+Results stored before stamps existed are judged by their fingerprint, taken from
+the inputs stored next to them: still valid when the listing is unchanged and the
+stage has no TTL, stale otherwise.
+"""
+import hashlib
+import json
+import time
+from typing import List, Optional
+
+from config import (
+    STAGE_TTL_S,
+    LABOUR_COST_PERCENTAGE,
+    VACANT_PROPERTY_GRANT_AMOUNT,
+    DERELICT_PROPERTY_TOP_UP_GRANT,
+    SEAI_GRANT_KEYWORDS
+)
+from telemetry import metrics
+
+STALE_STAGES = metrics.counter(
+    "rule_engine_stale_stages_total", "Stored enrichment stages found stale by refresh runs.", ["stage"])
+
+STAGES = ("amenity", "market_average", "air_quality", "renovation", "investment")
+
+# Bump a stage's version when the code computing it changes meaning.
+STAGE_VERSIONS = {stage: 1 for stage in STAGES}
+
+STAGE_FIELDS = {
+    "amenity": ("amenity_details", "amenity_score"),
+    "market_average": ("market_average_price", "price_attractiveness_score"),
+    "air_quality": ("air_quality_score", "air_quality_index", "air_quality_category"),
+    "renovation": ("renovation_details",),
+    "investment": ("investment_analysis",),
+}
+
+# Stage whose fallback the enrichment reports under each degraded_services name.
+STAGE_SERVICES = {"amenity": "places", "market_average": "market_price", "air_quality": "air_quality",
+                  "renovation": "gemini"}
+
+RESULTS_KEY = "stage_results"
+
+
+def _inputs(stage: str, data: dict):
+    if stage in ("amenity", "market_average", "air_quality"):
+        return [round(float(data["latitude"]), 6), round(float(data["longitude"]), 6)]
+    if stage == "renovation":
+        return [str(url) for url in data.get("image_urls") or []]
+    renovation = data.get("renovation_details") or {}
+    return [
+        float(data["listed_price"]), data.get("market_average_price"), renovation.get("total_cost"),
+        [[item.get("item"), item.get("reason")] for item in renovation.get("items") or []],
+        LABOUR_COST_PERCENTAGE, VACANT_PROPERTY_GRANT_AMOUNT, DERELICT_PROPERTY_TOP_UP_GRANT, SEAI_GRANT_KEYWORDS,
+    ]
+
+
+def fingerprint(stage: str, data: dict) -> str:
+    """Hash of what the stage's result depends on, taken from a listing or enriched property."""
+    encoded = json.dumps(_inputs(stage, data), sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def stamp(data: dict, stage: str, degraded: bool = False, now: Optional[float] = None) -> dict:
+    """Records that `stage` was just computed for `data` (an enriched property)."""
+    data.setdefault(RESULTS_KEY, {})[stage] = {
+        "version": STAGE_VERSIONS[stage],
+        "computed_at": time.time() if now is None else now,
+        "fingerprint": fingerprint(stage, data),
+        "degraded": degraded,
+    }
+    return data
+
+
+def is_stale(stage: str, stored: dict, listing: dict, now: Optional[float] = None) -> bool:
+    if any(stored.get(field) is None for field in STAGE_FIELDS[stage]):
+        return True
+    current = listing if stage != "investment" else {**stored, **listing}
+    meta = (stored.get(RESULTS_KEY) or {}).get(stage)
+    if meta is None:
+        return STAGE_TTL_S[stage] is not None or fingerprint(stage, stored) != fingerprint(stage, current)
+    if meta.get("version") != STAGE_VERSIONS[stage] or meta.get("degraded"):
+        return True
+    if meta.get("fingerprint") != fingerprint(stage, current):
+        return True
+    ttl_s = STAGE_TTL_S[stage]
+    now = time.time() if now is None else now
+    return ttl_s is not None and now - float(meta.get("computed_at") or 0) > ttl_s
+
+
+def stale_stages(stored: dict, listing: dict, now: Optional[float] = None) -> List[str]:
+    """Stages of a stored result that must be recomputed for the current listing, in STAGES order."""
+    stale = [stage for stage in STAGES if is_stale(stage, stored, listing, now)]
+    for stage in stale:
+        STALE_STAGES.inc(stage=stage)
+    return stale
+
+
+def carry_over(enriched: dict, stored: dict, stages) -> dict:
+    """Copies the stored fields and stamps of `stages` into a freshly validated property."""
+    stored_results = stored.get(RESULTS_KEY) or {}
+    for stage in stages:
+        for field in STAGE_FIELDS[stage]:
+            enriched[field] = stored[field]
+        if stage in stored_results:
+            enriched.setdefault(RESULTS_KEY, {})[stage] = stored_results[stage]
+        else:
+            # Adopted from before stamps existed; fingerprinted from the stored inputs.
+            stamp(enriched, stage, now=0.0)
+            enriched[RESULTS_KEY][stage]["fingerprint"] = fingerprint(stage, stored)
+    return enriched
+
+
+def degraded_services(enriched: dict) -> List[str]:
+    results = enriched.get(RESULTS_KEY) or {}
+    return [service for stage, service in STAGE_SERVICES.items() if (results.get(stage) or {}).get("degraded")]
@@ -0,0 +1,281 @@
+# firestore_writer.py
+"""
+Write-behind bulk writer for scoring results.
+
+Score updates (`properties`) and full result sets (`validity_data`) are queued and
+packed into BatchWrite RPCs of up to 500 operations. Full batches are committed
+concurrently with a bound on how many are in flight; BatchWrite reports a status
+per write, so only the operations that failed with a transient error are retried.
+
+Works unchanged against the Firestore emulator (set FIRESTORE_EMULATOR_HOST).
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from google.cloud.firestore_v1.bulk_batch import BulkWriteBatch
+
+from constants import COLLECTION_NAME, COLLECTION_NAME_VALIDITY_DATA, FIELD_NAMES_RE, FIELD_NAMES_FE
+from telemetry import metrics
+
+log = logging.getLogger(__name__)
+
+COMMIT_SECONDS = metrics.histogram(
+    "rule_engine_firestore_commit_seconds", "Latency of one BatchWrite RPC, by result.", ["result"])
+WRITES = metrics.counter(
+    "rule_engine_firestore_writes_total", "Firestore write operations by result: ok, failed, or retried (per retry).", ["result"])
+
+# Firestore's limit on writes per BatchWrite request.
+MAX_BATCH_OPERATIONS = 500
+
+# gRPC status codes worth retrying (ABORTED, UNAVAILABLE, RESOURCE_EXHAUSTED, DEADLINE_EXCEEDED, INTERNAL).
+UNAVAILABLE = 14
+RETRYABLE_CODES = {10, UNAVAILABLE, 8, 4, 13}
+
+
+class _Operation:
+    __slots__ = ("kind", "doc_ref", "data", "merge", "item_key")
+
+    def __init__(self, kind: str, doc_ref, data: dict, merge: bool, item_key: Optional[str]):
+        self.kind = kind
+        self.doc_ref = doc_ref
+        self.data = data
+        self.merge = merge
+        self.item_key = item_key
+
+    def apply(self, batch: BulkWriteBatch):
+        if self.kind == "update":
+            batch.update(self.doc_ref, self.data)
+        else:
+            batch.set(self.doc_ref, self.data, merge=self.merge)
+
+
+class BulkScoreWriter:
+    """
+    Queues Firestore writes and commits them in full-size, concurrent batches.
+
+    Call flush() at chunk boundaries to push out a partial batch and wait for
+    everything in flight, and close() at the end of a run.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_batch_operations: int = MAX_BATCH_OPERATIONS,
+        max_in_flight: int = 4,
+        max_attempts: int = 5,
+        base_backoff_s: float = 0.5,
+    ):
+        self.db = db
+        self.max_batch_operations = min(max_batch_operations, MAX_BATCH_OPERATIONS)
+        self.max_attempts = max_attempts
+        self.base_backoff_s = base_backoff_s
+
+        self._pending: List[_Operation] = []
+        self._pending_paths = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight_paths: Dict[str, int] = {}
+        self._in_flight_batches = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="bulk-writer")
+
+        # Per-item bookkeeping so callers hear about an item only once all its writes landed.
+        self._item_remaining: Dict[str, int] = {}
+        self._item_failed = set()
+        self._item_callbacks: Dict[str, List[Callable[[], None]]] = {}
+
+        self.written_operations = 0
+        self.failed_operations = 0
+        self.committed_batches = 0
+        self.failed_items: List[str] = []
+
+    # --- Queueing ---
+
+    def write_scores(self, item: dict, on_committed: Optional[Callable[[], None]] = None):
+        """Queue the two writes for a scored property (score fields + full validity data)."""
+        item_id = item[FIELD_NAMES_RE.ID.value]
+        properties_ref = self.db.collection(COLLECTION_NAME).document(item_id)
+        validity_ref = self.db.collection(COLLECTION_NAME_VALIDITY_DATA).document(item_id)
+        scores = {
+            FIELD_NAMES_FE.VALIDITY_SCORE.value: item[FIELD_NAMES_RE.VALIDITY_SCORE.value],
+            FIELD_NAMES_FE.COMMUNITY_SCORE.value: item[FIELD_NAMES_RE.COMMUNITY_SCORE.value],
+            FIELD_NAMES_FE.NEEDS_SCORING.value: False,
+        }
+        if item.get(FIELD_NAMES_RE.LISTING_FINGERPRINT.value):
+            scores[FIELD_NAMES_FE.LISTING_FINGERPRINT.value] = item[FIELD_NAMES_RE.LISTING_FINGERPRINT.value]
+        ops = [
+            _Operation("update", properties_ref, scores, False, item_id),
+            _Operation("set", validity_ref, item, False, item_id),
+        ]
+        self._enqueue_item(item_id, ops, on_committed)
+
+    def write_item(self, item_key: str, writes: List[Tuple[str, Any, dict, bool]],
+                   on_committed: Optional[Callable[[], None]] = None):
+        """
+        Queue several writes belonging to one item, each as (kind, doc_ref, data, merge)
+        with kind "set" or "update". on_committed runs once all of them have landed
+        (never if one fails; the item is then listed in failed_items), and before a
+        later write to the same documents is sent, so the callbacks of items sharing a
+        document run in the order the items were queued. It must not queue writes.
+        """
+        ops = [_Operation(kind, doc_ref, data, merge, item_key) for kind, doc_ref, data, merge in writes]
+        self._enqueue_item(item_key, ops, on_committed)
+
+    def _enqueue_item(self, item_key: str, ops: List[_Operation], on_committed: Optional[Callable[[], None]]):
+        with self._lock:
+            self._item_remaining[item_key] = self._item_remaining.get(item_key, 0) + len(ops)
+            if on_committed is not None:
+                self._item_callbacks.setdefault(item_key, []).append(on_committed)
+        for op in ops:
+            self._enqueue(op)
+
+    def update(self, doc_ref, data: dict):
+        self._enqueue(_Operation("update", doc_ref, data, False, None))
+
+    def set(self, doc_ref, data: dict, merge: bool = False):
+        self._enqueue(_Operation("set", doc_ref, data, merge, None))
+
+    def _enqueue(self, op: _Operation):
+        path = op.doc_ref.path
+        with self._lock:
+            # BatchWrite allows one write per document and gives no ordering between
+            # batches, so a second write to a document waits for the first to land.
+            if path in self._pending_paths or path in self._in_flight_paths:
+                batch = self._take_pending_locked()
+                if batch:
+                    self._lock.release()
+                    try:
+                        self._submit(batch)
+                    finally:
+                        self._lock.acquire()
+                while path in self._in_flight_paths:
+                    self._idle.wait()
+            self._pending.append(op)
+            self._pending_paths.add(path)
+            batch = self._take_pending_locked() if len(self._pending) >= self.max_batch_operations else None
+        if batch:
+            self._submit(batch)
+
+    def _take_pending_locked(self) -> List[_Operation]:
+        batch, self._pending = self._pending, []
+        self._pending_paths = set()
+        for op in batch:
+            path = op.doc_ref.path
+            self._in_flight_paths[path] = self._in_flight_paths.get(path, 0) + 1
+        if batch:
+            self._in_flight_batches += 1
+        return batch
+
+    def _submit(self, batch: List[_Operation]):
+        # Blocks the producer once max_in_flight batches are committing (backpressure).
+        self._slots.acquire()
+        self._executor.submit(self._run_batch, batch)
+
+    # --- Committing ---
+
+    def _run_batch(self, ops: List[_Operation]):
+        try:
+            succeeded, failed = self._commit_with_retries(ops)
+        except Exception as e:
+            log.error("Bulk write failed", exc_info=True, extra={"operations": len(ops), "error": str(e)})
+            succeeded, failed = [], ops
+        finally:
+            self._slots.release()
+
+        callbacks = []
+        with self._lock:
+            self.committed_batches += 1
+            self.written_operations += len(succeeded)
+            self.failed_operations += len(failed)
+            WRITES.inc(len(succeeded), result="ok")
+            WRITES.inc(len(failed), result="failed")
+            for op in failed:
+                if op.item_key is not None and op.item_key not in self._item_failed:
+                    self._item_failed.add(op.item_key)
+                    self.failed_items.append(op.item_key)
+            for op in ops:
+                if op.item_key is not None:
+                    self._item_remaining[op.item_key] -= 1
+                    if not self._item_remaining[op.item_key]:
+                        del self._item_remaining[op.item_key]
+                        item_callbacks = self._item_callbacks.pop(op.item_key, [])
+                        if op.item_key in self._item_failed:
+                            self._item_failed.discard(op.item_key)
+                        else:
+                            callbacks.extend(item_callbacks)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                log.warning("Bulk writer commit callback failed", exc_info=True, extra={"error": str(e)})
+        # Only now, so flush() returns once the commit callbacks have run too, and a later
+        # write to one of these documents (and its callbacks) waits for these callbacks.
+        with self._lock:
+            for op in ops:
+                path = op.doc_ref.path
+                self._in_flight_paths[path] -= 1
+                if not self._in_flight_paths[path]:
+                    del self._in_flight_paths[path]
+            self._in_flight_batches -= 1
+            self._idle.notify_all()
+
+    def _commit_with_retries(self, ops: List[_Operation]):
+        succeeded: List[_Operation] = []
+        failed: List[_Operation] = []
+        remaining = ops
+        for attempt in range(1, self.max_attempts + 1):
+            batch = BulkWriteBatch(self.db)
+            for op in remaining:
+                op.apply(batch)
+            started = time.perf_counter()
+            try:
+                response = batch.commit()
+                statuses = [status.code for status in response.status]
+                COMMIT_SECONDS.observe(time.perf_counter() - started, result="ok")
+            except Exception as e:
+                # The RPC itself failed: nothing was applied, every operation is retryable.
+                COMMIT_SECONDS.observe(time.perf_counter() - started, result="error")
+                log.warning("BatchWrite attempt failed", extra={"attempt": attempt, "error": str(e)})
+                statuses = [UNAVAILABLE] * len(remaining)
+
+            retry = []
+            for op, code in zip(remaining, statuses):
+                if code == 0:
+                    succeeded.append(op)
+                elif code in RETRYABLE_CODES:
+                    retry.append(op)
+                else:
+                    log.error("Write rejected", extra={"path": op.doc_ref.path, "status": code})
+                    failed.append(op)
+            if not retry:
+                return succeeded, failed
+            remaining = retry
+            if attempt < self.max_attempts:
+                WRITES.inc(len(retry), result="retried")
+                time.sleep(self.base_backoff_s * (2 ** (attempt - 1)) * (1 + random.random()))
+
+        log.error("Giving up on writes", extra={"writes": len(remaining), "attempts": self.max_attempts})
+        return succeeded, failed + remaining
+
+    # --- Lifecycle hooks ---
+
+    def flush(self):
+        """Commit the partial batch and block until every in-flight batch has finished."""
+        with self._lock:
+            batch = self._take_pending_locked()
+        if batch:
+            self._submit(batch)
+        with self._lock:
+            while self._in_flight_batches:
+                self._idle.wait()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        log.info("Bulk writer closed", extra={
+            "writes": self.written_operations, "batches": self.committed_batches, "failed": self.failed_operations})
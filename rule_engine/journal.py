@@ -0,0 +1,202 @@
+# journal.py
+"""
+Crash-safe checkpoint journal for the batch enrichment.
+
+Every time a property finishes a costly stage (the HTTP lookups, the Gemini
+renovation estimate, scoring) its output is appended to a local file and
+fsync'd before it moves on; once its Firestore write is committed that is
+recorded too. A run that dies midway loses nothing it paid for: on restart each
+journaled property re-enters the pipeline at the stage after its last checkpoint,
+without reading Firestore or calling any external service again. A property
+whose write failed stays journaled as scored, so the next run only retries the
+write.
+
+One JSON record per line, prefixed with its CRC32. A line torn by a crash (or
+otherwise corrupt) fails the check and is ignored; a torn last line is cut off
+on load so new records are not appended to it. Only each property's latest
+record matters, so once the file holds COMPACT_RATIO times more lines than live
+properties it is rewritten with just those (atomically, via a temp file and
+rename). Checkpoints older than max_age_s are dropped at load and compaction, as
+their lookups would be stale by then anyway.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+from telemetry import metrics
+
+log = logging.getLogger(__name__)
+
+JOURNAL_RECORDS = metrics.counter(
+    "rule_engine_journal_records_total", "Checkpoints appended to the enrichment journal, by stage.", ["stage"])
+JOURNAL_RESUMED = metrics.counter(
+    "rule_engine_journal_resumed_total", "Properties resumed from the journal, by last completed stage.", ["stage"])
+
+# Checkpoints in pipeline order; a property resumes after the last one it reached.
+STAGES = ("lookups", "renovation", "scored")
+WRITTEN = "written"
+
+# Marker carried by a resumed item so stages it already completed pass it through.
+RESUME_KEY = "_journal_stage"
+
+# Rewrite the file once it holds this many lines per live property (and at least COMPACT_MIN_LINES).
+COMPACT_RATIO = 4
+COMPACT_MIN_LINES = 10_000
+
+
+def _encode(record: dict) -> bytes:
+    payload = json.dumps(record, separators=(",", ":"), default=str).encode("utf-8")
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+
+def _decode(line: bytes) -> Optional[dict]:
+    crc, _, payload = line.rstrip(b"\n").partition(b" ")
+    try:
+        if int(crc, 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+class CheckpointJournal:
+    def __init__(self, path: str, fsync: bool = True, max_age_s: float = 7 * 86400):
+        self.path = path
+        self.fsync = fsync
+        self.max_age_s = max_age_s
+        self._lock = threading.Lock()
+        self._live: Dict[str, dict] = {} # property_id -> latest record (never WRITTEN)
+        self._lines = 0
+        self.corrupt_lines = 0
+        self._load()
+        self._file = open(path, "ab")
+
+    # --- Recovery ---
+
+    def _load(self):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        cutoff = time.time() - self.max_age_s
+        complete = 0 # bytes up to the end of the last newline-terminated line
+        with f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn by a crash mid-append: cut it off, or the next append would be
+                    # glued onto it and lost with it.
+                    self.corrupt_lines += 1
+                    os.truncate(self.path, complete)
+                    break
+                complete += len(line)
+                self._lines += 1
+                record = _decode(line)
+                if record is None:
+                    self.corrupt_lines += 1
+                    continue
+                if record["stage"] == WRITTEN or record["ts"] < cutoff:
+                    self._live.pop(record["id"], None)
+                else:
+                    self._live[record["id"]] = record
+        if self.corrupt_lines:
+            log.warning("Ignored corrupt journal lines", extra={"path": self.path, "lines": self.corrupt_lines})
+        log.info("Enrichment journal loaded", extra={
+            "path": self.path, "resumable": len(self._live),
+            **{f"at_{stage}": sum(r["stage"] == stage for r in self._live.values()) for stage in STAGES}})
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._live)
+
+    def resume(self, property_id: str) -> Optional[dict]:
+        """The property's last checkpointed output, marked with its stage, or None to start afresh."""
+        with self._lock:
+            record = self._live.get(property_id)
+        if record is None:
+            return None
+        JOURNAL_RESUMED.inc(stage=record["stage"])
+        item = json.loads(json.dumps(record["data"])) # a private copy, stages mutate their items
+        item[RESUME_KEY] = record["stage"]
+        return item
+
+    @staticmethod
+    def reached(item: dict, stage: str) -> bool:
+        """True when a resumed item already completed `stage` (so the stage must pass it through)."""
+        done = item.get(RESUME_KEY)
+        return done is not None and STAGES.index(done) >= STAGES.index(stage)
+
+    @staticmethod
+    def unmark(item: dict) -> dict:
+        """Drops the resume marker once an item runs a stage for real (it must never be written)."""
+        item.pop(RESUME_KEY, None)
+        return item
+
+    # --- Appending ---
+
+    def checkpoint(self, property_id: str, stage: str, item: dict) -> dict:
+        """Durably records `item` as the output of `stage`; returns it without the resume marker."""
+        self.unmark(item)
+        data = {k: v for k, v in item.items() if not k.startswith("_")}
+        self._append({"id": property_id, "stage": stage, "ts": time.time(), "data": data})
+        JOURNAL_RECORDS.inc(stage=stage)
+        return item
+
+    def mark_written(self, property_id: str):
+        self._append({"id": property_id, "stage": WRITTEN, "ts": time.time()})
+        JOURNAL_RECORDS.inc(stage=WRITTEN)
+
+    def _append(self, record: dict):
+        line = _encode(record)
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._lines += 1
+            if record["stage"] == WRITTEN:
+                self._live.pop(record["id"], None)
+            else:
+                self._live[record["id"]] = record
+            if self._lines >= max(COMPACT_MIN_LINES, COMPACT_RATIO * len(self._live)):
+                self._compact_locked()
+
+    # --- Compaction ---
+
+    def compact(self):
+        with self._lock:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        cutoff = time.time() - self.max_age_s
+        live = {pid: r for pid, r in self._live.items() if r["ts"] >= cutoff}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wb") as f:
+            for record in live.values():
+                f.write(_encode(record))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp, self.path)
+        self._fsync_dir()
+        self._file = open(self.path, "ab")
+        log.debug("Enrichment journal compacted", extra={"lines_before": self._lines, "lines_after": len(live)})
+        self._live, self._lines = live, len(live)
+
+    def _fsync_dir(self):
+        if not self.fsync or not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Compacts (so finished properties leave the file) and closes the journal."""
+        with self._lock:
+            self._compact_locked()
+            self._file.close()
@@ -1,19 +1,59 @@
 # main.py
 
+import sys
 import json
-from math import ceil
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+import asyncio
+import logging
+from functools import partial
+from typing import List
 
-from engine import ViabilityEngine
-from engine.enrichment import DataEnricher # We need direct access to the enricher
-from data_loader import initialize_firebase, load_from_firestore
-from config import SCORING_WEIGHTS
+import aiohttp
+import numpy as np
+import pandas as pd
+
+from engine import ViabilityEngine, external_services
+from engine.investment_calculator import InvestmentCalculator
+from engine.scoring import CLUSTER_RADIUS_M, ScoringEngine
+from engine.spatial_index import PersistentSpatialIndex
+from data_loader import initialize_firebase, load_from_firestore, listing_fingerprint, LISTING_INPUT_PATHS
+from firestore_writer import BulkScoreWriter
+from journal import CheckpointJournal
+from sharding import IdRange, ShardLeaser
+from pipeline import AsyncStage, Pipeline, Stage
+from config import MAPS_API_KEY, SCORING_WEIGHTS, SPATIAL_INDEX_PATH, DISCOVERY_MODE, DISCOVERY_PAGE_SIZE
+from config import LOG_LEVEL, LOG_FORMAT, METRICS_TEXTFILE_PATH, METRICS_EXPORT_INTERVAL_S, RUN_REPORT_PATH
+from config import JOURNAL_PATH, JOURNAL_FSYNC, JOURNAL_MAX_AGE_S, STAGE_TTL_S
+from config import SHARD_COUNT, SHARDS_PER_CLAIM, SHARD_LEASE_S, SHARD_HEARTBEAT_S, SHARD_WORKER_ID
 from constants import COLLECTION_NAME, COLLECTION_NAME_VALIDITY_DATA, FIELD_NAMES_RE, FIELD_NAMES_FE
 from firebase_admin import firestore
+from telemetry import metrics, configure_logging, PeriodicExporter
+
+log = logging.getLogger(__name__)
 
 # --- Configuration for Batch Processing ---
-CHUNK_SIZE = 10 # Increase chunk size for more parallelism. 10 is a good starting point.
-MAX_WORKERS = 10 # The number of properties to process in parallel. Match this to CHUNK_SIZE.
+# Worker threads per pipeline stage. Size each to its bottleneck: Firestore reads are
+# cheap, the CPU stages need few.
+STAGE_WORKERS = {
+    "load": 4,
+    "investment": 2,
+}
+# Properties in flight at once in the asyncio stages. Lookups fan out into a handful of
+# concurrent HTTP calls each; image downloads are further bounded by the image memory
+# budget (IMAGE_MEMORY_BUDGET_MB); Gemini is quota-bound.
+ASYNC_STAGE_CONCURRENCY = {
+    "lookups": 500,
+    "images": 100,
+    "gemini": 20,
+    "refresh": 100, # --refresh: a property's stale lookups, images and Gemini call in one go.
+}
+HTTP_CONNECTION_LIMIT = 1000 # Open sockets shared by every request of an async stage.
+STAGE_QUEUE_SIZE = 32 # Bounded hand-off between stages (backpressure).
+SCORING_BATCH_SIZE = 25 # Enriched properties are scored in small groups...
+SCORING_BATCH_TIMEOUT_S = 2.0 # ...but never held back longer than this.
+RESCORE_EVERY = 100 # Refresh stale neighbour cluster scores after this many writes.
+RESCORE_PAGE_SIZE = 1000 # validity_data documents per read in rescore-only mode.
+RESCORE_FRAME_ROWS = 50_000 # Stored results scored (and held in memory) at once in rescore-only mode.
 
 # --- Firestore Functions (unchanged) ---
 
@@ -22,6 +62,7 @@ def _update_firestore_properties(batch, db, doc_id: str, vs: float, cs: float):
     batch.update(doc_ref, {
         FIELD_NAMES_FE.VALIDITY_SCORE.value: vs,
         FIELD_NAMES_FE.COMMUNITY_SCORE.value: cs,
+        FIELD_NAMES_FE.NEEDS_SCORING.value: False,
     })
 
 def _save_full_data(batch, db, doc_id: str, item: dict):
@@ -37,123 +78,609 @@ def update_properties_in_transaction(db, item: dict):
     _save_full_data(batch, db, item_id, item)
     batch.commit()
 
-def merge_into_firestore(item: dict):
+def merge_into_firestore(item: dict) -> bool:
     try:
         db = firestore.client()
         update_properties_in_transaction(db, item)
+        return True
     except Exception as e:
         item_id = item.get(FIELD_NAMES_RE.ID.value, "N/A")
-        print(f"    -> ERROR: Failed to merge item ID {item_id} into Firestore: {e}")
+        log.error("Failed to merge item into Firestore", extra={"item_id": item_id, "error": str(e)})
+        return False
+
+# --- Discovery of unprocessed properties (streaming) ---
+
+def _iter_pages(query, page_size: int):
+    """Streams a query page by page using document-ID cursors."""
+    query = query.order_by("__name__").limit(page_size)
+    last_doc = None
+    while True:
+        page = list((query.start_after(last_doc) if last_doc else query).stream())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_doc = page[-1]
+
+def _collection_range(db, collection_name: str, id_range: IdRange = (None, None)):
+    """The collection restricted to document IDs in [lower, upper) (a shard's slice)."""
+    collection = db.collection(collection_name)
+    query, (lower, upper) = collection, id_range
+    if lower is not None:
+        query = query.where(filter=firestore.FieldFilter("__name__", ">=", collection.document(lower)))
+    if upper is not None:
+        query = query.where(filter=firestore.FieldFilter("__name__", "<", collection.document(upper)))
+    return query
+
+def get_documents_without_a_field(db, collection_name: str, field_name: str, page_size: int = DISCOVERY_PAGE_SIZE,
+                                  id_range: IdRange = (None, None)):
+    """
+    Yields documents missing field_name. Only that one field is transferred, and
+    results are yielded as each page arrives instead of after a full collection scan.
+    """
+    query = _collection_range(db, collection_name, id_range).select([field_name])
+    for page in _iter_pages(query, page_size):
+        for doc in page:
+            if field_name not in doc.to_dict():
+                yield doc
+
+def get_documents_needing_scoring(db, collection_name: str, page_size: int = DISCOVERY_PAGE_SIZE,
+                                  id_range: IdRange = (None, None)):
+    """Yields documents flagged needsScoring == true; the server does the filtering."""
+    query = (
+        _collection_range(db, collection_name, id_range)
+        .where(filter=firestore.FieldFilter(FIELD_NAMES_FE.NEEDS_SCORING.value, "==", True))
+        .select(["__name__"])
+    )
+    for page in _iter_pages(query, page_size):
+        yield from page
 
-def get_documents_without_a_field(db, collection_name: str, field_name: str):
-    docs = db.collection(collection_name).stream()
-    return [doc for doc in docs if field_name not in doc.to_dict()]
+def get_documents_with_changed_listings(db, collection_name: str, page_size: int = DISCOVERY_PAGE_SIZE,
+                                        id_range: IdRange = (None, None)):
+    """
+    Yields unscored documents and those whose listing fingerprint no longer matches the
+    one written with their scores. Only the listing inputs are transferred, and rewrites
+    that leave them unchanged (scraper refreshes, image migrations) are skipped.
+    """
+    score_field, fingerprint_field = FIELD_NAMES_FE.VALIDITY_SCORE.value, FIELD_NAMES_FE.LISTING_FINGERPRINT.value
+    query = _collection_range(db, collection_name, id_range).select(LISTING_INPUT_PATHS + [score_field, fingerprint_field])
+    counts = {"unscored": 0, "changed": 0, "unchanged": 0}
+    for page in _iter_pages(query, page_size):
+        for doc in page:
+            data = doc.to_dict()
+            if score_field not in data:
+                counts["unscored"] += 1
+            elif data.get(fingerprint_field) != listing_fingerprint(data):
+                counts["changed"] += 1
+            else:
+                counts["unchanged"] += 1
+                continue
+            yield doc
+    log.info("Listing change detection complete", extra=counts)
 
-def query_no_validity(db):
+def query_no_validity(db, id_range: IdRange = (None, None)):
+    if DISCOVERY_MODE == "marker":
+        return get_documents_needing_scoring(db, COLLECTION_NAME, id_range=id_range)
+    if DISCOVERY_MODE == "fingerprint":
+        return get_documents_with_changed_listings(db, COLLECTION_NAME, id_range=id_range)
     return get_documents_without_a_field(
-        db, COLLECTION_NAME, FIELD_NAMES_FE.VALIDITY_SCORE.value
+        db, COLLECTION_NAME, FIELD_NAMES_FE.VALIDITY_SCORE.value, id_range=id_range
     )
 
-# --- NEW: Worker function for parallel processing ---
+def mark_unscored_for_scoring(db):
+    """One-off backfill of the needsScoring marker for documents without a validityScore."""
+    marked = 0
+    batch = db.batch()
+    for doc in get_documents_without_a_field(db, COLLECTION_NAME, FIELD_NAMES_FE.VALIDITY_SCORE.value):
+        batch.update(doc.reference, {FIELD_NAMES_FE.NEEDS_SCORING.value: True})
+        marked += 1
+        if marked % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    log.info("Marked properties as needing scoring", extra={"marked": marked})
+
+# --- Corpus-wide spatial index for community cluster scores ---
 
-def process_single_property(enricher: DataEnricher, property_data: dict) -> dict | None:
+def _iter_property_coordinates(db):
+    for doc in db.collection(COLLECTION_NAME).select(["location.coordinates"]).stream():
+        coords = (doc.to_dict().get("location") or {}).get("coordinates") or []
+        if len(coords) == 2:
+            yield doc.id, coords[1], coords[0]
+
+def backfill_spatial_index(db, spatial_index: PersistentSpatialIndex):
     """
-    Worker function that enriches a single property.
-    Designed to be run in a separate thread.
-    Includes error handling to prevent one failure from stopping the entire batch.
+    Seeds an empty spatial index with every property's coordinates (only the
+    location field is read) plus the community scores already written. Existing
+    scores were computed per chunk, so they are all flagged for lazy rescoring.
     """
-    prop_id = property_data.get("property_id", "Unknown")
-    try:
-        # This is the slow, network-intensive part.
-        return enricher.enrich_property(property_data)
-    except Exception as e:
-        print(f"  -> ERROR processing property {prop_id}. It will be skipped. Reason: {e}")
-        return None
+    log.info("Seeding spatial index with the coordinates of every known property")
+    spatial_index.upsert(_iter_property_coordinates(db), mark_stale=False)
 
-# --- Main Batch Processing Logic (Updated for Parallelism) ---
+    scored = []
+    fields = ["community_access_score", "community_cluster_score"]
+    for doc in db.collection(COLLECTION_NAME_VALIDITY_DATA).select(fields).stream():
+        data = doc.to_dict()
+        if all(data.get(f) is not None for f in fields):
+            scored.append((doc.id, data["community_access_score"], data["community_cluster_score"]))
+    spatial_index.record_scores(scored)
+    flagged = spatial_index.mark_all_scored_stale()
+    log.info("Spatial index seeded", extra={"properties": len(spatial_index), "queued_for_rescoring": flagged})
 
-def run_batch_analysis():
+def rescore_stale_neighbours(writer: BulkScoreWriter, engine: ViabilityEngine):
     """
-    Fetches all unprocessed properties and analyzes them in parallel, resilient chunks,
-    saving progress after each chunk.
+    Refreshes the community scores of already-scored properties whose cluster
+    neighbourhood changed since they were written. Only changed scores are stored.
+    The index learns a refreshed score only once its write is committed, so a
+    failed write leaves the property flagged for the next rescore.
     """
-    print("--- Starting Parallel Batch Property Viability Analysis ---")
-    
-    db = initialize_firebase()
-    
-    print("Querying Firestore for all properties that need analysis...")
-    all_unprocessed_docs = query_no_validity(db)
-    
-    if not all_unprocessed_docs:
-        print("No new properties to process. System is up-to-date.")
+    changed, refreshed = engine.scorer.rescore_stale_clusters()
+    if not refreshed:
         return
 
-    total_docs = len(all_unprocessed_docs)
-    total_chunks = ceil(total_docs / CHUNK_SIZE)
-    print(f"Found {total_docs} properties. Processing in {total_chunks} chunks of size {CHUNK_SIZE} with {MAX_WORKERS} parallel workers.")
-    
-    engine = ViabilityEngine(weights=SCORING_WEIGHTS)
+    db = writer.db
+    spatial_index = engine.scorer.spatial_index
+    pending = {entry[0]: entry for entry in refreshed}
+    for item in changed:
+        doc_id = item[FIELD_NAMES_RE.ID.value]
+        writer.write_item(doc_id, [
+            ("update", db.collection(COLLECTION_NAME).document(doc_id), {
+                FIELD_NAMES_FE.COMMUNITY_SCORE.value: item['community_value_score'],
+            }, False),
+            ("set", db.collection(COLLECTION_NAME_VALIDITY_DATA).document(doc_id), {
+                'community_cluster_score': item['community_cluster_score'],
+                'community_value_score': item['community_value_score'],
+                FIELD_NAMES_RE.COMMUNITY_SCORE.value: item['community_value_score'],
+            }, True),
+        ], on_committed=partial(spatial_index.record_scores, [pending.pop(doc_id)]))
+    # Unchanged scores need no write.
+    spatial_index.record_scores(list(pending.values()))
+    writer.flush()
+
+    log.info("Rescored neighbouring cluster scores", extra={"refreshed": len(refreshed), "changed": len(changed)})
+
+# --- Rescore-only mode (no enrichment, no external calls) ---
+
+# validity_data fields the scoring and investment calculation read...
+RESCORE_INPUT_FIELDS = [
+    "property_id", "address", "listed_price", "latitude", "longitude", "ber", "area_m2",
+    "renovation_details", "market_average_price", "amenity_details",
+    "price_attractiveness_score", "amenity_score", "air_quality_score",
+]
+# ...and the derived fields they produce (compared against what is stored).
+RESCORE_SCORE_FIELDS = [
+    "total_renovation_cost", "renovation_cost_score", "community_access_score", "community_cluster_score",
+    "community_value_score", "sustainability_score", "viability_score",
+]
+_RESCORE_REQUIRED = ["listed_price", "latitude", "longitude", "renovation_details", "market_average_price",
+                     "amenity_details", "price_attractiveness_score", "amenity_score", "air_quality_score"]
+
+def _iter_validity_data(db):
+    fields = RESCORE_INPUT_FIELDS + RESCORE_SCORE_FIELDS + ["investment_analysis"]
+    query = db.collection(COLLECTION_NAME_VALIDITY_DATA).select(fields)
+    for page in _iter_pages(query, RESCORE_PAGE_SIZE):
+        for doc in page:
+            yield doc.id, doc.to_dict()
+
+def _changed(new: pd.Series, old: pd.Series) -> np.ndarray:
+    new = pd.to_numeric(new, errors="coerce").to_numpy(dtype=float)
+    old = pd.to_numeric(old, errors="coerce").to_numpy(dtype=float)
+    return ~((new == old) | (np.isnan(new) & np.isnan(old)))
+
+def _rescore_frame(records: List[dict], scorer: ScoringEngine, writer: BulkScoreWriter | None) -> dict:
+    """Rescores one frame of stored results and queues the changed fields; returns change counts."""
+    df = pd.DataFrame(records)
+    for field in RESCORE_SCORE_FIELDS + ["investment_analysis"]:
+        if field not in df.columns:
+            df[field] = None
+    stored = df[["_doc_id", *RESCORE_SCORE_FIELDS, "investment_analysis"]].copy()
+
+    df["investment_analysis"] = InvestmentCalculator().calculate_many(
+        df["listed_price"], df["renovation_details"], df["market_average_price"])
+    ranked = scorer.rank_frame(df).set_index("_doc_id")
+    stored = stored.set_index("_doc_id").loc[ranked.index]
+
+    changed = {field: _changed(ranked[field], stored[field]) for field in RESCORE_SCORE_FIELDS}
+    changed["investment_analysis"] = np.array(
+        [new != old for new, old in zip(ranked["investment_analysis"], stored["investment_analysis"])], dtype=bool)
+    any_changed = np.logical_or.reduce(list(changed.values()))
+    headline = changed["viability_score"] | changed["community_value_score"]
+    counts = {"properties": len(ranked), "changed": int(any_changed.sum()), "headline_scores_changed": int(headline.sum()),
+              **{f"changed_{field}": int(mask.sum()) for field, mask in changed.items()}}
+    if writer is None:
+        return counts
+
+    spatial_index = scorer.spatial_index
+    db = writer.db
+    fields = list(changed)
+    for i, doc_id, values in zip(range(len(ranked)), ranked.index, ranked[fields + ["property_id"]].to_dict("records")):
+        if not any_changed[i]:
+            continue
+        update = {field: values[field] for field in fields if changed[field][i]}
+        update[FIELD_NAMES_RE.VALIDITY_SCORE.value] = values["viability_score"]
+        update[FIELD_NAMES_RE.COMMUNITY_SCORE.value] = values["community_value_score"]
+        # An update replaces each listed field whole; a merging set would merge into the
+        # investment_analysis map and keep keys the calculator no longer emits.
+        writes = [("update", db.collection(COLLECTION_NAME_VALIDITY_DATA).document(doc_id), update, False)]
+        if headline[i]:
+            writes.append(("update", db.collection(COLLECTION_NAME).document(doc_id), {
+                FIELD_NAMES_FE.VALIDITY_SCORE.value: values["viability_score"],
+                FIELD_NAMES_FE.COMMUNITY_SCORE.value: values["community_value_score"],
+            }, False))
+        on_committed = None
+        if spatial_index is not None:
+            # The index only learns the new scores once they are stored.
+            on_committed = partial(spatial_index.record_scores, [(
+                values["property_id"], values["community_access_score"], values["community_cluster_score"])])
+        writer.write_item(doc_id, writes, on_committed=on_committed)
+    return counts
+
+def rescore_from_validity_data(db, spatial_index: PersistentSpatialIndex | None, dry_run: bool = False) -> int:
+    """
+    Recomputes the scores and investment analysis of every property in validity_data
+    with the current SCORING_WEIGHTS and grant settings, in vectorized passes over
+    frames of RESCORE_FRAME_ROWS stored results. Nothing is enriched again, so no
+    external service is called. Only changed fields are written; returns how many
+    properties changed.
+
+    Cluster scores come from the spatial index, which keeps rows independent. Without
+    an index they are computed within the frame, so the whole corpus is scored as one
+    frame and memory grows with the corpus.
+    """
+    started = time.monotonic()
+    scorer = ScoringEngine(SCORING_WEIGHTS, spatial_index=spatial_index, verbose=False)
+    writer = None if dry_run else BulkScoreWriter(db)
+    frame_rows = RESCORE_FRAME_ROWS if spatial_index is not None else None
+    totals, records, skipped = {}, [], 0
+
+    def score(records):
+        for key, value in _rescore_frame(records, scorer, writer).items():
+            totals[key] = totals.get(key, 0) + value
+
+    for doc_id, data in _iter_validity_data(db):
+        if any(data.get(field) is None for field in _RESCORE_REQUIRED):
+            skipped += 1
+            continue
+        data["_doc_id"] = doc_id
+        data.setdefault("property_id", doc_id)
+        records.append(data)
+        if frame_rows is not None and len(records) >= frame_rows:
+            score(records)
+            records = []
+    if records:
+        score(records)
+
+    log.info("Rescored stored results", extra={**totals, "skipped_incomplete": skipped})
+    if writer is None:
+        return totals.get("changed", 0)
+    writer.close()
+    log.info("Rescore complete", extra={
+        "written": totals.get("changed", 0) - len(writer.failed_items), "failed_properties": len(writer.failed_items),
+        "elapsed_s": round(time.monotonic() - started, 1)})
+    return totals.get("changed", 0)
+
+# --- Daily air-quality precompute ---
+
+def precompute_air_quality(db):
+    """Refreshes the air-quality grid cells around every known property (run once a day)."""
+    points = [(lat, lon) for _, lat, lon in _iter_property_coordinates(db)]
+    refreshed = asyncio.run(external_services.refresh_air_quality_grid_async(points, MAPS_API_KEY))
+    log.info("Air quality grid refreshed", extra={"cells": refreshed, "properties": len(points)})
+
+# --- Pipeline stage functions ---
+
+def _item_to_save(prop_result: dict) -> dict:
+    item_to_save = prop_result.copy()
+    item_to_save[FIELD_NAMES_RE.ID.value] = item_to_save['property_id']
+    item_to_save[FIELD_NAMES_RE.VALIDITY_SCORE.value] = item_to_save['viability_score']
+    item_to_save[FIELD_NAMES_RE.COMMUNITY_SCORE.value] = item_to_save['community_value_score']
+    return item_to_save
+
+def _http_session() -> aiohttp.ClientSession:
+    return external_services.http_session(HTTP_CONNECTION_LIMIT)
+
+def _on_written(spatial_index: PersistentSpatialIndex, journal: CheckpointJournal | None, item: dict):
+    spatial_index.record_scores([(item['property_id'], item['community_access_score'], item['community_cluster_score'])])
+    if journal is not None:
+        journal.mark_written(item['property_id'])
 
-    for i in range(total_chunks):
-        start_index = i * CHUNK_SIZE
-        end_index = start_index + CHUNK_SIZE
-        current_chunk_docs = all_unprocessed_docs[start_index:end_index]
-        
-        print(f"\n--- Processing Chunk {i+1}/{total_chunks} ({len(current_chunk_docs)} properties) ---")
+def build_pipeline(db, engine: ViabilityEngine, writer: BulkScoreWriter, journal: CheckpointJournal) -> Pipeline:
+    """
+    load -> lookups -> images -> gemini -> investment -> score -> write, each stage with its own
+    worker count (STAGE_WORKERS, ASYNC_STAGE_CONCURRENCY) and bounded queues between them.
+
+    The lookup, renovation and score outputs are checkpointed in the journal. A property
+    found there is not loaded again and passes through the stages it already completed.
+    """
+    spatial_index = engine.scorer.spatial_index
+    enricher = engine.enricher
+    written = 0
 
-        property_listings_chunk = []
-        for doc in current_chunk_docs:
+    def load(doc):
+        property_data = journal.resume(doc.id)
+        if property_data is None:
             try:
-                # The data loading part is still sequential and fast.
                 property_data = load_from_firestore(db, doc.id)
-                property_listings_chunk.append(property_data)
             except (FileNotFoundError, ValueError) as e:
-                print(f"  -> WARNING: Could not load property '{doc.id}'. Skipping. Reason: {e}")
-        
-        if not property_listings_chunk:
-            print("No valid properties in this chunk. Moving to the next.")
-            continue
-            
-        # --- PARALLEL ENRICHMENT ---
-        enriched_results = []
-        print(f"  -> Starting parallel enrichment for {len(property_listings_chunk)} properties...")
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Submit all enrichment tasks to the thread pool
-            future_to_prop = {
-                executor.submit(process_single_property, engine.enricher, prop): prop 
-                for prop in property_listings_chunk
-            }
-            
-            # Process results as they are completed
-            for future in as_completed(future_to_prop):
-                result = future.result()
-                if result: # Only add successful results
-                    enriched_results.append(result)
-        
-        if not enriched_results:
-            print("  -> No properties were successfully enriched in this chunk.")
-            continue
+                log.warning("Could not load property, skipping", extra={"doc_id": doc.id, "error": str(e)})
+                return None
+        # Register the property in the corpus index before it is scored, so cluster
+        # scores see every known neighbour (and already-scored neighbours get flagged stale).
+        spatial_index.upsert([(property_data['property_id'], property_data['latitude'], property_data['longitude'])])
+        return property_data
+
+    # Checkpoints are fsync'd; the async stages do that off their event loop.
+    async def lookups(session, property_data):
+        if journal.reached(property_data, "lookups"):
+            return property_data
+        enriched = await enricher.enrich_lookups_async(session, property_data)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, journal.checkpoint, enriched['property_id'], "lookups", enriched)
+
+    async def images(session, enriched):
+        if journal.reached(enriched, "renovation"):
+            return enriched
+        return await enricher.fetch_images_async(session, enriched)
+
+    async def gemini(enriched):
+        if journal.reached(enriched, "renovation"):
+            return enriched
+        enriched = await enricher.analyse_renovation_async(enriched)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, journal.checkpoint, enriched['property_id'], "renovation", enriched)
+
+    def investment(enriched):
+        if journal.reached(enriched, "scored"):
+            return enriched
+        return enricher.calculate_investment(journal.unmark(enriched))
+
+    def score(enriched_batch):
+        done = [item for item in enriched_batch if journal.reached(item, "scored")]
+        todo = [item for item in enriched_batch if not journal.reached(item, "scored")]
+        log.debug("Scoring enriched properties", extra={"properties": len(todo), "resumed": len(done)})
+        scored = [_item_to_save(r) for r in engine.scorer.rank_properties(todo)]
+        return done + [journal.checkpoint(item['property_id'], "scored", item) for item in scored]
+
+    def write(item_to_save):
+        nonlocal written
+        journal.unmark(item_to_save)
+        # Queued on the bulk writer; the index and the journal only learn about the
+        # write once it is committed. A failed write stays journaled as scored.
+        writer.write_scores(item_to_save, on_committed=partial(_on_written, spatial_index, journal, item_to_save))
+        written += 1
+        if written % RESCORE_EVERY == 0:
+            writer.flush()
+            try:
+                rescore_stale_neighbours(writer, engine)
+            except Exception as e:
+                log.warning("Could not rescore neighbouring clusters, will retry later", extra={"error": str(e)})
+        return item_to_save
 
-        # --- SCORING AND SAVING (Sequential) ---
-        print(f"  -> Enrichment complete. Scoring {len(enriched_results)} properties...")
-        # The scorer now gets the list of successfully enriched properties
-        ranked_properties = engine.scorer.rank_properties(enriched_results)
-        
-        if ranked_properties:
-            print(f"  -> Storing results for {len(ranked_properties)} properties in Firestore...")
-            for prop_result in ranked_properties:
-                item_to_save = prop_result.copy()
-                item_to_save[FIELD_NAMES_RE.ID.value] = item_to_save['property_id']
-                item_to_save[FIELD_NAMES_RE.VALIDITY_SCORE.value] = item_to_save['viability_score']
-                item_to_save[FIELD_NAMES_RE.COMMUNITY_SCORE.value] = item_to_save['community_value_score']
-                
-                # The merge function is called sequentially, which is safer for DB writes
-                merge_into_firestore(item_to_save)
+    external_services.air_quality_grid() # loaded here rather than on the lookups stage's event loop
+    return Pipeline([
+        Stage("load", load, workers=STAGE_WORKERS["load"], queue_size=STAGE_QUEUE_SIZE),
+        AsyncStage("lookups", lookups, concurrency=ASYNC_STAGE_CONCURRENCY["lookups"],
+                   queue_size=STAGE_QUEUE_SIZE, resource=_http_session),
+        AsyncStage("images", images, concurrency=ASYNC_STAGE_CONCURRENCY["images"],
+                   queue_size=STAGE_QUEUE_SIZE, resource=_http_session),
+        AsyncStage("gemini", gemini, concurrency=ASYNC_STAGE_CONCURRENCY["gemini"],
+                   queue_size=STAGE_QUEUE_SIZE),
+        Stage("investment", investment, workers=STAGE_WORKERS["investment"], queue_size=STAGE_QUEUE_SIZE),
+        Stage("score", score, workers=1, queue_size=STAGE_QUEUE_SIZE,
+              batch_size=SCORING_BATCH_SIZE, batch_timeout_s=SCORING_BATCH_TIMEOUT_S),
+        Stage("write", write, workers=1, queue_size=STAGE_QUEUE_SIZE),
+    ])
+
+# --- Stage refresh mode (only stale enrichment stages are recomputed) ---
+
+def _iter_scored_documents(db):
+    for page in _iter_pages(db.collection(COLLECTION_NAME_VALIDITY_DATA), RESCORE_PAGE_SIZE):
+        yield from page
+
+def build_refresh_pipeline(db, engine: ViabilityEngine, writer: BulkScoreWriter) -> Pipeline:
+    """
+    load -> refresh -> score -> write over already-scored properties. Each is compared
+    with its current listing and only its stale stages are recomputed (STAGE_TTL_S,
+    engine/stage_results.py); the rest are reused from validity_data. Properties with
+    nothing stale are dropped by the refresh stage.
+    """
+    spatial_index = engine.scorer.spatial_index
+
+    def load(doc):
+        try:
+            property_data = load_from_firestore(db, doc.id)
+        except (FileNotFoundError, ValueError) as e:
+            log.warning("Could not load property, skipping", extra={"doc_id": doc.id, "error": str(e)})
+            return None
+        spatial_index.upsert([(property_data['property_id'], property_data['latitude'], property_data['longitude'])])
+        return property_data, doc.to_dict()
+
+    async def refresh(session, loaded):
+        property_data, stored = loaded
+        return await engine.enricher.refresh_property_async(session, property_data, stored)
+
+    def score(enriched_batch):
+        return [_item_to_save(r) for r in engine.scorer.rank_properties(enriched_batch)]
+
+    def write(item_to_save):
+        writer.write_scores(item_to_save, on_committed=partial(_on_written, spatial_index, None, item_to_save))
+        return item_to_save
+
+    external_services.air_quality_grid() # loaded here rather than on the refresh stage's event loop
+    return Pipeline([
+        Stage("load", load, workers=STAGE_WORKERS["load"], queue_size=STAGE_QUEUE_SIZE),
+        AsyncStage("refresh", refresh, concurrency=ASYNC_STAGE_CONCURRENCY["refresh"],
+                   queue_size=STAGE_QUEUE_SIZE, resource=_http_session),
+        Stage("score", score, workers=1, queue_size=STAGE_QUEUE_SIZE,
+              batch_size=SCORING_BATCH_SIZE, batch_timeout_s=SCORING_BATCH_TIMEOUT_S),
+        Stage("write", write, workers=1, queue_size=STAGE_QUEUE_SIZE),
+    ])
+
+def run_stage_refresh():
+    """Recomputes the stale enrichment stages of every scored property and re-scores it."""
+    log.info("Starting stage refresh of scored properties", extra={"stage_ttl_s": STAGE_TTL_S})
+    started = time.monotonic()
+    db = initialize_firebase()
+
+    spatial_index = PersistentSpatialIndex(SPATIAL_INDEX_PATH, radius_m=CLUSTER_RADIUS_M)
+    if len(spatial_index) == 0:
+        backfill_spatial_index(db, spatial_index)
+    engine = ViabilityEngine(weights=SCORING_WEIGHTS, spatial_index=spatial_index)
+    writer = BulkScoreWriter(db)
+    pipeline = build_refresh_pipeline(db, engine, writer)
+
+    total_docs = pipeline.run(_iter_scored_documents(db))
+    writer.flush()
+    try:
+        rescore_stale_neighbours(writer, engine)
+    except Exception as e:
+        log.warning("Could not rescore neighbouring clusters, will retry next run", extra={"error": str(e)})
+    writer.close()
+    spatial_index.close()
+    write_run_report(pipeline.stats(), total_docs, time.monotonic() - started)
+
+    for stats in pipeline.stats():
+        log.info("Stage summary", extra=stats)
+    refresh_stats = next(s for s in pipeline.stats() if s["stage"] == "refresh")
+    log.info("Stage refresh complete", extra={
+        "properties": total_docs, "up_to_date": refresh_stats["dropped"], "failed_writes": len(writer.failed_items)})
+
+# --- Main Batch Processing Logic (Streaming Pipeline) ---
+
+def run_batch_analysis(sharded: bool = False):
+    """
+    Streams every unprocessed property through the stage pipeline, so each property
+    moves on as soon as its own lookups finish instead of waiting for a whole chunk.
+
+    Sharded, the worker only takes the properties of the shards it leases (see
+    sharding.py), one pipeline per claim, until every shard is completed.
+    """
+    log.info("Starting pipelined batch property viability analysis")
+    started = time.monotonic()
+
+    db = initialize_firebase()
+
+    log.info("Streaming properties that need analysis from Firestore", extra={
+        "discovery_mode": DISCOVERY_MODE, "stage_workers": STAGE_WORKERS, "async_concurrency": ASYNC_STAGE_CONCURRENCY})
+    
+    spatial_index = PersistentSpatialIndex(SPATIAL_INDEX_PATH, radius_m=CLUSTER_RADIUS_M)
+    if len(spatial_index) == 0:
+        backfill_spatial_index(db, spatial_index)
+
+    engine = ViabilityEngine(weights=SCORING_WEIGHTS, spatial_index=spatial_index)
+    writer = BulkScoreWriter(db)
+    leaser = None
+    if sharded:
+        if not SHARD_WORKER_ID:
+            raise RuntimeError("ERROR: SHARD_WORKER_ID not set. Sharded workers need a stable, unique ID.")
+        leaser = ShardLeaser(db, SHARD_WORKER_ID, SHARD_COUNT, SHARD_LEASE_S, SHARD_HEARTBEAT_S).start()
+        log.info("Running as a shard worker", extra={"worker": SHARD_WORKER_ID, "shard_count": SHARD_COUNT})
+    journal = CheckpointJournal(JOURNAL_PATH, fsync=JOURNAL_FSYNC, max_age_s=JOURNAL_MAX_AGE_S)
+    pipelines = []
+
+    exporter = None
+    if METRICS_EXPORT_INTERVAL_S > 0:
+        exporter = PeriodicExporter(metrics, METRICS_TEXTFILE_PATH, METRICS_EXPORT_INTERVAL_S).start()
+    try:
+        if leaser is None:
+            pipelines.append(build_pipeline(db, engine, writer, journal))
+            total_docs = pipelines[0].run(query_no_validity(db))
         else:
-            print("  -> Engine did not return any ranked properties for this chunk.")
+            total_docs = 0
+            while shards := leaser.claim(SHARDS_PER_CLAIM):
+                failed_before = len(writer.failed_items)
+                pipelines.append(build_pipeline(db, engine, writer, journal))
+                total_docs += pipelines[-1].run(leaser.documents(shards, partial(query_no_validity, db)))
+                writer.flush() # a shard is only completed once its writes are committed
+                if len(writer.failed_items) > failed_before:
+                    leaser.release(shards)
+                else:
+                    leaser.complete(shards)
+
+        writer.flush()
+        try:
+            rescore_stale_neighbours(writer, engine)
+        except Exception as e:
+            log.warning("Could not rescore neighbouring clusters, will retry next run", extra={"error": str(e)})
+        writer.close()
+        spatial_index.close()
+        if writer.failed_items:
+            log.warning("Writes failed, the scored results stay journaled for the next run",
+                        extra={"properties": len(writer.failed_items)})
+    finally:
+        if leaser is not None:
+            leaser.close()
+        journal.close()
+        if exporter is not None:
+            exporter.stop()
+    stage_stats = _combined_stats(pipelines)
+    write_run_report(stage_stats, total_docs, time.monotonic() - started)
 
-    print("\n--- All chunks processed. Batch analysis complete. ---")
+    if total_docs == 0:
+        log.info("No new properties to process. System is up-to-date.")
+        return
+    for stats in stage_stats:
+        log.info("Stage summary", extra=stats)
+    log.info("HTTP response cache", extra={"summary": external_services.response_cache.summary()})
+    log.info("Image memory", extra={"peak_mb": round(external_services.image_budget.peak_bytes / 2**20, 1),
+                                    "budget_mb": round(external_services.image_budget.limit_bytes / 2**20)})
+    log.info("Image store", extra={"summary": external_services.image_store.summary()})
+    for client in external_services.services.values():
+        log.info("External service", extra={"summary": client.summary()})
+    log.info("Batch analysis complete", extra={"properties": total_docs})
+
+def _combined_stats(pipelines: List[Pipeline]) -> List[dict]:
+    """Per-stage stats summed over the pipelines of a run (a sharded run has one per claim)."""
+    combined = {}
+    for pipeline in pipelines:
+        for stats in pipeline.stats():
+            total = combined.setdefault(stats["stage"], {**stats, "processed": 0, "dropped": 0, "errors": 0, "busy_s": 0.0})
+            total["busy_s"] += stats["avg_s"] * stats["processed"]
+            for key in ("processed", "dropped", "errors"):
+                total[key] += stats[key]
+    for total in combined.values():
+        busy_s = total.pop("busy_s")
+        total["avg_s"] = round(busy_s / total["processed"], 4) if total["processed"] else 0.0
+    return list(combined.values())
+
+def show_shard_status(db):
+    leaser = ShardLeaser(db, SHARD_WORKER_ID, SHARD_COUNT, SHARD_LEASE_S, SHARD_HEARTBEAT_S)
+    for lease in leaser.status():
+        log.info("Shard lease", extra=lease)
+
+def write_run_report(stage_stats: List[dict], total_docs: int, elapsed_s: float):
+    """Writes the Prometheus textfile and the JSON run report; a failed write only warns."""
+    try:
+        metrics.write_textfile(METRICS_TEXTFILE_PATH)
+        metrics.write_report(
+            RUN_REPORT_PATH,
+            properties=total_docs,
+            throughput_per_s=round(total_docs / elapsed_s, 3) if elapsed_s > 0 else 0.0,
+            stages=stage_stats,
+        )
+    except OSError as e:
+        log.warning("Could not write metrics", extra={"error": str(e)})
 
 
 if __name__ == "__main__":
-    run_batch_analysis()
\ No newline at end of file
+    configure_logging(LOG_LEVEL, LOG_FORMAT)
+    if "--mark-unscored" in sys.argv:
+        mark_unscored_for_scoring(initialize_firebase())
+    elif "--precompute-air-quality" in sys.argv:
+        precompute_air_quality(initialize_firebase())
+    elif "--rescore" in sys.argv:
+        # Recompute scores from stored results after changing SCORING_WEIGHTS (no API calls).
+        rescore_index = PersistentSpatialIndex(SPATIAL_INDEX_PATH, radius_m=CLUSTER_RADIUS_M)
+        rescore_from_validity_data(initialize_firebase(), rescore_index if len(rescore_index) else None,
+                                   dry_run="--dry-run" in sys.argv)
+        rescore_index.close()
+    elif "--refresh" in sys.argv:
+        # Recompute only stale enrichment stages (air quality daily, market prices monthly...).
+        run_stage_refresh()
+    elif "--shard-status" in sys.argv:
+        show_shard_status(initialize_firebase())
+    elif "--invalidate-renovation-cache" in sys.argv:
+        log.info("Dropped cached renovation analyses", extra={"dropped": external_services.invalidate_renovation_cache()})
+    else:
+        # --sharded: run as one of several workers splitting the properties by lease.
+        run_batch_analysis(sharded="--sharded" in sys.argv)
\ No newline at end of file
@@ -19,6 +19,7 @@ def _update_firestore_properties(batch, db, id: str, vs: int, cs: int):
         {
             FIELD_NAMES_FE.VALIDITY_SCORE.value: vs,
             FIELD_NAMES_FE.COMMUNITY_SCORE.value: cs,
+            FIELD_NAMES_FE.NEEDS_SCORING.value: False,
         },
     )
 
@@ -1,20 +1,31 @@
-from constants import COLLECTION_NAME, FIELD_NAMES_RE
+from constants import COLLECTION_NAME, FIELD_NAMES_FE
+
+PAGE_SIZE = 300
 
 
 def query_no_validity(db):
-    docs_without_validity = get_documents_without_a_field(
-        db, COLLECTION_NAME, FIELD_NAMES_RE.VALIDITY_SCORE.value
+    return get_documents_without_a_field(
+        db, COLLECTION_NAME, FIELD_NAMES_FE.VALIDITY_SCORE.value
     )
-    return docs_without_validity
-
 
-def get_documents_without_a_field(db, collection_name: str, field_name: str):
-    docs = db.collection(collection_name).stream()
 
-    docs_without_field = []
-    for doc in docs:
-        doc_data = doc.to_dict()
-        if field_name not in doc_data:
-            docs_without_field.append(doc)
-
-    return docs_without_field
+def get_documents_without_a_field(db, collection_name: str, field_name: str, page_size: int = PAGE_SIZE):
+    """
+    Yields documents missing field_name, one cursor-paged query at a time.
+    Only field_name is transferred for each document.
+    """
+    query = (
+        db.collection(collection_name)
+        .select([field_name])
+        .order_by("__name__")
+        .limit(page_size)
+    )
+    last_doc = None
+    while True:
+        page = list((query.start_after(last_doc) if last_doc else query).stream())
+        for doc in page:
+            if field_name not in doc.to_dict():
+                yield doc
+        if len(page) < page_size:
+            return
+        last_doc = page[-1]
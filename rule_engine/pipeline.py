@@ -0,0 +1,285 @@
+# pipeline.py
+"""
+Streaming stage scheduler for the batch analysis.
+
+Each Stage owns a bounded input queue and its own pool of worker threads, so cheap
+HTTP lookups, image downloads and Gemini calls can be sized independently. Items
+flow to the next stage as soon as they are done; throughput is set by the slowest
+stage rather than by the slowest property in a chunk, and the bounded queues stop
+a fast stage from running arbitrarily far ahead of a slow one.
+
+I/O-bound steps can instead be an AsyncStage: one thread running an event loop
+with up to `concurrency` items in flight, which scales to thousands of pending
+HTTP calls where a thread pool would need a thread per call.
+"""
+import asyncio
+import contextlib
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional
+
+from telemetry import metrics
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+STAGE_SECONDS = metrics.histogram(
+    "rule_engine_stage_seconds", "Time spent on one call of a stage function.", ["stage"])
+STAGE_ITEMS = metrics.counter(
+    "rule_engine_stage_items_total", "Items handled by a stage, by outcome.", ["stage", "outcome"])
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    fn receives one item and returns the item to pass on, or None to drop it.
+    With batch_size > 1, fn instead receives a list of up to batch_size items
+    (gathered for at most batch_timeout_s) and returns a list of results.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Any],
+        workers: int = 1,
+        queue_size: int = 32,
+        batch_size: int = 1,
+        batch_timeout_s: float = 0.5,
+    ):
+        if workers < 1:
+            raise ValueError(f"Stage '{name}' needs at least one worker.")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.concurrency = workers
+        self.batch_size = batch_size
+        self.batch_timeout_s = batch_timeout_s
+        self.inbox: queue.Queue = queue.Queue(maxsize=queue_size)
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.busy_s = 0.0
+        self._lock = threading.Lock()
+        self._live_workers = workers
+
+    def _record(self, processed: int, dropped: int, errors: int, busy_s: float):
+        with self._lock:
+            self.processed += processed
+            self.dropped += dropped
+            self.errors += errors
+            self.busy_s += busy_s
+        if busy_s:
+            STAGE_SECONDS.observe(busy_s, stage=self.name)
+        for outcome, n in (("passed", processed - dropped - errors), ("dropped", dropped), ("error", errors)):
+            if n:
+                STAGE_ITEMS.inc(n, stage=self.name, outcome=outcome)
+
+    def _next_batch(self) -> Optional[List[Any]]:
+        """Blocks for the first item, then gathers more until full or timed out. None = done."""
+        first = self.inbox.get()
+        if first is _DONE:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_timeout_s
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.inbox.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                # Leave the sentinel for the next read so the stage still shuts down.
+                self.inbox.put(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self, outbox: Optional[queue.Queue]):
+        while True:
+            if self.batch_size > 1:
+                items = self._next_batch()
+                if items is None:
+                    break
+            else:
+                item = self.inbox.get()
+                if item is _DONE:
+                    break
+                items = [item]
+
+            started = time.monotonic()
+            try:
+                results = self.fn(items) if self.batch_size > 1 else [self.fn(items[0])]
+                errors = 0
+            except Exception as e:
+                log.error("Stage failed, items skipped", exc_info=True,
+                          extra={"stage": self.name, "items": len(items), "error": str(e)})
+                results, errors = [], len(items)
+            results = [r for r in (results or []) if r is not None]
+            self._record(len(items), len(items) - len(results) - errors, errors, time.monotonic() - started)
+
+            if outbox is not None:
+                for result in results:
+                    outbox.put(result)
+
+        # Let sibling workers see the sentinel; the last one out signals the next stage.
+        self.inbox.put(_DONE)
+        with self._lock:
+            self._live_workers -= 1
+            last = self._live_workers == 0
+        if last and outbox is not None:
+            outbox.put(_DONE)
+
+
+class AsyncStage(Stage):
+    """
+    A stage whose fn is a coroutine function, run on a private event loop.
+
+    Up to `concurrency` items are processed at once. If `resource` is given it must be
+    a factory for an async context manager (e.g. an aiohttp.ClientSession), entered
+    once inside the loop; fn is then called as fn(resource_value, item), else fn(item).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        concurrency: int = 100,
+        queue_size: int = 32,
+        resource: Optional[Callable[[], Any]] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError(f"Stage '{name}' needs a concurrency of at least one.")
+        super().__init__(name, fn, workers=1, queue_size=queue_size)
+        self.concurrency = concurrency
+        self.resource = resource
+        self._inbox_done = False
+        self._pending_get = None # an inbox read started by the event loop and not yet consumed
+
+    def _take(self):
+        item = self.inbox.get()
+        if item is _DONE:
+            self._inbox_done = True
+        return item
+
+    def _drain(self):
+        """Skips what is left of the inbox up to _DONE, unless _DONE was already taken."""
+        if self._pending_get is not None:
+            # The loop stopped with a read in flight: wait for it, as racing it for the
+            # next item could leave this loop blocked after it took _DONE.
+            item, self._pending_get = self._pending_get.result(), None
+            if item is not _DONE:
+                self._record(1, 0, 1, 0.0)
+        while not self._inbox_done:
+            if self._take() is not _DONE:
+                self._record(1, 0, 1, 0.0)
+
+    def _work(self, outbox: Optional[queue.Queue]):
+        try:
+            asyncio.run(self._run(outbox))
+        except Exception as e:
+            # Keep draining so upstream stages are not blocked on a full inbox.
+            log.error("Stage stopped, remaining items skipped", exc_info=True,
+                      extra={"stage": self.name, "error": str(e)})
+            self._drain()
+        finally:
+            self.inbox.put(_DONE)
+            if outbox is not None:
+                outbox.put(_DONE)
+
+    async def _run(self, outbox: Optional[queue.Queue]):
+        loop = asyncio.get_running_loop()
+        # The stage queues are blocking; separate threads for reads and writes keep a
+        # full outbox (backpressure) from stalling the read of the next item.
+        getter = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-get")
+        putter = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.name}-put")
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def handle(resource, item):
+            started = time.monotonic()
+            try:
+                result = await (self.fn(resource, item) if self.resource else self.fn(item))
+                errors = 0
+            except Exception as e:
+                log.error("Stage failed, item skipped", exc_info=True,
+                          extra={"stage": self.name, "items": 1, "error": str(e)})
+                result, errors = None, 1
+            self._record(1, int(result is None and not errors), errors, time.monotonic() - started)
+            try:
+                if result is not None and outbox is not None:
+                    await loop.run_in_executor(putter, outbox.put, result)
+            finally:
+                slots.release()
+
+        try:
+            async with (self.resource() if self.resource else contextlib.nullcontext()) as resource:
+                while True:
+                    await slots.acquire()
+                    self._pending_get = getter.submit(self._take)
+                    item = await asyncio.wrap_future(self._pending_get)
+                    self._pending_get = None
+                    if item is _DONE:
+                        break
+                    task = asyncio.create_task(handle(resource, item))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+        finally:
+            getter.shutdown(wait=False)
+            putter.shutdown(wait=True)
+
+
+class Pipeline:
+    """Chains stages with bounded queues and runs a source iterable through them."""
+
+    def __init__(self, stages: List[Stage]):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+
+    def run(self, source: Iterable[Any]) -> int:
+        """Feeds every item from source through the stages; returns how many were fed."""
+        threads = []
+        for i, stage in enumerate(self.stages):
+            outbox = self.stages[i + 1].inbox if i + 1 < len(self.stages) else None
+            for w in range(stage.workers):
+                t = threading.Thread(target=stage._work, args=(outbox,), name=f"{stage.name}-{w}", daemon=True)
+                t.start()
+                threads.append(t)
+
+        fed = 0
+        try:
+            for item in source:
+                self.stages[0].inbox.put(item)
+                fed += 1
+        finally:
+            self.stages[0].inbox.put(_DONE)
+            for t in threads:
+                t.join()
+        return fed
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "stage": stage.name, "workers": stage.concurrency, "processed": stage.processed,
+                "dropped": stage.dropped, "errors": stage.errors,
+                "avg_s": round(stage.busy_s / stage.processed, 4) if stage.processed else 0.0,
+            }
+            for stage in self.stages
+        ]
+
+    def summary(self) -> str:
+        return "\n".join(
+            f"  {s['stage']:<12} workers={s['workers']:<4} processed={s['processed']:<6} "
+            f"dropped={s['dropped']:<4} errors={s['errors']:<4} avg={s['avg_s']:.2f}s"
+            for s in self.stats()
+        )
@@ -0,0 +1,283 @@
+# sharding.py
+"""
+Lease-based sharding of the batch analysis across processes and machines.
+
+Properties are split into SHARD_COUNT contiguous document-ID ranges, so each
+shard's discovery query reads only its own slice of the collection. The split
+points come from a Firestore partition query and are stored once in a plan
+document in the pipeline_leases collection, so every worker uses the same ranges;
+delete the plan (or change SHARD_COUNT) to rebalance after the corpus has grown.
+
+A worker (`python main.py --sharded`) claims free shards through lease documents
+in the same collection, each claim a Firestore transaction, so no two workers
+hold the same shard; workers start their scan at different shards to avoid
+contending for the same leases. Held leases are renewed by a heartbeat thread; a
+worker that dies stops renewing, and once its leases expire the surviving workers
+reclaim the shards. Finished shards are marked completed and are not claimed
+again by workers started before the completion. A shard with failed writes is
+released uncompleted for another worker (or the next run) to retry. A worker
+exits once no shard is left for it, waiting (not exiting) while a peer still
+holds one.
+
+Each worker keeps its own local files, named after its SHARD_WORKER_ID (see
+config.py), so workers on one host do not share SQLite files. A worker's
+spatial index therefore knows the properties present when it was seeded plus
+those it scored itself; delete it to reseed with the other workers' listings.
+
+Lease expiry compares wall clocks across hosts, so SHARD_LEASE_S must stay well
+above the expected clock skew. Losing a lease (a stalled heartbeat) stops the
+worker feeding that shard; properties already in flight are still written,
+which is harmless as every write is a full overwrite.
+
+Against the local emulator, with FIRESTORE_EMULATOR_HOST set as for any run,
+start several workers with distinct SHARD_WORKER_IDs:
+
+    SHARD_WORKER_ID=a python main.py --sharded &
+    SHARD_WORKER_ID=b python main.py --sharded &
+    python main.py --shard-status
+"""
+import logging
+import threading
+import time
+import zlib
+from functools import partial
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+from firebase_admin import firestore
+
+from constants import COLLECTION_NAME, COLLECTION_NAME_LEASES
+from telemetry import metrics
+
+log = logging.getLogger(__name__)
+
+SHARD_LEASES = metrics.counter(
+    "rule_engine_shard_leases_total", "Shard lease events, by outcome.", ["event"])
+
+
+# An ID range [lower, upper); None is unbounded.
+IdRange = Tuple[Optional[str], Optional[str]]
+
+
+class ShardLeaser:
+    def __init__(self, db, worker_id: str, shard_count: int, lease_s: float = 120, heartbeat_s: float = 30,
+                 collection_name: str = COLLECTION_NAME):
+        if heartbeat_s >= lease_s:
+            raise ValueError("The heartbeat interval must be shorter than the lease.")
+        self.db = db
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.lease_s = lease_s
+        self.heartbeat_s = heartbeat_s
+        self.collection_name = collection_name
+        self.started_at = time.time()
+        self._held: Set[int] = set()
+        self._released: Set[int] = set()
+        self._split_ids: Optional[List[str]] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _ref(self, shard: int):
+        # The shard count is part of the ID, so resharding starts from fresh leases.
+        return self.db.collection(COLLECTION_NAME_LEASES).document(f"{self.shard_count}-{shard:04d}")
+
+    def _plan_ref(self):
+        return self.db.collection(COLLECTION_NAME_LEASES).document(f"{self.shard_count}-plan")
+
+    def _in_transaction(self, fn, ref):
+        return firestore.transactional(fn)(self.db.transaction(), ref)
+
+    # --- Partitioning ---
+
+    def _partition_split_ids(self) -> List[str]:
+        """Document IDs splitting the collection into shard_count parts of similar size."""
+        query = self.db.collection_group(self.collection_name)
+        split_ids = [partition.end_at.id for partition in query.get_partitions(self.shard_count)
+                     if partition.end_at is not None]
+        return sorted(split_ids)[:self.shard_count - 1]
+
+    def _store_plan(self, transaction, ref, split_ids: List[str]) -> List[str]:
+        plan = ref.get(transaction=transaction).to_dict()
+        if plan is not None:
+            return plan["split_ids"]
+        transaction.set(ref, {"shard_count": self.shard_count, "split_ids": split_ids, "created_at": time.time()})
+        return split_ids
+
+    def split_ids(self) -> List[str]:
+        """The shard boundaries, planned by the first worker and reused by every other."""
+        if self._split_ids is None:
+            plan = self._plan_ref().get().to_dict()
+            if plan is not None:
+                self._split_ids = plan["split_ids"]
+            else:
+                planned = self._partition_split_ids()
+                self._split_ids = self._in_transaction(partial(self._store_plan, split_ids=planned), self._plan_ref())
+                log.info("Planned shard boundaries", extra={"shard_count": self.shard_count, "split_ids": len(self._split_ids)})
+        return self._split_ids
+
+    def id_range(self, shard: int) -> Optional[IdRange]:
+        """The document IDs of `shard`, or None for a shard left empty by a small collection."""
+        split_ids = self.split_ids()
+        if shard > len(split_ids):
+            return None
+        return (split_ids[shard - 1] if shard > 0 else None,
+                split_ids[shard] if shard < len(split_ids) else None)
+
+    # --- Claiming ---
+
+    def _try_claim(self, transaction, ref) -> str:
+        """'claimed', 'held' (by a live peer) or 'done' (completed during this run)."""
+        lease = ref.get(transaction=transaction).to_dict() or {}
+        now = time.time()
+        if lease.get("completed_at", 0) >= self.started_at:
+            return "done"
+        if lease.get("owner") not in (None, self.worker_id) and lease.get("expires_at", 0) > now:
+            return "held"
+        transaction.set(ref, {
+            "shard": int(ref.id.split("-")[1]), "shard_count": self.shard_count, "owner": self.worker_id,
+            "claimed_at": now, "heartbeat_at": now, "expires_at": now + self.lease_s, "completed_at": 0,
+        })
+        if lease.get("owner") not in (None, self.worker_id):
+            log.warning("Reclaimed an expired shard lease", extra={"shard": ref.id, "previous_owner": lease["owner"]})
+            SHARD_LEASES.inc(event="reclaimed")
+        return "claimed"
+
+    def claim(self, max_shards: int = 1) -> List[int]:
+        """
+        Claims up to max_shards free or expired shards. Waits while every remaining
+        shard is held by a live peer; returns [] once all shards are completed.
+        """
+        # Workers start at different shards, so they do not all contend for the first leases.
+        offset = zlib.crc32(self.worker_id.encode("utf-8")) % self.shard_count
+        while not self._stop.is_set():
+            claimed, busy = [], 0
+            for i in range(self.shard_count):
+                shard = (offset + i) % self.shard_count
+                if len(claimed) >= max_shards:
+                    break
+                if shard in self._released:
+                    continue
+                outcome = self._in_transaction(self._try_claim, self._ref(shard))
+                if outcome == "claimed":
+                    claimed.append(shard)
+                busy += outcome == "held"
+            if claimed:
+                with self._lock:
+                    self._held.update(claimed)
+                for _ in claimed:
+                    SHARD_LEASES.inc(event="claimed")
+                log.info("Claimed shards", extra={"worker": self.worker_id, "shards": claimed})
+                return claimed
+            if not busy:
+                return []
+            log.info("Waiting for shards held by other workers", extra={"worker": self.worker_id, "held": busy})
+            self._stop.wait(self.heartbeat_s)
+        return []
+
+    def holds(self, shard: int) -> bool:
+        with self._lock:
+            return shard in self._held
+
+    def documents(self, shards: List[int], discover: Callable[[IdRange], Iterable]):
+        """
+        Yields the documents `discover` finds in each shard's ID range, for as long as
+        the shard's lease is still held.
+        """
+        for shard in shards:
+            id_range = self.id_range(shard)
+            if id_range is None:
+                continue
+            for doc in discover(id_range):
+                if not self.holds(shard):
+                    break
+                yield doc
+
+    # --- Heartbeats and completion ---
+
+    def _renew(self, transaction, ref) -> bool:
+        lease = ref.get(transaction=transaction).to_dict() or {}
+        if lease.get("owner") != self.worker_id:
+            return False
+        now = time.time()
+        transaction.update(ref, {"heartbeat_at": now, "expires_at": now + self.lease_s})
+        return True
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_s):
+            with self._lock:
+                held = sorted(self._held)
+            for shard in held:
+                try:
+                    renewed = self._in_transaction(self._renew, self._ref(shard))
+                except Exception as e:
+                    # Keep the shard; the lease is only lost once a peer takes it over.
+                    log.warning("Could not renew shard lease", extra={"shard": shard, "error": str(e)})
+                    continue
+                if not renewed:
+                    with self._lock:
+                        self._held.discard(shard)
+                    SHARD_LEASES.inc(event="lost")
+                    log.warning("Lost shard lease to another worker", extra={"worker": self.worker_id, "shard": shard})
+
+    def start(self) -> "ShardLeaser":
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="shard-heartbeat", daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def _complete(self, transaction, ref) -> bool:
+        lease = ref.get(transaction=transaction).to_dict() or {}
+        if lease.get("owner") != self.worker_id:
+            return False
+        transaction.update(ref, {"owner": None, "expires_at": 0, "completed_at": time.time()})
+        return True
+
+    def complete(self, shards: List[int]):
+        """Marks shards this worker still holds as completed and releases their leases."""
+        for shard in shards:
+            if not self.holds(shard):
+                continue
+            if self._in_transaction(self._complete, self._ref(shard)):
+                SHARD_LEASES.inc(event="completed")
+            with self._lock:
+                self._held.discard(shard)
+        log.info("Completed shards", extra={"worker": self.worker_id, "shards": shards})
+
+    def _release(self, transaction, ref) -> bool:
+        lease = ref.get(transaction=transaction).to_dict() or {}
+        if lease.get("owner") != self.worker_id:
+            return False
+        transaction.update(ref, {"owner": None, "expires_at": 0})
+        return True
+
+    def release(self, shards: List[int]):
+        """
+        Gives up shards without completing them (some of their writes failed), for
+        another worker or the next run to retry. This worker does not claim them again.
+        """
+        for shard in shards:
+            if not self.holds(shard):
+                continue
+            if self._in_transaction(self._release, self._ref(shard)):
+                SHARD_LEASES.inc(event="released")
+            with self._lock:
+                self._held.discard(shard)
+                self._released.add(shard)
+        log.warning("Released shards uncompleted", extra={"worker": self.worker_id, "shards": shards})
+
+    def close(self):
+        """Stops the heartbeat. Leases still held (after a failure) expire and are reclaimed."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+    def status(self) -> List[dict]:
+        now = time.time()
+        out = []
+        for shard in range(self.shard_count):
+            lease = self._ref(shard).get().to_dict() or {}
+            out.append({
+                "shard": shard, "owner": lease.get("owner"),
+                "expires_in_s": round(lease["expires_at"] - now, 1) if lease.get("owner") else None,
+                "completed_at": lease.get("completed_at") or None,
+            })
+        return out
@@ -0,0 +1,333 @@
+# telemetry.py
+"""
+Metrics and structured logging for the batch analysis.
+
+`metrics` is the process-wide registry. Hot paths record into counters and latency
+histograms (fixed buckets; recording is a dict lookup and a bisect under the
+metric's lock). Components that already keep running totals (caches, the image
+store, service clients) register a collector instead, which is only called at
+export time. The registry is exported as a Prometheus textfile, for node_exporter's
+textfile collector, and as a JSON run report with estimated percentiles.
+
+configure_logging() routes the standard logging module to stderr, one record per
+line as key=value pairs (LOG_FORMAT=json for JSON lines). Fields passed with
+extra={...} become structured fields of the record.
+"""
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+# Upper bounds (seconds) of the latency buckets, Prometheus-style; +Inf is implicit.
+LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Sample(NamedTuple):
+    """One value reported by a collector; kind is "counter" or "gauge"."""
+    name: str
+    kind: str
+    help: str
+    labels: Dict[str, str]
+    value: float
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + n
+
+    def values(self) -> List[Tuple[Dict[str, str], float]]:
+        with self._lock:
+            return [(self._labels(k), v) for k, v in self._series.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> List[Tuple[Dict[str, str], List[int], float]]:
+        """(labels, per-bucket counts incl. +Inf, sum) for every series."""
+        with self._lock:
+            return [(self._labels(k), list(s[0]), s[1]) for k, s in self._series.items()]
+
+    def quantile(self, counts: List[int], q: float) -> float:
+        """Estimate from bucket counts, interpolating linearly inside the bucket."""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], Iterable[Sample]]] = []
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS_S) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def _collected(self) -> List[Sample]:
+        with self._lock:
+            collectors = list(self._collectors)
+        samples = []
+        for collector in collectors:
+            try:
+                samples.extend(collector())
+            except Exception as e:
+                logging.getLogger(__name__).warning("Metrics collector failed", extra={"error": str(e)})
+        return samples
+
+    # --- Exports ---
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Counter):
+                for labels, value in metric.values():
+                    lines.append(f"{metric.name}{_label_text(labels)} {_number(value)}")
+            else:
+                for labels, counts, total in metric.snapshot():
+                    cumulative = 0
+                    for bound, n in zip(metric.buckets + (float("inf"),), counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else _number(bound)
+                        lines.append(f"{metric.name}_bucket{_label_text({**labels, 'le': le})} {cumulative}")
+                    lines.append(f"{metric.name}_sum{_label_text(labels)} {_number(total)}")
+                    lines.append(f"{metric.name}_count{_label_text(labels)} {cumulative}")
+
+        described = set()
+        for sample in sorted(self._collected(), key=lambda s: s.name):
+            if sample.name not in described:
+                described.add(sample.name)
+                lines.append(f"# HELP {sample.name} {sample.help}")
+                lines.append(f"# TYPE {sample.name} {sample.kind}")
+            lines.append(f"{sample.name}{_label_text(sample.labels)} {_number(sample.value)}")
+        return "\n".join(lines) + "\n"
+
+    def report(self) -> dict:
+        """Counters, histogram summaries (count, mean, p50/p95/p99) and collected values."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        report = {"counters": {}, "histograms": {}, "collected": {}}
+        for metric in metrics:
+            if isinstance(metric, Counter):
+                report["counters"][metric.name] = [{**labels, "value": value} for labels, value in metric.values()]
+                continue
+            summaries = []
+            for labels, counts, total in metric.snapshot():
+                count = sum(counts)
+                summaries.append({
+                    **labels, "count": count, "sum_s": round(total, 4),
+                    "mean_s": round(total / count, 4) if count else 0.0,
+                    **{f"p{q}_s": round(metric.quantile(counts, q / 100), 4) for q in (50, 95, 99)},
+                })
+            report["histograms"][metric.name] = summaries
+        for sample in self._collected():
+            report["collected"].setdefault(sample.name, []).append({**sample.labels, "value": sample.value})
+        return report
+
+    def write_textfile(self, path: str):
+        _write_atomic(path, self.prometheus_text())
+
+    def write_report(self, path: str, **extra):
+        finished = time.time()
+        report = {
+            "started_at": _iso(self.started_at),
+            "finished_at": _iso(finished),
+            "duration_s": round(finished - self.started_at, 3),
+            **extra,
+            **self.report(),
+        }
+        _write_atomic(path, json.dumps(report, indent=2, default=str) + "\n")
+
+
+def _label_text(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape_label_value(value) -> str:
+    # The text exposition format escapes backslash, newline and double quote in label values.
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds")
+
+
+def _write_atomic(path: str, text: str):
+    # node_exporter may read the file at any moment: never expose a half-written one.
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    # mkstemp creates the file 0600 and os.replace keeps that, but the textfile collector
+    # usually runs as another user.
+    if hasattr(os, "fchmod"):
+        os.fchmod(fd, 0o644)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+metrics = Registry()
+
+
+class PeriodicExporter:
+    """Rewrites the Prometheus textfile every interval_s seconds during a long run."""
+
+    def __init__(self, registry: Registry, path: str, interval_s: float):
+        self.registry = registry
+        self.path = path
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _write(self):
+        try:
+            self.registry.write_textfile(self.path)
+        except OSError as e:
+            logging.getLogger(__name__).warning("Could not write metrics textfile",
+                                                extra={"path": self.path, "error": str(e)})
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self._write()
+
+    def stop(self):
+        """Final write; like the periodic ones, a failure only warns (stop() runs in finally blocks)."""
+        self._stop.set()
+        self._thread.join()
+        self._write()
+
+
+# --- Structured logging ---
+
+# Attributes every LogRecord has; anything else was passed through extra=.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_lines: bool = False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        fields.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        if self.json_lines:
+            return json.dumps(fields, default=str, ensure_ascii=False)
+        return " ".join(f"{k}={_logfmt(v)}" for k, v in fields.items())
+
+
+def _logfmt(value) -> str:
+    text = value if isinstance(value, str) else json.dumps(value, default=str, ensure_ascii=False)
+    if text and not any(c in text for c in ' "=\n'):
+        return text
+    return json.dumps(text, ensure_ascii=False)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "text", stream=None):
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(StructuredFormatter(json_lines=fmt == "json"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
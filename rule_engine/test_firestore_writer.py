@@ -0,0 +1,180 @@
+# test_firestore_writer.py
+"""
+BulkScoreWriter against an in-memory BatchWrite endpoint that can fail writes with
+chosen gRPC codes and records what was committed, in order. Run with `python -m pytest`.
+"""
+import threading
+import time
+
+import pytest
+
+import firestore_writer
+from firestore_writer import BulkScoreWriter
+
+ABORTED, UNAVAILABLE, INVALID_ARGUMENT = 10, 14, 3
+
+
+class _Ref:
+    def __init__(self, path):
+        self.path = path
+
+
+class _Status:
+    def __init__(self, code):
+        self.code = code
+
+
+class _Response:
+    def __init__(self, codes):
+        self.status = [_Status(code) for code in codes]
+
+
+class _Server:
+    """
+    Applies BatchWrite requests to a dict. failures maps a document path to the codes
+    its next writes fail with, one per attempt; raise_next fails whole RPCs.
+    """
+
+    def __init__(self, commit_s=0.0):
+        self.commit_s = commit_s
+        self.docs = {}
+        self.log = []
+        self.failures = {}
+        self.raise_next = 0
+        self.attempts = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def commit(self, writes):
+        with self.lock:
+            self.attempts += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            fail_rpc = self.raise_next > 0
+            self.raise_next -= fail_rpc
+        try:
+            time.sleep(self.commit_s)
+            if fail_rpc:
+                raise ConnectionError("injected RPC failure")
+            codes = []
+            with self.lock:
+                for kind, ref, data, merge in writes:
+                    pending = self.failures.get(ref.path)
+                    code = pending.pop(0) if pending else 0
+                    codes.append(code)
+                    if code == 0:
+                        base = self.docs.get(ref.path, {}) if kind == "update" or merge else {}
+                        self.docs[ref.path] = {**base, **data}
+                        self.log.append((ref.path, dict(data)))
+            return _Response(codes)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = _Server()
+
+    class _Batch:
+        def __init__(self, db):
+            self.writes = []
+
+        def update(self, ref, data):
+            self.writes.append(("update", ref, data, False))
+
+        def set(self, ref, data, merge=False):
+            self.writes.append(("set", ref, data, merge))
+
+        def commit(self):
+            return server.commit(self.writes)
+
+    monkeypatch.setattr(firestore_writer, "BulkWriteBatch", _Batch)
+    return server
+
+
+def _writer(**kwargs):
+    return BulkScoreWriter(db=None, base_backoff_s=0.0, **kwargs)
+
+
+def test_retryable_codes_are_retried_until_written(server):
+    server.failures = {"p/0": [UNAVAILABLE, ABORTED], "p/1": [ABORTED]}
+    server.raise_next = 1
+    committed = []
+    writer = _writer(max_batch_operations=10)
+    for i in range(5):
+        writer.write_item(str(i), [("set", _Ref(f"p/{i}"), {"n": i}, False)], lambda i=i: committed.append(i))
+    writer.close()
+
+    assert server.docs == {f"p/{i}": {"n": i} for i in range(5)}
+    assert sorted(committed) == list(range(5))
+    assert writer.written_operations == 5 and writer.failed_operations == 0 and writer.failed_items == []
+    # One failed RPC, then p/0 twice and p/1 once more.
+    assert server.attempts == 4
+
+
+def test_rejected_and_exhausted_writes_fail_their_item_without_a_callback(server):
+    server.failures = {"p/0": [INVALID_ARGUMENT], "p/1": [UNAVAILABLE] * 3}
+    committed = []
+    writer = _writer(max_attempts=3)
+    for i in range(3):
+        writer.write_item(str(i), [("set", _Ref(f"p/{i}"), {"n": i}, False),
+                                   ("set", _Ref(f"q/{i}"), {"n": i}, False)], lambda i=i: committed.append(i))
+    writer.close()
+
+    assert sorted(writer.failed_items) == ["0", "1"]
+    assert committed == [2]
+    assert writer.written_operations == 4 and writer.failed_operations == 2
+
+
+def test_writes_to_one_document_land_in_queue_order(server):
+    server.commit_s = 0.002
+    writer = _writer(max_batch_operations=7)
+    for seq in range(200):
+        writer.update(_Ref(f"p/{seq % 5}"), {"seq": seq})
+    writer.close()
+
+    for k in range(5):
+        seqs = [data["seq"] for path, data in server.log if path == f"p/{k}"]
+        assert seqs == list(range(k, 200, 5))
+
+
+def test_at_most_max_in_flight_batches_commit_at_once(server):
+    server.commit_s = 0.02
+    writer = _writer(max_batch_operations=5, max_in_flight=4)
+    for i in range(200):
+        writer.set(_Ref(f"p/{i}"), {"n": i})
+    writer.close()
+
+    assert len(server.docs) == 200
+    assert server.max_in_flight == 4
+
+
+def test_callbacks_run_after_commit_in_queue_order_and_before_flush_returns(server):
+    server.commit_s = 0.001
+    server.failures = {"p/3": [UNAVAILABLE]}
+    seen = []
+
+    def on_committed(seq, path):
+        # Recorded rather than asserted, as the writer logs and swallows callback errors.
+        stored = server.docs[path]["seq"]
+        time.sleep(0.001)  # room for a later write to the document to overtake
+        seen.append((path, seq, stored))
+
+    writer = _writer(max_batch_operations=6)
+    for seq in range(120):
+        path = f"p/{seq % 4}"
+        writer.write_item(f"item-{seq}", [("set", _Ref(path), {"seq": seq}, False)],
+                          lambda seq=seq, path=path: on_committed(seq, path))
+        if seq == 60:
+            writer.flush()
+            assert len(seen) == 61
+    writer.flush()
+
+    assert len(seen) == 120
+    # Each callback saw its own write landed and not yet overwritten.
+    assert all(seq == stored for _, seq, stored in seen)
+    for k in range(4):
+        assert [seq for path, seq, _ in seen if path == f"p/{k}"] == list(range(k, 120, 4))
+    writer.close()
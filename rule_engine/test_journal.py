@@ -0,0 +1,129 @@
+# test_journal.py
+"""
+CheckpointJournal recovery: reopening a journal left behind by a crash, torn or
+corrupt lines, compaction and the resume helpers. Run with `python -m pytest`.
+"""
+import journal
+from journal import RESUME_KEY, CheckpointJournal
+
+
+def _open(tmp_path, **kwargs):
+    return CheckpointJournal(str(tmp_path / "journal.log"), fsync=False, **kwargs)
+
+
+def _lines(tmp_path):
+    return (tmp_path / "journal.log").read_bytes().splitlines(keepends=True)
+
+
+def test_reopened_journal_resumes_each_property_after_its_last_checkpoint(tmp_path):
+    j = _open(tmp_path)
+    j.checkpoint("1", "lookups", {"property_id": "1", "amenities": [1, 2]})
+    j.checkpoint("1", "renovation", {"property_id": "1", "amenities": [1, 2], "cost": 10})
+    j.checkpoint("2", "lookups", {"property_id": "2", "_transient": object()})
+    j.checkpoint("3", "scored", {"property_id": "3"})
+    j.mark_written("3")
+    j._file.close() # a crash: no compaction on close
+
+    j = _open(tmp_path)
+    assert len(j) == 2
+    item = j.resume("1")
+    assert item == {"property_id": "1", "amenities": [1, 2], "cost": 10, RESUME_KEY: "renovation"}
+    assert "_transient" not in j.resume("2")
+    assert j.resume("3") is None
+
+
+def test_torn_last_line_is_rejected_and_later_appends_survive(tmp_path):
+    j = _open(tmp_path)
+    j.checkpoint("1", "lookups", {"property_id": "1"})
+    j.checkpoint("1", "renovation", {"property_id": "1", "cost": 10})
+    j._file.close()
+    path = tmp_path / "journal.log"
+    path.write_bytes(path.read_bytes()[:-7]) # torn mid-record, no trailing newline
+
+    j = _open(tmp_path)
+    assert j.corrupt_lines == 1
+    assert j.resume("1")[RESUME_KEY] == "lookups"
+    j.checkpoint("2", "scored", {"property_id": "2"})
+    j._file.close()
+
+    j = _open(tmp_path)
+    assert j.corrupt_lines == 0
+    assert j.resume("1")[RESUME_KEY] == "lookups" and j.resume("2")[RESUME_KEY] == "scored"
+
+
+def test_corrupt_line_fails_its_crc_and_is_skipped(tmp_path):
+    j = _open(tmp_path)
+    for pid in ("1", "2", "3"):
+        j.checkpoint(pid, "lookups", {"property_id": pid, "price": 100})
+    j._file.close()
+    lines = _lines(tmp_path)
+    lines[1] = lines[1].replace(b'"price":100', b'"price":900')
+    (tmp_path / "journal.log").write_bytes(b"".join(lines) + b"not a record\n")
+
+    j = _open(tmp_path)
+    assert j.corrupt_lines == 2
+    assert j.resume("2") is None
+    assert j.resume("1")["price"] == 100 and j.resume("3")["price"] == 100
+
+
+def test_compaction_keeps_only_the_latest_record_of_unwritten_properties(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "COMPACT_MIN_LINES", 8)
+    j = _open(tmp_path)
+    for pid in ("1", "2"):
+        for stage in journal.STAGES:
+            j.checkpoint(pid, stage, {"property_id": pid, "stage_seen": stage})
+    j.mark_written("2")
+    assert len(_lines(tmp_path)) == 7
+    # The 8th line reaches both the minimum and the ratio (4 lines per live property).
+    j.checkpoint("1", "scored", {"property_id": "1", "stage_seen": "scored again"})
+    assert len(_lines(tmp_path)) == 1
+    j.checkpoint("3", "lookups", {"property_id": "3"})
+    j._file.close()
+
+    j = _open(tmp_path)
+    assert j.resume("1") == {"property_id": "1", "stage_seen": "scored again", RESUME_KEY: "scored"}
+    assert j.resume("2") is None
+    assert j.resume("3")[RESUME_KEY] == "lookups"
+    j.close()
+    assert len(_lines(tmp_path)) == 2
+
+
+def test_compaction_waits_for_the_ratio_of_lines_to_live_properties(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "COMPACT_MIN_LINES", 1)
+    j = _open(tmp_path)
+    for pid in range(5):
+        j.checkpoint(str(pid), "lookups", {"property_id": str(pid)})
+    for n in range(14):
+        j.checkpoint("0", "lookups", {"property_id": "0", "n": n})
+    assert len(_lines(tmp_path)) == 19
+    j.checkpoint("0", "lookups", {"property_id": "0", "n": 14})
+    assert len(_lines(tmp_path)) == 5
+
+
+def test_no_compaction_below_the_minimum_line_count(tmp_path):
+    j = _open(tmp_path)
+    for i in range(50):
+        j.checkpoint("1", "lookups", {"property_id": "1", "n": i})
+    assert len(_lines(tmp_path)) == 50
+    assert 50 < journal.COMPACT_MIN_LINES
+
+
+def test_expired_checkpoints_are_dropped(tmp_path, monkeypatch):
+    j = _open(tmp_path, max_age_s=60)
+    j.checkpoint("1", "lookups", {"property_id": "1"})
+    j._file.close()
+
+    now = journal.time.time()
+    monkeypatch.setattr(journal.time, "time", lambda: now + 120)
+    assert _open(tmp_path, max_age_s=60).resume("1") is None
+
+
+def test_reached_and_unmark():
+    item = {"property_id": "1", RESUME_KEY: "renovation"}
+
+    assert CheckpointJournal.reached(item, "lookups")
+    assert CheckpointJournal.reached(item, "renovation")
+    assert not CheckpointJournal.reached(item, "scored")
+    assert not CheckpointJournal.reached({"property_id": "1"}, "lookups")
+    assert CheckpointJournal.unmark(item) == {"property_id": "1"}
+    assert CheckpointJournal.unmark(item) == {"property_id": "1"}
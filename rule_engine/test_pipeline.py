@@ -0,0 +1,55 @@
+# test_pipeline.py
+"""
+Shutdown of an AsyncStage whose event loop fails: the pipeline must still finish
+rather than hang on its threads. Run with `python -m pytest`.
+"""
+import contextlib
+import threading
+
+from pipeline import AsyncStage, Pipeline, Stage
+
+
+def _run_with_timeout(pipeline, items, timeout_s=10.0):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("fed", pipeline.run(items)), daemon=True)
+    thread.start()
+    thread.join(timeout_s)
+    assert not thread.is_alive(), "Pipeline.run hung"
+    return result["fed"]
+
+
+def _resource(fail_on):
+    @contextlib.asynccontextmanager
+    async def resource():
+        if fail_on == "enter":
+            raise RuntimeError("enter failed")
+        yield "session"
+        if fail_on == "exit":
+            raise RuntimeError("exit failed")
+    return resource
+
+
+async def _double(session, item):
+    return item * 2
+
+
+def test_failing_resource_exit_after_the_last_item_does_not_hang():
+    collected = []
+    pipeline = Pipeline([
+        AsyncStage("lookups", _double, concurrency=4, queue_size=2, resource=_resource("exit")),
+        Stage("collect", collected.append),
+    ])
+
+    assert _run_with_timeout(pipeline, range(20)) == 20
+    assert sorted(collected) == [2 * i for i in range(20)]
+
+
+def test_failing_resource_enter_skips_every_item_without_blocking_upstream():
+    pipeline = Pipeline([
+        AsyncStage("lookups", _double, concurrency=4, queue_size=2, resource=_resource("enter")),
+        Stage("collect", lambda item: item),
+    ])
+
+    assert _run_with_timeout(pipeline, range(50)) == 50
+    lookups, collect = pipeline.stats()
+    assert lookups["errors"] == 50 and collect["processed"] == 0
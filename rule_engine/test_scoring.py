@@ -0,0 +1,179 @@
+# test_scoring.py
+"""
+The columnar scoring kernels against the per-row helpers they replace: every
+score must come out identical, not merely close. Run with `python -m pytest`.
+"""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import SCORING_WEIGHTS
+from engine.scoring import (
+    BER_ORDER_WORST_TO_BEST, ScoringEngine, _amenity_access_score, _amenity_access_scores, _cluster_score,
+    _cluster_scores, _cluster_scores_from_counts, _renovation_cost_scores, _round2, _sustainability_score,
+    _sustainability_scores,
+)
+from engine.spatial_index import PersistentSpatialIndex, haversine_m, haversine_m_vec
+
+RADII_M = (50.0, 300.0, 1000.0)
+
+
+def _scalar_cluster_scores(lats, lons, radius_m):
+    return [_cluster_score(lats, lons, i, radius_m) for i in range(len(lats))]
+
+
+def _random_points(rng, n, lat=53.35, lon=-6.26, spread_deg=0.02):
+    return lat + rng.uniform(-spread_deg, spread_deg, n), lon + rng.uniform(-spread_deg, spread_deg, n)
+
+
+@pytest.mark.parametrize("radius_m", RADII_M)
+def test_cluster_scores_match_scalar_on_random_points(radius_m):
+    rng = np.random.default_rng(1)
+    lats, lons = _random_points(rng, 600)
+
+    assert _cluster_scores(lats, lons, radius_m) == _scalar_cluster_scores(lats, lons, radius_m)
+
+
+def test_cluster_scores_match_scalar_exactly_at_the_radius():
+    rng = np.random.default_rng(2)
+    lats, lons = _random_points(rng, 5000, spread_deg=0.005)
+    lats[0], lons[0] = 53.35, -6.26
+    scalar_d = np.array([haversine_m(lats[0], lons[0], float(lat), float(lon)) for lat, lon in zip(lats, lons)])
+    vector_d = haversine_m_vec(np.full(len(lats), lats[0]), np.full(len(lons), lons[0]), lats, lons)
+    # Pairs whose NumPy and math distances differ in the last bit are the ones a
+    # vectorized comparison alone would misclassify, next to a few plain pairs.
+    boundary = np.flatnonzero(scalar_d != vector_d)
+    assert boundary.size
+    for j in boundary.tolist() + [1, 2, 3]:
+        # Small batches, as NumPy's SIMD and scalar loops can round differently.
+        subset = [0, j, *rng.choice(len(lats), 3, replace=False)]
+        radius_m = scalar_d[j]  # the pair (0, j) sits exactly on the boundary
+        assert (_cluster_scores(lats[subset], lons[subset], radius_m)
+                == _scalar_cluster_scores(lats[subset], lons[subset], radius_m))
+
+
+def test_cluster_scores_match_scalar_across_cell_borders():
+    # Points due north/east of an anchor at the radius and one micro-degree either side,
+    # with the anchor placed on a grid cell edge.
+    radius_m = 300.0
+    lat0, lon0 = 53.0, -6.0
+    dlat = np.degrees(radius_m / 6371000.0)
+    dlon = dlat / np.cos(np.radians(lat0))
+    lats, lons = [lat0], [lon0]
+    for eps in (-1e-6, 0.0, 1e-6):
+        lats += [lat0 + dlat + eps, lat0 - dlat - eps, lat0, lat0]
+        lons += [lon0, lon0, lon0 + dlon + eps, lon0 - dlon - eps]
+    lats, lons = np.array(lats), np.array(lons)
+
+    assert _cluster_scores(lats, lons, radius_m) == _scalar_cluster_scores(lats, lons, radius_m)
+
+
+def test_cluster_scores_match_scalar_at_the_antimeridian_and_with_missing_coordinates():
+    rng = np.random.default_rng(3)
+    lats = np.concatenate([rng.uniform(-0.01, 0.01, 100), rng.uniform(79.99, 80.01, 100), [np.nan, 53.0]])
+    lons = np.concatenate([rng.choice([-1, 1], 100) * rng.uniform(179.995, 180.0, 100),
+                           rng.uniform(-0.05, 0.05, 100), [-6.0, np.nan]])
+
+    assert _cluster_scores(lats, lons, 300.0) == _scalar_cluster_scores(lats, lons, 300.0)
+
+
+def test_persistent_index_bulk_counts_match_point_queries(tmp_path):
+    rng = np.random.default_rng(4)
+    lats, lons = _random_points(rng, 400, spread_deg=0.01)
+    ids = [str(i) for i in range(len(lats))]
+    index = PersistentSpatialIndex(str(tmp_path / "index.sqlite3"), radius_m=300.0)
+    index.upsert(zip(ids[:300], lats[:300], lons[:300]), mark_stale=False)
+
+    # The last 100 properties are not in the index yet, as in a batch of new listings.
+    bulk = index.count_within_many(ids, lats, lons)
+    single = [index.count_within(lat, lon, exclude_id=pid) for pid, lat, lon in zip(ids, lats, lons)]
+    index.close()
+
+    assert bulk.tolist() == single
+    assert _cluster_scores_from_counts(bulk) == _scalar_cluster_scores(lats[:300], lons[:300], 300.0) + [
+        _cluster_score(np.append(lats[:300], lat), np.append(lons[:300], lon), 300, 300.0)
+        for lat, lon in zip(lats[300:], lons[300:])
+    ]
+
+
+def test_round2_matches_builtin_round_on_ties():
+    values = np.concatenate([np.arange(0, 100, 0.005), np.random.default_rng(5).uniform(0, 100, 10_000)])
+
+    assert _round2(values).tolist() == [round(float(v), 2) for v in values]
+
+
+def test_renovation_cost_scores_match_scalar():
+    rng = np.random.default_rng(6)
+    price = np.concatenate([rng.uniform(10_000, 500_000, 2000), [0.0, -1.0, 100_000, 100_000, np.nan]])
+    reno = np.concatenate([rng.uniform(0, 1_000_000, 2000), [50_000, 50_000, 50_000, 200_000, 50_000]])
+    reno[:20] = price[:20] * np.array([0.5, 2.0] * 10)  # the clamp bounds exactly
+    scalar = ScoringEngine(SCORING_WEIGHTS, verbose=False)._calculate_renovation_cost_score
+
+    expected = [scalar(float(r), float(p)) for r, p in zip(reno, price)]
+    np.testing.assert_array_equal(_renovation_cost_scores(reno, price), expected)
+
+
+def _amenity(kind, distance_km):
+    return {"type": kind, "distance_km": distance_km}
+
+
+def test_amenity_access_scores_match_scalar():
+    rng = np.random.default_rng(7)
+    kinds = ["bus stop", " Train Station ", "supermarket", "GROCERY", "park", "green space", "school",
+             "secondary school", "pharmacy", None]
+    details = [
+        {"found_amenities": [_amenity(kinds[k], round(float(d), 3) if d < 7 else None)
+                             for k, d in zip(rng.integers(0, len(kinds), m), rng.uniform(-0.1, 8, m))]}
+        for m in rng.integers(0, 8, 2000)
+    ]
+    details += [
+        None, "not a dict", {}, {"found_amenities": None}, {"found_amenities": []},
+        # The anchor bonus needs three categories within the anchor radius, urban and rural.
+        {"found_amenities": [_amenity("bus stop", 0.6), _amenity("supermarket", 0.6),
+                             _amenity("park", 0.6)]},
+        {"found_amenities": [_amenity("bus stop", 1.6), _amenity("supermarket", 1.2), _amenity("park", 1.2),
+                             _amenity("school", 1.2)]},
+        {"found_amenities": [_amenity("school", 1.5), _amenity("school", 0.1), _amenity("park", None)]},
+    ]
+
+    np.testing.assert_array_equal(_amenity_access_scores(details), [_amenity_access_score(d) for d in details])
+
+
+def test_sustainability_scores_match_scalar_with_missing_inputs():
+    rng = np.random.default_rng(8)
+    n = 2000
+    ber = rng.choice(BER_ORDER_WORST_TO_BEST + ["c1 ", " a2", "XX", "", None], n).tolist()
+    access = rng.uniform(0, 100, n).round(2).tolist()
+    area = rng.uniform(-20, 400, n).round(1).tolist()
+    for i in rng.choice(n, 300, replace=False):
+        access[i] = None
+    for i in rng.choice(n, 300, replace=False):
+        area[i] = None
+    records = [{"ber": b, "community_access_score": a, "area_m2": m} for b, a, m in zip(ber, access, area)]
+    expected = [_sustainability_score(r) for r in records]
+
+    # As lists, with None for missing values ...
+    np.testing.assert_array_equal(_sustainability_scores(ber, access, area), expected)
+    # ... and as DataFrame columns, where pandas turns the missing numbers into NaN.
+    frame = pd.DataFrame(records)
+    assert frame["community_access_score"].isna().sum() == 300
+    np.testing.assert_array_equal(
+        _sustainability_scores(frame["ber"], frame["community_access_score"], frame["area_m2"]), expected)
+
+
+def test_flagging_many_neighbours_stays_within_the_sql_variable_limit(tmp_path):
+    rng = np.random.default_rng(9)
+    lats, lons = _random_points(rng, 3000, spread_deg=0.0005)
+    ids = [str(i) for i in range(len(lats))]
+    index = PersistentSpatialIndex(str(tmp_path / "index.sqlite3"), radius_m=300.0)
+    index._conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    index.upsert(zip(ids, lats, lons), mark_stale=False)
+    index.record_scores((pid, 50.0, 50.0) for pid in ids)
+
+    # One new listing in the middle of 3000 scored neighbours flags all of them.
+    flagged = index.upsert([("new", float(lats.mean()), float(lons.mean()))])
+    index.close()
+
+    assert flagged == set(ids)
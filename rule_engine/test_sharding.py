@@ -0,0 +1,145 @@
+# test_sharding.py
+"""
+ShardLeaser against an in-memory store whose transactions are serialized, the
+guarantee Firestore transactions give the lease documents. Run with `python -m pytest`.
+"""
+import threading
+import time
+
+from sharding import ShardLeaser
+
+SHARD_COUNT = 8
+
+
+class _Snapshot:
+    def __init__(self, data):
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _Ref:
+    def __init__(self, db, collection, doc_id):
+        self.db, self.id, self.key = db, doc_id, (collection, doc_id)
+
+    def get(self, transaction=None):
+        return _Snapshot(self.db.docs.get(self.key))
+
+
+class _Transaction:
+    def __init__(self, db):
+        self.db = db
+
+    def set(self, ref, data):
+        self.db.docs[ref.key] = dict(data)
+
+    def update(self, ref, data):
+        self.db.docs[ref.key].update(data)
+
+
+class _Partition:
+    def __init__(self, end_at):
+        self.end_at = end_at
+
+
+class _FakeDB:
+    def __init__(self, doc_ids):
+        self.docs = {}
+        self.doc_ids = sorted(doc_ids)
+        self.lock = threading.RLock()
+
+    def collection(self, name):
+        db = self
+
+        class _Collection:
+            def document(self, doc_id):
+                return _Ref(db, name, doc_id)
+        return _Collection()
+
+    def collection_group(self, name):
+        db = self
+
+        class _Group:
+            def get_partitions(self, partition_count):
+                step = len(db.doc_ids) // partition_count
+                for i in range(1, partition_count):
+                    yield _Partition(_Ref(db, name, db.doc_ids[i * step]))
+                yield _Partition(None)
+        return _Group()
+
+    def discover(self, id_range):
+        lower, upper = id_range
+        return [doc_id for doc_id in self.doc_ids
+                if (lower is None or doc_id >= lower) and (upper is None or doc_id < upper)]
+
+
+class _Leaser(ShardLeaser):
+    def _in_transaction(self, fn, ref):
+        with self.db.lock:
+            return fn(_Transaction(self.db), ref)
+
+
+def _leaser(db, worker_id, lease_s=60.0):
+    return _Leaser(db, worker_id, SHARD_COUNT, lease_s=lease_s, heartbeat_s=lease_s / 4)
+
+
+def _db():
+    return _FakeDB([f"{i:05d}" for i in range(400)])
+
+
+def test_concurrent_claims_are_exclusive():
+    db = _db()
+    leasers = [_leaser(db, name) for name in ("a", "b")]
+    claims = {}
+    threads = [threading.Thread(target=lambda l=l: claims.__setitem__(l.worker_id, l.claim(SHARD_COUNT // 2)))
+               for l in leasers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not set(claims["a"]) & set(claims["b"])
+    assert sorted(claims["a"] + claims["b"]) == list(range(SHARD_COUNT))
+
+
+def test_shard_ranges_cover_every_document_once():
+    db = _db()
+    leaser = _leaser(db, "a")
+    shards = leaser.claim(SHARD_COUNT)
+
+    assert sorted(leaser.documents(shards, db.discover)) == db.doc_ids
+    assert leaser.split_ids() == _leaser(db, "b").split_ids()
+
+
+def test_expired_lease_is_reclaimed():
+    db = _db()
+    stalled = _leaser(db, "stalled", lease_s=0.2)
+    shards = stalled.claim(1)
+    time.sleep(0.3)
+
+    peer = _leaser(db, "peer")
+    assert set(shards) <= set(peer.claim(SHARD_COUNT))
+    stalled.complete(shards)
+    lease = db.docs[("pipeline_leases", f"{SHARD_COUNT}-{shards[0]:04d}")]
+    assert lease["owner"] == "peer" and not lease["completed_at"]
+
+
+def test_completed_shards_are_not_claimed_again():
+    db = _db()
+    a, b = _leaser(db, "a"), _leaser(db, "b")
+    a.complete(a.claim(SHARD_COUNT))
+
+    assert b.claim(1) == []
+    assert a.claim(1) == []
+
+
+def test_released_shards_are_left_to_other_workers():
+    db = _db()
+    a, b = _leaser(db, "a"), _leaser(db, "b")
+    shards = a.claim(SHARD_COUNT)
+    a.release(shards[:1])
+    a.complete(shards[1:])
+
+    assert a.claim(1) == []
+    assert b.claim(1) == shards[:1]